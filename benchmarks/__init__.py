@@ -0,0 +1 @@
+"""benchmarks for the metering sink, run them from the repository root"""
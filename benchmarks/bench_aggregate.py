@@ -0,0 +1,133 @@
+"""
+checks the sample aggregation against a naive per-sample loop and
+compares their speed
+
+    python -m benchmarks.bench_aggregate --resources 500 --samples 120
+"""
+import argparse
+import math
+import random
+import time
+from datetime import datetime, timezone
+
+from metersink.aggregate import Aggregator, sample_fields
+
+METERS = (
+    ("cpu", "cumulative", "ns"),
+    ("memory.usage", "gauge", "MB"),
+    ("network.incoming.bytes.delta", "delta", "B"),
+    ("volume.size", "gauge", "GB"),
+)
+
+
+def make_samples(resources, samples_per_meter, interval, seed=1):
+    """returns synthetic ceilometer samples in publisher order"""
+    rng = random.Random(seed)
+    start = 1_700_000_000
+    samples = []
+    counters = {}
+    for step in range(samples_per_meter):
+        timestamp = datetime.fromtimestamp(start + step * interval, tz=timezone.utc)
+        timestamp = timestamp.replace(tzinfo=None).isoformat()
+        for resource in range(resources):
+            for meter, counter_type, unit in METERS:
+                if counter_type == "cumulative":
+                    key = (resource, meter)
+                    counters[key] = counters.get(key, 0) + rng.randint(0, 10 ** 9)
+                    volume = counters[key]
+                else:
+                    volume = rng.random() * 1000
+                samples.append({
+                    "counter_name": meter,
+                    "counter_type": counter_type,
+                    "counter_unit": unit,
+                    "counter_volume": volume,
+                    "resource_id": f"resource-{resource}",
+                    "project_id": f"project-{resource % 20}",
+                    "timestamp": timestamp,
+                })
+    return samples
+
+
+def naive_rollup(samples, window):
+    """the reference, one pass over all samples at the end"""
+    series = {}
+    epochs = {}
+    for sample in samples:
+        meter, counter_type, _unit, volume, timestamp = sample_fields(sample, epochs)
+        series.setdefault((sample["resource_id"], meter, counter_type), []).append(
+            (timestamp, volume))
+    records = {}
+    for (resource_id, meter, counter_type), points in series.items():
+        points.sort()
+        previous = None
+        for index, (timestamp, volume) in enumerate(points):
+            window_start = math.floor(timestamp / window) * window
+            window_end = window_start + window
+            record = records.setdefault((resource_id, meter, window_start), {
+                "first": timestamp, "count": 0, "total": 0.0, "integral": 0.0,
+                "max": -math.inf, "last": None,
+            })
+            next_time = points[index + 1][0] if index + 1 < len(points) else math.inf
+            integral = volume * (min(next_time, window_end) - timestamp)
+            record["integral"] += integral
+            if counter_type == "delta":
+                record["total"] += volume
+            elif counter_type == "cumulative":
+                if previous is not None:
+                    record["total"] += volume - previous if volume >= previous else volume
+            else:
+                record["total"] += integral
+            record["count"] += 1
+            record["max"] = max(record["max"], volume)
+            record["last"] = volume
+            previous = volume
+    for (_resource_id, _meter, window_start), record in records.items():
+        span = window_start + window - record["first"]
+        record["mean"] = record["integral"] / span if span else 0.0
+    return records
+
+
+def main():
+    """runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--resources", type=int, default=500)
+    parser.add_argument("--samples", type=int, default=120, help="samples per meter")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between polls")
+    parser.add_argument("--window", type=int, default=3600)
+    args = parser.parse_args()
+
+    samples = make_samples(args.resources, args.samples, args.interval)
+    end = 1_700_000_000 + args.samples * args.interval + args.window
+
+    start = time.perf_counter()
+    expected = naive_rollup(samples, args.window)
+    naive_seconds = time.perf_counter() - start
+
+    aggregator = Aggregator(window=args.window, grace=0, meters=[m[0] for m in METERS])
+    start = time.perf_counter()
+    # the api hands the aggregator one POST batch at a time
+    for offset in range(0, len(samples), 1000):
+        aggregator.add_batch(samples[offset:offset + 1000])
+    records = aggregator.rollup(now=end)
+    aggregator_seconds = time.perf_counter() - start
+
+    assert len(records) == len(expected), (len(records), len(expected))
+    for record in records:
+        naive = expected[(record.resource_id, record.meter, record.window_start)]
+        assert naive["count"] == record.count
+        assert math.isclose(naive["total"], record.total, rel_tol=1e-9, abs_tol=1e-6)
+        assert math.isclose(naive["mean"], record.mean, rel_tol=1e-9, abs_tol=1e-6)
+        assert naive["max"] == record.max and naive["last"] == record.last
+
+    print(f"samples:       {len(samples)}")
+    print(f"usage records: {len(records)}")
+    print(f"naive loop:    {naive_seconds:.3f}s {len(samples) / naive_seconds:,.0f} samples/s")
+    print(f"aggregator:    {aggregator_seconds:.3f}s "
+          f"{len(samples) / aggregator_seconds:,.0f} samples/s")
+    print(f"speedup:       {naive_seconds / aggregator_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
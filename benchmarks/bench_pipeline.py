@@ -0,0 +1,188 @@
+"""
+drives /post_json of an in-process pipeline against a fake odoo and
+reports the throughput, the request latency and the odoo rpcs per message
+
+    python -m benchmarks.bench_pipeline --messages 5000 --latency 0.002
+    python -m benchmarks.bench_pipeline --input recorded.jsonl --set odoo.flush_interval=0
+
+a recorded input has one batch (a json array), one captured batch or one
+message per line
+"""
+import argparse
+import configparser
+import json
+import logging
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from werkzeug.serving import make_server
+
+from benchmarks.fake_odoo import FakeOdoo
+from metersink.api import app, start_pipeline
+from metersink.metrics import ODOO_RPCS
+from metersink.replay import Poster, percentile
+
+EVENT_TYPES = (
+    "compute.instance.create.end",
+    "compute.instance.exists",
+    "compute.instance.resize.confirm.end",
+    "compute.instance.shelve.end",
+    "compute.instance.unshelve.end",
+    "volume.create.end",
+    "volume.exists",
+    "volume.resize.end",
+)
+FLAVORS = ("SCS-1V-2", "SCS-2V-4", "SCS-4V-8", "SCS-8V-16")
+
+
+def make_events(messages, projects, resources, seed=1):
+    """returns synthetic ceilometer events in publisher order"""
+    rng = random.Random(seed)
+    created = datetime(2026, 1, 1)
+    events = []
+    for number in range(messages):
+        resource = rng.randrange(resources)
+        event_type = rng.choice(EVENT_TYPES)
+        traits = [
+            ["project_id", 1, f"project-{resource % projects}"],
+            ["resource_id", 1, f"00000000-0000-4000-8000-{resource:012d}"],
+            ["created_at", 1, created.isoformat()],
+            ["display_name", 1, f"resource-{resource}"],
+        ]
+        if event_type.startswith("volume"):
+            traits.append(["size", 2, rng.choice((10, 20, 50, 100))])
+        else:
+            traits.append(["flavor_name", 1, rng.choice(FLAVORS)])
+        events.append({
+            "event_type": event_type,
+            "message_id": f"bench-{number}",
+            "generated": (created + timedelta(minutes=number)).isoformat(),
+            "traits": traits,
+        })
+    return events
+
+
+def read_batches(path, batch_size):
+    """returns the batches of a recorded file, loose messages are batched up"""
+    batches = []
+    loose = []
+    with open(path, encoding="utf-8") as recorded:
+        for line in recorded:
+            if not line.strip():
+                continue
+            value = json.loads(line)
+            if isinstance(value, list):
+                batches.append(value)
+            elif isinstance(value, dict) and "messages" in value:
+                # a line of metersink.capture
+                batches.append(value["messages"])
+            elif isinstance(value, dict):
+                loose.append(value)
+    batches.extend(loose[offset:offset + batch_size]
+                   for offset in range(0, len(loose), batch_size))
+    return batches
+
+
+def project_ids(batches):
+    """returns the project ids of the events in batches"""
+    found = set()
+    for batch in batches:
+        for message in batch:
+            traits = message.get("traits")
+            if isinstance(traits, list):
+                found.update(value for name, _type, value in traits if name == "project_id")
+            elif isinstance(traits, dict) and "project_id" in traits:
+                found.add(traits["project_id"])
+    return found
+
+
+def write_config(directory, url, overrides):
+    """writes the config of the pipeline under test and returns its path"""
+    conf = configparser.ConfigParser()
+    conf.read_dict({
+        "DEFAULT": {"log_level": "WARNING"},
+        "output": {"odoo": url},
+        "odoo": {"odoo_db": "bench", "odoo_user_name": "bench", "odoo_api_key": "bench"},
+    })
+    for override in overrides:
+        key, value = override.split("=", 1)
+        section, option = key.split(".", 1)
+        if section != "DEFAULT" and not conf.has_section(section):
+            conf.add_section(section)
+        conf.set(section, option, value)
+    path = os.path.join(directory, "bench.conf")
+    with open(path, "w", encoding="utf-8") as config_file:
+        conf.write(config_file)
+    return path
+
+
+def main():
+    """runs the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--input", help="a recorded file of batches or messages")
+    parser.add_argument("--messages", type=int, default=2000, help="synthetic messages")
+    parser.add_argument("--projects", type=int, default=20)
+    parser.add_argument("--resources", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=50, help="messages per request")
+    parser.add_argument("--concurrency", type=int, default=4, help="parallel requests")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds the fake odoo takes per call")
+    parser.add_argument("--set", dest="overrides", action="append", default=[],
+                        metavar="SECTION.KEY=VALUE", help="overrides a config value")
+    args = parser.parse_args()
+
+    if args.input:
+        batches = read_batches(args.input, args.batch)
+    else:
+        events = make_events(args.messages, args.projects, args.resources)
+        batches = [events[offset:offset + args.batch]
+                   for offset in range(0, len(events), args.batch)]
+    messages = sum(len(batch) for batch in batches)
+
+    # one log line per request would be measured too
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    odoo = FakeOdoo(latency=args.latency, projects=project_ids(batches)).start()
+    with tempfile.TemporaryDirectory() as directory:
+        stop_pipeline = start_pipeline(write_config(directory, odoo.url, args.overrides))
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        poster = Poster(f"http://127.0.0.1:{server.server_port}/post_json")
+        rpcs_before = sum(ODOO_RPCS.values().values())
+        calls_before = Counter(odoo.calls)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            latencies = list(executor.map(poster.post, batches))
+        accepted_seconds = time.perf_counter() - start
+        app.config['ingest'].join()
+        # buffered line writes count as delivered once they are flushed
+        stop_pipeline()
+        delivered_seconds = time.perf_counter() - start
+
+        server.shutdown()
+        odoo.stop()
+    rpcs = sum(ODOO_RPCS.values().values()) - rpcs_before
+
+    print(f"messages:      {messages} in {len(batches)} requests, "
+          f"{args.concurrency} in parallel")
+    print(f"accepted:      {accepted_seconds:.3f}s {messages / accepted_seconds:,.0f} msg/s")
+    print(f"delivered:     {delivered_seconds:.3f}s {messages / delivered_seconds:,.0f} msg/s")
+    print(f"request p50:   {percentile(latencies, 0.5) * 1000:.1f}ms")
+    print(f"request p99:   {percentile(latencies, 0.99) * 1000:.1f}ms")
+    print(f"request mean:  {statistics.mean(latencies) * 1000:.1f}ms")
+    print(f"rejected:      {poster.rejected} requests with 503")
+    print(f"odoo rpcs:     {rpcs} {rpcs / messages:.2f} per message")
+    for call, count in (odoo.calls - calls_before).most_common():
+        print(f"  {call:32} {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+an in-memory odoo behind the xml-rpc common and object endpoints, with an
+artificial latency per call, for benchmarks without a real odoo
+"""
+import threading
+import time
+from collections import Counter
+from socketserver import ThreadingMixIn
+from xmlrpc.server import SimpleXMLRPCRequestHandler, SimpleXMLRPCServer
+
+
+class _Handler(SimpleXMLRPCRequestHandler):
+    rpc_paths = ("/xmlrpc/2/common", "/xmlrpc/2/object")
+    # the sinks keep their connections open
+    protocol_version = "HTTP/1.1"
+
+
+class _Server(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+
+def _domain(args) -> list:
+    """returns the domain of search args in polish notation"""
+    domain = list(args[0]) if args else []
+    if len(domain) == 3 and isinstance(domain[0], str) and domain[0] not in "|&!":
+        # a single condition without the list around it
+        return [domain]
+    return domain
+
+
+def _condition(record, condition) -> bool:
+    field, operator, value = condition
+    if "." in field:
+        # related fields like order_id.state are not modelled
+        return True
+    current = record.get(field)
+    if isinstance(current, list) and len(current) == 2 and isinstance(current[1], str) \
+            and field.endswith("_id"):
+        # a many2one as read, [id, name]
+        current = current[0]
+    if operator == "=":
+        return current == value
+    if operator == "=like":
+        return str(current or "").startswith(value.rstrip("%"))
+    if operator == "in":
+        if isinstance(current, list):
+            return bool(set(current) & set(value))
+        return current in value
+    return True
+
+
+def _matches(record, domain) -> bool:
+    def term(position):
+        item = domain[position]
+        if item in ("|", "&"):
+            left, position = term(position + 1)
+            right, position = term(position)
+            return (left or right) if item == "|" else (left and right), position
+        if item == "!":
+            value, position = term(position + 1)
+            return not value, position
+        return _condition(record, item), position + 1
+
+    position = 0
+    while position < len(domain):
+        value, position = term(position)
+        if not value:
+            return False
+    return True
+
+
+class FakeOdoo:
+    """
+    serves version, authenticate and execute_kw with search, search_read,
+    search_count, read, create and write on dict tables, every call
+    sleeps latency seconds first
+    """
+
+    def __init__(self, latency=0.0, projects=(), host="127.0.0.1", port=0):
+        self.latency = latency
+        self.calls = Counter()
+        self.tables = {
+            "res.partner": {},
+            "sale.order": {},
+            "sale.order.line": {},
+            "res.product": {},
+        }
+        self._ids = 0
+        self._lock = threading.Lock()
+        for project_id in projects:
+            self.add_customer(project_id)
+        self._server = _Server((host, port), requestHandler=_Handler,
+                               logRequests=False, allow_none=True)
+        self._server.register_function(self.version)
+        self._server.register_function(self.authenticate)
+        self._server.register_function(self.execute_kw)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """returns the base url of the xml-rpc endpoints"""
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _next_id(self) -> int:
+        with self._lock:
+            self._ids += 1
+            return self._ids
+
+    def add_customer(self, project_id):
+        """adds a partner with the tag of a project"""
+        record_id = self._next_id()
+        self.tables["res.partner"][record_id] = {
+            "id": record_id,
+            "name": f"customer of {project_id}",
+            "category_id": [f"project={project_id}"],
+            "sale_order_ids": [],
+        }
+
+    def start(self):
+        """serves in a background thread"""
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="fake-odoo", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """stops serving"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, call):
+        with self._lock:
+            self.calls[call] += 1
+
+    def version(self):
+        """the version probe of the common endpoint"""
+        self._count("common.version")
+        return {"server_version": "16.0"}
+
+    def authenticate(self, _db, _user_name, _password, _env):
+        """the login of the common endpoint"""
+        self._count("common.authenticate")
+        return 2
+
+    def execute_kw(self, _db, _uid, _password, model, method, args, kwargs=None):
+        """the model methods of the object endpoint"""
+        time.sleep(self.latency)
+        self._count(f"{model}.{method}")
+        kwargs = kwargs or {}
+        table = self.tables.setdefault(model, {})
+        if method in ("search", "search_read", "search_count"):
+            domain = _domain(args)
+            records = [record for record in list(table.values()) if _matches(record, domain)]
+            records = records[kwargs.get("offset", 0):]
+            if kwargs.get("limit"):
+                records = records[:kwargs["limit"]]
+            if method == "search":
+                return [record["id"] for record in records]
+            if method == "search_count":
+                return len(records)
+            return records
+        if method == "read":
+            ids = args[0][0] if args and args[0] and isinstance(args[0][0], list) else args[0]
+            return [table[record_id] for record_id in ids if record_id in table]
+        if method == "create":
+            values = args[0]
+            single = isinstance(values, dict)
+            ids = []
+            for value in [values] if single else values:
+                record = dict(value, id=self._next_id())
+                record.setdefault("name", record.get("display_name"))
+                table[record["id"]] = record
+                ids.append(record["id"])
+            return ids[0] if single or len(ids) == 1 else ids
+        if method == "write":
+            ids, values = args
+            for record_id in ids:
+                table[record_id].update(values)
+            return True
+        return {} if method == "fields_get" else []
@@ -0,0 +1,448 @@
+"""
+aggregation of ceilometer polling samples into usage records per billing window
+"""
+import fnmatch
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+import numpy as np
+
+from metersink.lib import parse_time
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 3600
+DEFAULT_GRACE = 60
+DEFAULT_IDLE_TTL = 86400
+DEFAULT_METERS = (
+    "cpu",
+    "memory.usage",
+    "disk.device.*",
+    "network.*.bytes.delta",
+    "volume.size",
+)
+INITIAL_CAPACITY = 16
+
+
+class UsageRecord(NamedTuple):
+    """
+    the usage of one meter of a resource in one billing window
+
+    total is the sum of deltas for delta and cumulative meters and the
+    time integral (value * seconds) for gauges, mean is time-weighted
+    """
+    project_id: str
+    resource_id: str
+    meter: str
+    unit: str
+    counter_type: str
+    window_start: float
+    window_end: float
+    count: int
+    total: float
+    mean: float
+    max: float
+    last: float
+
+    def to_dict(self) -> dict:
+        """returns the record as message for the sinks"""
+        data = self._asdict()
+        for key in ("window_start", "window_end"):
+            data[key] = datetime.fromtimestamp(data[key], tz=timezone.utc).isoformat()
+        data["usage"] = True
+        return data
+
+
+def is_sample(message) -> bool:
+    """tells a polling sample from an event"""
+    return "event_type" not in message and (
+        "counter_name" in message or "name" in message
+    )
+
+
+def to_epoch(value) -> float:
+    """returns the unix time of a utc ceilometer timestamp"""
+    return parse_time(value).replace(tzinfo=timezone.utc).timestamp()
+
+
+def sample_fields(sample, epochs=None) -> tuple:
+    """
+    returns (meter, type, unit, volume, timestamp) of a sample in either
+    format, epochs caches the parsed timestamps of a batch
+    """
+    meter = sample.get("counter_name", sample.get("name"))
+    counter_type = sample.get("counter_type", sample.get("type", "gauge"))
+    unit = sample.get("counter_unit", sample.get("unit", ""))
+    volume = sample.get("counter_volume", sample.get("volume"))
+    if epochs is None:
+        timestamp = to_epoch(sample["timestamp"])
+    else:
+        # the samples of one polling cycle share their timestamps
+        timestamp = epochs.get(sample["timestamp"])
+        if timestamp is None:
+            timestamp = epochs[sample["timestamp"]] = to_epoch(sample["timestamp"])
+    return meter, counter_type, unit, float(volume), timestamp
+
+
+class SeriesBuffer:
+    """
+    the columnar, time ordered samples of one (resource, meter) pair which
+    are not rolled up yet
+
+    new samples are collected in lists and moved into the arrays in one go
+    before a rollup, as a poll usually brings one sample per series
+    """
+
+    __slots__ = ("project_id", "counter_type", "unit", "times", "values", "size", "sorted",
+                 "pending_times", "pending_values", "previous", "seen")
+
+    def __init__(self, project_id, counter_type, unit):
+        self.project_id = project_id
+        self.counter_type = counter_type
+        self.unit = unit
+        self.times = np.empty(INITIAL_CAPACITY, dtype=np.float64)
+        self.values = np.empty(INITIAL_CAPACITY, dtype=np.float64)
+        self.size = 0
+        self.sorted = True
+        self.pending_times = []
+        self.pending_values = []
+        # the last value before the buffered samples, for cumulative meters
+        self.previous = np.nan
+        self.seen = time.monotonic()
+
+    def __len__(self):
+        return self.size + len(self.pending_times)
+
+    def append(self, timestamp, value):
+        """collects one sample"""
+        self.pending_times.append(timestamp)
+        self.pending_values.append(value)
+        self.seen = time.monotonic()
+
+    def _move_pending(self):
+        if self.pending_times:
+            self.extend(np.fromiter(self.pending_times, np.float64, len(self.pending_times)),
+                        np.fromiter(self.pending_values, np.float64, len(self.pending_values)))
+            self.pending_times = []
+            self.pending_values = []
+
+    def extend(self, times, values):
+        """appends sample arrays, grows the arrays by doubling"""
+        needed = self.size + len(times)
+        if needed > len(self.times):
+            capacity = max(needed, 2 * len(self.times))
+            self.times = np.resize(self.times, capacity)
+            self.values = np.resize(self.values, capacity)
+        if self.size and times[0] < self.times[self.size - 1] or np.any(np.diff(times) < 0):
+            self.sorted = False
+        self.times[self.size:needed] = times
+        self.values[self.size:needed] = values
+        self.size = needed
+
+    def _sort(self):
+        order = np.argsort(self.times[:self.size], kind="stable")
+        self.times[:self.size] = self.times[:self.size][order]
+        self.values[:self.size] = self.values[:self.size][order]
+        self.sorted = True
+
+    def rollup(self, window, until) -> list:
+        """
+        aggregates all windows which end before until and drops their
+        samples, returns (window_start, count, total, mean, max, last) rows
+        """
+        self._move_pending()
+        if not self.size:
+            return []
+        if not self.sorted:
+            self._sort()
+        times = self.times[:self.size]
+        values = self.values[:self.size]
+        closed = int(np.searchsorted(times, math.floor(until / window) * window, side="left"))
+        if not closed:
+            return []
+        times = times[:closed]
+        values = values[:closed]
+
+        window_ids = np.floor(times / window)
+        starts = np.flatnonzero(np.diff(window_ids, prepend=np.nan))
+        window_starts = window_ids[starts] * window
+        window_ends = window_starts + window
+        counts = np.diff(np.append(starts, closed))
+
+        # every sample holds its value until the next one or the window end
+        next_times = np.append(times[1:], np.inf)
+        window_end_per_sample = np.repeat(window_ends, counts)
+        held = np.minimum(next_times, window_end_per_sample) - times
+        integrals = np.add.reduceat(values * held, starts)
+        spans = window_ends - times[starts]
+        means = np.divide(integrals, spans, out=np.zeros_like(integrals), where=spans > 0)
+        maxima = np.maximum.reduceat(values, starts)
+        lasts = values[np.append(starts[1:], closed) - 1]
+
+        if self.counter_type == "delta":
+            totals = np.add.reduceat(values, starts)
+        elif self.counter_type == "cumulative":
+            increments = np.diff(values, prepend=self.previous)
+            # a counter reset starts again from zero
+            increments = np.where(increments < 0, values, increments)
+            increments[np.isnan(increments)] = 0.0
+            totals = np.add.reduceat(increments, starts)
+            self.previous = values[-1]
+        else:
+            totals = integrals
+
+        remaining = self.size - closed
+        self.times[:remaining] = self.times[closed:self.size]
+        self.values[:remaining] = self.values[closed:self.size]
+        self.size = remaining
+        return list(zip(window_starts.tolist(), counts.tolist(), totals.tolist(),
+                        means.tolist(), maxima.tolist(), lasts.tolist()))
+
+
+class SpoolHold:
+    """
+    holds back the spool commit of a batch with aggregated samples. it
+    goes through for a sink once the rest of the batch reached it and the
+    usage records of the windows of the samples as well, so a restart
+    replays the samples of windows which were not emitted yet.
+    """
+
+    __slots__ = ("commit", "until", "_delivered", "_emitted", "_committed", "_lock")
+
+    def __init__(self, commit):
+        self.commit = commit
+        # the end of the last window of the samples
+        self.until = 0.0
+        self._delivered = set()
+        # None once the windows went to every sink
+        self._emitted = set()
+        self._committed = set()
+        self._lock = threading.Lock()
+
+    def _due(self, sink_names) -> list:
+        due = [
+            sink_name for sink_name in sink_names
+            if sink_name in self._delivered and sink_name not in self._committed
+            and (self._emitted is None or sink_name in self._emitted)
+        ]
+        self._committed.update(due)
+        return due
+
+    def delivered(self, sink_name):
+        """the rest of the batch reached a sink"""
+        with self._lock:
+            self._delivered.add(sink_name)
+            due = self._due([sink_name])
+        for sink in due:
+            self.commit(sink)
+
+    def emitted(self, sink_name=None):
+        """the windows of the samples reached a sink, without one all sinks"""
+        with self._lock:
+            if sink_name is None:
+                self._emitted = None
+            elif self._emitted is not None:
+                self._emitted.add(sink_name)
+            due = self._due(list(self._delivered) if sink_name is None else [sink_name])
+        for sink in due:
+            self.commit(sink)
+
+
+class Aggregator:
+    """
+    buffers polling samples per (resource, meter) and rolls them up into
+    usage records once their billing window plus a grace period is over.
+    a cumulative series keeps its last value for the next window until it
+    had no sample for idle_ttl seconds, e.g. of a deleted resource.
+    """
+
+    def __init__(self, window=DEFAULT_WINDOW, grace=DEFAULT_GRACE, meters=DEFAULT_METERS,
+                 idle_ttl=DEFAULT_IDLE_TTL):
+        self.window = window
+        self.grace = grace
+        self.meters = tuple(meters)
+        self.idle_ttl = idle_ttl
+        self._series = {}
+        self._holds = []
+        self._lock = threading.Lock()
+        self._stats = {"samples": 0, "ignored": 0, "invalid": 0, "records": 0,
+                       "evicted": 0}
+
+    def accepts(self, meter) -> bool:
+        """tells if a meter is aggregated"""
+        return any(fnmatch.fnmatchcase(meter, pattern) for pattern in self.meters)
+
+    def add_batch(self, samples, hold=None) -> list:
+        """
+        buffers samples, returns the ones whose meter is not aggregated.
+        hold, the SpoolHold of their batch, is released by the rollup which
+        emits their windows. samples without a resource, a timestamp or a
+        numeric volume are dropped and counted as invalid
+        """
+        rest = []
+        epochs = {}
+        accepted = {}
+        valid = []
+        invalid = 0
+        # every sample is read before one is buffered, a replay of the
+        # batch must not find a part of it in the buffers already
+        for sample in samples:
+            meter = sample.get("counter_name", sample.get("name"))
+            if not isinstance(meter, str):
+                invalid += 1
+                continue
+            if meter not in accepted:
+                accepted[meter] = self.accepts(meter)
+            if not accepted[meter]:
+                rest.append(sample)
+                continue
+            try:
+                fields = sample_fields(sample, epochs)
+                resource_id = sample["resource_id"]
+            except (LookupError, TypeError, ValueError):
+                invalid += 1
+                continue
+            if resource_id is None or not math.isfinite(fields[3]):
+                invalid += 1
+                continue
+            valid.append((resource_id, sample.get("project_id"), fields))
+        if invalid:
+            LOG.warning("dropped %s invalid samples of a batch", invalid)
+        until = 0.0
+        with self._lock:
+            for resource_id, project_id, (meter, counter_type, unit, volume, timestamp) in valid:
+                key = (resource_id, meter)
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = SeriesBuffer(project_id, counter_type, unit)
+                series.append(timestamp, volume)
+                until = max(until, timestamp)
+            added = len(valid)
+            self._stats["samples"] += added
+            self._stats["ignored"] += len(rest)
+            self._stats["invalid"] += invalid
+            if hold is not None and added:
+                hold.until = (math.floor(until / self.window) + 1) * self.window
+                self._holds.append(hold)
+        if hold is not None and not added:
+            hold.emitted()
+        return rest
+
+    def rollup(self, now=None) -> list:
+        """returns the usage records of all windows which are over"""
+        return self.rollup_held(now)[0]
+
+    def rollup_held(self, now=None) -> tuple:
+        """
+        returns the usage records of all windows which are over and the
+        SpoolHolds of the batches whose samples are all in them
+        """
+        until = (now if now is not None else time.time()) - self.grace
+        idle_since = time.monotonic() - self.idle_ttl
+        closed = math.floor(until / self.window) * self.window
+        records = []
+        with self._lock:
+            for (resource_id, meter), series in list(self._series.items()):
+                for window_start, count, total, mean, maximum, last in series.rollup(
+                        self.window, until):
+                    records.append(UsageRecord(
+                        project_id=series.project_id,
+                        resource_id=resource_id,
+                        meter=meter,
+                        unit=series.unit,
+                        counter_type=series.counter_type,
+                        window_start=window_start,
+                        window_end=window_start + self.window,
+                        count=count,
+                        total=total,
+                        mean=mean,
+                        max=maximum,
+                        last=last,
+                    ))
+                if not len(series) and (series.counter_type != "cumulative"
+                                        or series.seen <= idle_since):
+                    if series.counter_type == "cumulative":
+                        self._stats["evicted"] += 1
+                    del self._series[(resource_id, meter)]
+            self._stats["records"] += len(records)
+            holds = [hold for hold in self._holds if hold.until <= closed]
+            self._holds = [hold for hold in self._holds if hold.until > closed]
+        return records, holds
+
+    def stats(self) -> dict:
+        """returns the sample and record counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["series"] = len(self._series)
+            stats["buffered"] = sum(len(series) for series in self._series.values())
+            stats["held_batches"] = len(self._holds)
+        return stats
+
+
+class RollupTimer:
+    """
+    rolls the aggregator up periodically and hands the records to
+    emit(records, on_delivered), which calls on_delivered(sink_name) for
+    every sink which took them
+    """
+
+    def __init__(self, aggregator, emit, interval):
+        self.aggregator = aggregator
+        self.emit = emit
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="rollup", daemon=True)
+
+    def start(self):
+        """starts the periodic rollup"""
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self, now=None):
+        """rolls up once and emits the records"""
+        records, holds = self.aggregator.rollup_held(now)
+
+        def on_delivered(sink_name):
+            for hold in holds:
+                hold.emitted(sink_name)
+
+        if records:
+            LOG.debug("emitting %s usage records", len(records))
+            try:
+                self.emit([record.to_dict() for record in records], on_delivered)
+            except Exception:  # pylint: disable=broad-except
+                # the spool keeps the held batches for a replay
+                LOG.exception("failed to emit %s usage records", len(records))
+        else:
+            for hold in holds:
+                hold.emitted()
+
+    def stop(self):
+        """stops the periodic rollup"""
+        self._stop.set()
+        self._thread.join()
+
+
+def get_aggregate_settings(conf):
+    """reads the [aggregate] section of the config, returns None if it is off"""
+    section = "aggregate"
+    if not conf.getboolean(section, "enabled", fallback=False):
+        return None
+    meters = [
+        meter.strip()
+        for meter in conf.get(section, "meters", fallback="").splitlines()
+        if meter.strip()
+    ]
+    return {
+        "window": conf.getint(section, "window", fallback=DEFAULT_WINDOW),
+        "grace": conf.getint(section, "grace", fallback=DEFAULT_GRACE),
+        "idle_ttl": conf.getint(section, "idle_ttl", fallback=DEFAULT_IDLE_TTL),
+        "meters": meters or DEFAULT_METERS,
+    }
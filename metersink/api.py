@@ -1,12 +1,97 @@
 """describes the api endpoint of the metering tool"""
 import argparse
+import functools
 import logging
-from pprint import pformat
-from flask import Flask, request, json
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import NamedTuple
+from flask import Flask, Response, request
 
-from metersink.lib import get_config, get_sinks
-from metersink.output_odoo import odoo_handle
-from metersink.output_textfile import output_file
+from metersink.aggregate import (
+    Aggregator,
+    RollupTimer,
+    SpoolHold,
+    get_aggregate_settings,
+    is_sample,
+)
+from metersink.backfill import DEFAULT_BATCH_SIZE, DEFAULT_CHECKPOINT, DEFAULT_WORKERS, backfill
+from metersink.capture import TrafficCapture, get_capture_settings
+from metersink.deadletter import DeadLetterStore, get_dead_letter_settings, iter_letters
+from metersink.dedup import Deduplicator, get_dedup_settings
+from metersink.fanout import FanOut, Progress
+from metersink.ingest import (
+    DEFAULT_MAX_BATCH,
+    IngestQueue,
+    QueueFull,
+    get_ingest_settings,
+    split_batch,
+)
+from metersink.ledger import (
+    LedgerReconciler,
+    UsageLedger,
+    get_ledger_settings,
+    open_job_ledger,
+    period_of,
+)
+from metersink.lib import get_config, messages_to_events
+from metersink.metrics import (
+    CONTENT_TYPE,
+    ERRORS,
+    HTTP_REQUESTS,
+    MESSAGES,
+    collect,
+    merge,
+    register_collector,
+    render,
+    stats_to_families,
+)
+from metersink.output_odoo import (
+    cache_stats,
+    coalescer_stats,
+    configure_caches,
+    configure_coalescing,
+    configure_sessions,
+    invalidate_caches,
+    lifecycle_stats,
+    line_index_stats,
+    odoo_handle,
+    odoo_written,
+    plan_odoo_batch,
+    reconcile_ledger,
+    set_dead_letters,
+    set_ledger,
+    stop_coalescers,
+    warm_line_indexes,
+    warm_odoo_sessions,
+)
+from metersink.parse import ParseError, TooLarge, UnsupportedFormat, iter_batches, iter_messages
+from metersink.output_textfile import (
+    close_file_sinks,
+    configure_file_sinks,
+    file_sink_stats,
+    output_file_batch,
+)
+from metersink.replay import DEFAULT_CONCURRENCY, DEFAULT_URL, run_replay
+from metersink.routing import Router
+from metersink.rpc import configure_pools, pool_stats
+from metersink.serve import Front, get_server_settings, serve, worker_loop
+from metersink.sources import AmqpSource, get_amqp_settings
+from metersink.spool import Spool, get_spool_settings
+from metersink.tracing import (
+    PROFILER,
+    TRACE_SETTINGS,
+    configure_tracing,
+    correlation_id_of,
+    recent_traces,
+    set_tracing,
+    span,
+    trace,
+)
 
 app = Flask(__name__)
 NAME = "billing_api"
@@ -17,43 +102,837 @@ def _init_logger():
 
 _init_logger()
 LOG = logging.getLogger(NAME)
+# switches of the capture file one at a time
+_CAPTURE_LOCK = threading.Lock()
 
 
-def push_to_sinks(conf, data):
-    """puts received metering data to the configured billing sinks"""
-    # LOG.debug('%s', conf)
-    sinks = get_sinks(conf)
-    LOG.debug("pushing to sinks: %s", sinks)
-    for sink_type, sink_values in sinks.items():
-        if sink_type == "file":
-            for sink_name in sink_values["name"]:
-                # maybe we want to differ between events and polls here
-                # for now we put all incoming into the file
-                output_file(sink_name, data)
-        elif sink_type == "odoo":
-            odoo_handle(sink_values, conf, data)
+def deliver_to_sink(sink_type, target, batch, sink_name=None, progress=None):
+    """
+    puts a batch into one sink, after the messages progress counts as
+    delivered, and moves progress on as the sink takes them. returns a
+    future if the sink buffered writes, it is done once they are written.
+    """
+    progress = progress or Progress()
+    if sink_type == "file":
+        # maybe we want to differ between events and polls here
+        # for now we put all incoming into the file.
+        # with the spool the batch counts as delivered once it is written
+        # a file write is traced under the first message of its batch
+        rest = batch[progress.delivered:]
+        with trace(correlation_id_of(rest[0]) if rest else "", sink_name), \
+                span("write", messages=len(rest)):
+            output_file_batch(target, rest, durable='spool' in app.config, progress=progress)
+        return
+    if sink_type == "odoo":
+        # the batch of an odoo sink holds the events of the messages,
+        # None for those which could not be read
+        rest = [message for message in batch[progress.delivered:] if message is not None]
+        with trace(correlation_id_of(rest[0]) if rest else "", sink_name), \
+                span("plan", messages=len(rest)):
+            # the lookups of all messages at once
+            plan = plan_odoo_batch(target, rest)
+        for number in range(progress.delivered, len(batch)):
+            message = batch[number]
+            if message is not None:
+                with trace(correlation_id_of(message), sink_name):
+                    odoo_handle((target,), message, plan=plan)
+            progress.delivered = number + 1
+        return odoo_written(target)
+    return None
+
+
+def push_to_sinks(routes, batch, only=None, on_delivered=None) -> list:
+    """
+    puts received metering data to the configured billing sinks in
+    parallel and returns the names of the sinks which took the whole
+    batch within their delivery timeout. on_delivered(sink_name) is
+    called for every sink which took it, once the writes it buffered are
+    flushed, even after its timeout.
+    """
+    fanout = app.config['fanout']
+    jobs = []
+    events = None
+    for sink_name, (sink_type, target, policy) in routes.sinks.items():
+        if only is not None and sink_name not in only:
+            continue
+        LOG.debug("pushing %s messages to %s", len(batch), sink_name)
+        payload = batch
+        if sink_type == "odoo":
+            if events is None:
+                # read once for all odoo sinks, the others take the messages as they are
+                events = messages_to_events(batch)
+                MESSAGES.inc("unreadable", amount=events.count(None))
+            payload = events
+        # a retry goes on after the messages the sink took, the rest of
+        # the batch is dead-lettered if it fails for good
+        progress = Progress()
+        future = fanout.submit(sink_name, deliver_to_sink, sink_type, target, payload, sink_name,
+                               progress, policy=policy, dead_letter=batch, progress=progress)
+        if on_delivered:
+            future.add_done_callback(functools.partial(_when_written, on_delivered, sink_name))
+        jobs.append((sink_name, future, policy.timeout))
+    return fanout.wait(jobs)
+
+
+def _when_written(on_delivered, sink_name, done):
+    """
+    calls on_delivered(sink_name) once a sink took a batch, after the
+    flush of the writes it buffered for it
+    """
+    if done.cancelled() or done.exception():
+        return
+    written = done.result()
+    if isinstance(written, Future):
+        written.add_done_callback(lambda _written: on_delivered(sink_name))
+    else:
+        on_delivered(sink_name)
+
+
+def deliver_batch(item):
+    """
+    pushes an accepted batch to the sinks, runs in the ingest workers.
+    commit(sink_name) moves the spool checkpoint of a sink past the batch.
+    on_done(delivered) tells a source if every sink took the batch.
+    """
+    batch, commit, only, on_done = item
+    if on_done is None:
+        _deliver_batch(batch, commit, only)
+        return
+    try:
+        delivered = _deliver_batch(batch, commit, only)
+    except Exception:
+        on_done(False)
+        raise
+    on_done(delivered)
+
+
+def _deliver_batch(batch, commit, only) -> bool:
+    aggregator = app.config.get('aggregator')
+    if aggregator:
+        # samples of aggregated meters leave as usage records per window,
+        # the spool keeps their batch until then, so replayed samples refill
+        # the windows lost with the last process
+        samples = [message for message in batch if is_sample(message)]
+        if samples:
+            hold = SpoolHold(commit) if commit else None
+            rest = aggregator.add_batch(samples, hold=hold)
+            batch = [message for message in batch if not is_sample(message)] + rest
+            if hold:
+                commit = hold.delivered
+    routes = app.config['router'].current()
+    delivered = push_to_sinks(routes, batch, only=only, on_delivered=commit)
+    return set(delivered) >= {name for name in routes.sinks if only is None or name in only}
+
+
+def sync_spool_sinks(routes):
+    """adds and removes spool checkpoints after the sinks changed"""
+    spool = app.config.get('spool')
+    if not spool:
+        return
+    for sink_name in routes.sinks:
+        spool.add_sink(sink_name)
+    for sink_name in list(spool.checkpoints):
+        if sink_name not in routes.sinks:
+            spool.remove_sink(sink_name)
+
+
+def _all_parts(parts, on_done):
+    """returns the on_done of every part, on_done is called once all parts are done"""
+    remaining = [parts]
+    results = []
+    lock = threading.Lock()
+
+    def part_done(delivered):
+        with lock:
+            results.append(delivered)
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+        on_done(all(results))
+
+    return part_done
+
+
+def _remember_on_delivery(dedup, batch, on_done):
+    """
+    returns the on_done of a batch which remembers its message ids once it
+    was delivered, a batch handed back to the broker comes again
+    """
+    def done(delivered):
+        if delivered:
+            dedup.remember(batch)
+        else:
+            dedup.release(batch)
+        on_done(delivered)
+
+    return done
+
+
+def _commit_parts(parts, commit):
+    """
+    returns the commit of every part of a spool record, the record is
+    committed for a sink once all its parts were delivered there
+    """
+    if parts == 1:
+        return commit
+    remaining = {}
+    lock = threading.Lock()
+
+    def part_commit(sink_name):
+        with lock:
+            remaining[sink_name] = remaining.get(sink_name, parts) - 1
+            if remaining[sink_name]:
+                return
+        commit(sink_name)
+
+    return part_commit
+
+
+class PreparedBatch(NamedTuple):
+    """a batch with room in the ingest queue and in the spool, not queued yet"""
+    batch: list
+    parts: list
+    records: list
+    on_done: object
+
+
+def accept_batch(batch, on_done=None) -> int:
+    """
+    makes an incoming batch durable if the spool is configured and queues
+    it for delivery, raises QueueFull if it can not be taken right now.
+    a batch is taken as a whole or not at all. returns the number of
+    messages taken, without duplicates. on_done(delivered) is called
+    once the batch is safe, in the spool or delivered to all sinks.
+    """
+    return submit_prepared(prepare_batch(batch, on_done))
+
+
+def prepare_batch(batch, on_done=None) -> PreparedBatch:
+    """
+    the first half of accept_batch: reserves room in the ingest queue and
+    appends the batch to the spool, raises QueueFull if there is no room.
+    the batch is then queued by submit_prepared or dropped by cancel_prepared.
+    """
+    ingest = app.config['ingest']
+    dedup = app.config.get('dedup')
+    if dedup:
+        # retried batches of the publisher end here, the ids are claimed
+        # against concurrent retries and remembered once the batch is taken
+        received = len(batch)
+        batch = dedup.claim(batch)
+        MESSAGES.inc("duplicate", amount=received - len(batch))
+        if not batch:
+            return PreparedBatch(batch, [], [], on_done)
+    spool = app.config.get('spool')
+    max_batch = app.config.get('max_batch', DEFAULT_MAX_BATCH)
+    # the messages of a project are delivered in order by one ingest
+    # worker, a large request in batches of up to max_batch
+    parts = [
+        (partition, part[start:start + max_batch])
+        for partition, part in split_batch(
+            batch, ingest.workers, app.config.get('partition_divisor', 1)).items()
+        for start in range(0, len(part), max_batch)
+    ]
+    partitions = [partition for partition, _part in parts]
+    try:
+        ingest.reserve(partitions)
+    except QueueFull:
+        if dedup:
+            dedup.release(batch)
+        raise
+    records = []
+    try:
+        for _partition, part in parts if spool else ():
+            records.append(spool.append(part))
+    except BaseException:
+        cancel_prepared(PreparedBatch(batch, parts, records, on_done))
+        raise
+    return PreparedBatch(batch, parts, records, on_done)
+
+
+def cancel_prepared(prepared):
+    """hands back the room of a prepared batch, its spool records count as delivered"""
+    if app.config.get('dedup'):
+        app.config['dedup'].release(prepared.batch)
+    if prepared.parts:
+        app.config['ingest'].release([partition for partition, _part in prepared.parts])
+    for record in prepared.records:
+        app.config['spool'].discard(record)
+
+
+def submit_prepared(prepared) -> int:
+    """queues a prepared batch for delivery, returns the number of its messages"""
+    batch, parts, records, on_done = prepared
+    if not batch:
+        if on_done:
+            on_done(True)
+        return 0
+    ingest = app.config['ingest']
+    dedup = app.config.get('dedup')
+    spool = app.config.get('spool')
+    part_done = None
+    if on_done and not spool:
+        part_done = _all_parts(
+            len(parts), _remember_on_delivery(dedup, batch, on_done) if dedup else on_done)
+    for number, (partition, part) in enumerate(parts):
+        commit = functools.partial(spool.commit, records[number]) if spool else None
+        # a batch in the spool is delivered at the latest by the replay after a restart
+        ingest.submit((part, commit, None, part_done), partition=partition, reserved=True)
+    if dedup and part_done is None:
+        dedup.remember(batch)
+    if on_done and spool:
+        on_done(True)
+    return len(batch)
+
+
+_PREPARED = {}
+_PREPARED_LOCK = threading.Lock()
+
+
+def worker_prepare(payload) -> int:
+    """
+    prepares the part of a batch the front hands to this worker process,
+    payload is (token, messages). returns the number of messages taken.
+    """
+    token, batch = payload
+    prepared = prepare_batch(batch)
+    with _PREPARED_LOCK:
+        _PREPARED[token] = prepared
+    return len(prepared.batch)
+
+
+def worker_commit(token):
+    """queues the part prepared under token once every worker prepared its part"""
+    with _PREPARED_LOCK:
+        prepared = _PREPARED.pop(token, None)
+    if prepared:
+        submit_prepared(prepared)
+
+
+def worker_cancel(token):
+    """drops the part prepared under token, another worker had no room"""
+    with _PREPARED_LOCK:
+        prepared = _PREPARED.pop(token, None)
+    if prepared:
+        cancel_prepared(prepared)
 
 
 @app.route("/post_json", methods=["POST"])
 def process_json():
-    """Endpoint for json requests"""
-    content_type = request.headers.get("Content-Type")
-    if not content_type == "application/json":
-        err_msg = f"Content-Type {content_type} not supported!"
-        return err_msg, 204
+    """
+    Endpoint for json and ndjson requests, optionally gzip or deflate encoded
+
+    the body is queued in batches of max_batch while it is read, in order.
+    an error answer says how many messages from the start of the body were
+    taken before it, the publisher retries the rest or the whole body,
+    which the dedup filter then takes without duplicates.
+    """
+    received = taken = accepted = 0
+    status = 202
+    accept = app.config.get('accept', accept_batch)
+    capture = app.config.get('capture')
+    if capture:
+        arrived = time.time()
+        request_number = capture.next_request()
+    try:
+        messages = iter_messages(
+            request.stream,
+            request.mimetype,
+            request.headers.get("Content-Encoding", "identity"),
+            max_body=app.config.get('max_body', 0),
+            max_message=app.config.get('max_message', 0),
+        )
+        for batch in iter_batches(messages, app.config.get('max_batch', DEFAULT_MAX_BATCH)):
+            received += len(batch)
+            if capture:
+                # rejected batches too, the publisher retries them as they came
+                capture.record(request_number, arrived, batch)
+            accepted += accept(batch)
+            taken += len(batch)
+    except UnsupportedFormat as exc:
+        status = 415
+        return {"error": str(exc)}, status
+    except ParseError as exc:
+        status = 413 if isinstance(exc, TooLarge) else 400
+        ERRORS.inc("api", type(exc).__name__)
+        LOG.warning("rejecting a request after %s messages: %s", taken, exc)
+        return {"error": str(exc), "received": taken, "accepted": accepted}, status
+    except QueueFull as exc:
+        status = 503
+        LOG.warning("rejecting a request after %s messages: %s", taken, exc)
+        return ({"error": str(exc), "received": taken, "accepted": accepted}, status,
+                {"Retry-After": str(exc.retry_after)})
+    except Exception as exc:
+        status = 500
+        ERRORS.inc("api", type(exc).__name__)
+        raise
+    finally:
+        HTTP_REQUESTS.inc("/post_json", str(status))
+        MESSAGES.inc("received", amount=received)
+        MESSAGES.inc("accepted", amount=accepted)
+    LOG.debug("received %s messages, accepted %s", received, accepted)
+    return {"received": received, "accepted": accepted}, status
+
+
+def local_stats(_payload=None) -> dict:
+    """returns the statistics of the pipeline in this process"""
+    stats_dict = {
+        "ingest": app.config['ingest'].stats(),
+        "sinks": app.config['fanout'].stats(),
+        "files": file_sink_stats(),
+        "odoo_pools": pool_stats(),
+        "odoo_writes": coalescer_stats(),
+        "odoo_caches": cache_stats(),
+        "odoo_lines": line_index_stats(),
+        "lifecycle": lifecycle_stats(),
+    }
+    if app.config.get('dedup'):
+        stats_dict["dedup"] = app.config['dedup'].stats()
+    if app.config.get('aggregator'):
+        stats_dict["aggregate"] = app.config['aggregator'].stats()
+    if app.config.get('spool'):
+        stats_dict["spool"] = app.config['spool'].stats()
+    if app.config.get('ledger'):
+        stats_dict["ledger"] = app.config['ledger'].stats()
+    if app.config.get('dead_letters'):
+        stats_dict["dead_letters"] = app.config['dead_letters'].stats()
+    if app.config.get('source'):
+        stats_dict["source"] = app.config['source'].stats()
+    return stats_dict
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """Endpoint for runtime statistics"""
+    front = app.config.get('front')
+    if front:
+        stats_dict = {"workers": front.broadcast("stats")}
+        if app.config.get('source'):
+            stats_dict["source"] = app.config['source'].stats()
+        return stats_dict, 200
+    return local_stats(), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Endpoint for prometheus"""
+    front = app.config.get('front')
+    if front:
+        families = merge({"front": collect(), **front.broadcast("metrics")})
+    else:
+        families = collect()
+    return Response(render(families), mimetype=None, content_type=CONTENT_TYPE)
+
+
+@app.route("/cache/invalidate", methods=["POST"])
+def invalidate_cache():
+    """Endpoint to drop the cached odoo lookups"""
+    front = app.config.get('front')
+    if front:
+        front.broadcast("invalidate")
+    else:
+        invalidate_caches()
+    return {"invalidated": True}, 200
 
-    json_data = request.json
-    LOG.debug("### the request ###############################################################")
-    LOG.debug("json_body: %s", pformat(json_data))
-    data = json.loads(request.data)
-    for message in data:
-        push_to_sinks(app.config['conf'], message)
-    return json_data, 202
+
+def local_ledger(payload) -> list:
+    """returns the usage of a billing period in the ledger of this process"""
+    ledger = app.config.get('ledger')
+    return ledger.period_totals(**payload) if ledger else []
+
+
+@app.route("/ledger", methods=["GET"])
+def ledger_usage():
+    """
+    Endpoint for the usage per resource of a ?period=YYYY-MM, the current
+    month by default, optionally of one ?project_id=
+    """
+    payload = {
+        "period": request.args.get("period") or period_of(datetime.now()),
+        "project_id": request.args.get("project_id"),
+    }
+    front = app.config.get('front')
+    if front:
+        usage = [row for rows in front.broadcast("ledger", payload).values() for row in rows]
+    elif app.config.get('ledger'):
+        usage = local_ledger(payload)
+    else:
+        return {"error": "the ledger is off"}, 404
+    return {**payload, "usage": usage}, 200
+
+
+def local_traces(payload) -> list:
+    """returns the latest traces of this process"""
+    return recent_traces(**payload)
+
+
+@app.route("/traces", methods=["GET"])
+def traces():
+    """Endpoint for the span timings of the latest messages, newest first"""
+    payload = {
+        "limit": request.args.get("limit", 100, type=int),
+        "correlation_id": request.args.get("correlation_id"),
+    }
+    front = app.config.get('front')
+    if front:
+        return {"workers": front.broadcast("traces", payload)}, 200
+    return {"enabled": TRACE_SETTINGS["enabled"], "traces": local_traces(payload)}, 200
+
+
+@app.route("/admin/tracing", methods=["POST"])
+def switch_tracing():
+    """Endpoint to switch the span timing on or off, e.g. {"enabled": true}"""
+    enabled = bool((request.get_json(silent=True) or {}).get("enabled", True))
+    front = app.config.get('front')
+    if front:
+        front.broadcast("tracing", enabled)
+    else:
+        set_tracing(enabled)
+    return {"enabled": enabled}, 200
+
+
+@app.route("/admin/capture", methods=["POST"])
+def switch_capture():
+    """
+    Endpoint to start or stop recording the posted batches, e.g.
+    {"enabled": true}, to the path of the [capture] section
+    """
+    enabled = bool((request.get_json(silent=True) or {}).get("enabled", True))
+    set_capture(enabled)
+    return {"enabled": enabled}, 200
+
+
+def set_capture(enabled):
+    """
+    opens or closes the capture file of the posted batches, a request which
+    still records to the old capture is waited for
+    """
+    with _CAPTURE_LOCK:
+        capture = app.config.pop('capture', None)
+        if capture:
+            capture.close()
+        if enabled:
+            settings = dict(app.config.get('capture_settings') or {})
+            settings.pop("enabled", None)
+            app.config['capture'] = TrafficCapture(**settings)
+            LOG.info("capturing the posted batches to %s", app.config['capture'].path)
+
+
+def start_profile(payload) -> bool:
+    """starts the sampling profiler of this process"""
+    label = f"-worker-{app.config['worker']}" if app.config.get('worker') is not None else ""
+    return PROFILER.start(payload["seconds"], payload["interval"], label=label)
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def profile():
+    """
+    Endpoint to sample the stacks of all threads for ?seconds=N, every
+    process writes them to a file of the profile_dir. GET returns the
+    state and the top frames of the last profile.
+    """
+    front = app.config.get('front')
+    if request.method == "GET":
+        if front:
+            return {"workers": front.broadcast("profile_status")}, 200
+        return PROFILER.status(), 200
+    payload = {
+        "seconds": request.args.get("seconds", 30.0, type=float),
+        "interval": request.args.get("interval", 0.005, type=float),
+    }
+    if payload["seconds"] <= 0 or payload["interval"] <= 0:
+        return {"error": "seconds and interval must be positive"}, 400
+    if front:
+        started = all(front.broadcast("profile", payload).values())
+    else:
+        started = start_profile(payload)
+    if not started:
+        return {"error": "a profile is already running"}, 409
+    return {"profiling": True, **payload}, 202
+
+
+def start_pipeline(config_file, verbose=False, worker=None, processes=1, job=False):
+    """
+    sets up the routing, the sinks and the ingest queue of this process
+    and returns the function which drains and stops them. a job like the
+    redrive uses the sinks but not the spool and the message bus of the
+    running service.
+    """
+    router = Router(config_file)
+    router.install_signal_handler()
+    config = router.conf
+    app.config['router'] = router
+    # a worker process only sees its own projects, the ingest workers
+    # use the rest of the project hash
+    app.config['partition_divisor'] = processes
+    app.config['worker'] = worker
+    configure_tracing(config)
+    configure_pools(config)
+    configure_sessions(config)
+    configure_coalescing(config)
+    configure_caches(config)
+    configure_file_sinks(config, worker=worker)
+    warm_odoo_sessions(router.routes.odoo)
+    warm_line_indexes(router.routes.odoo)
+    reconciler = None
+    spool_settings = None if job else get_spool_settings(config, worker=worker)
+    ledger_settings = get_ledger_settings(config, worker=worker)
+    if ledger_settings and job:
+        # into the ledgers of the service, its reconcilers write them to odoo
+        ledger = open_job_ledger(config, get_server_settings(config)["processes"])
+        app.config['ledger'] = ledger
+        set_ledger(ledger)
+    elif ledger_settings:
+        # the spool commits a batch once it is in the ledger, a crash must
+        # not lose it from there
+        ledger = UsageLedger(ledger_settings["path"],
+                             synchronous="FULL" if spool_settings else "NORMAL")
+        app.config['ledger'] = ledger
+        set_ledger(ledger)
+        reconciler = LedgerReconciler(
+            ledger,
+            lambda ledger: reconcile_ledger(ledger, router.current().odoo,
+                                            limit=ledger_settings["batch"]),
+            interval=ledger_settings["interval"],
+            keep_events=ledger_settings["keep_events"],
+        )
+        reconciler.start()
+    ingest_settings = get_ingest_settings(config)
+    dead_letter_settings = get_dead_letter_settings(config, worker=worker)
+    if dead_letter_settings:
+        app.config['dead_letters'] = DeadLetterStore(**dead_letter_settings)
+    set_dead_letters(app.config.get('dead_letters'))
+    app.config['fanout'] = FanOut(sink_threads=ingest_settings.pop("sink_threads"),
+                                  backlog=ingest_settings.pop("sink_backlog"),
+                                  dead_letters=app.config.get('dead_letters'))
+    app.config['max_batch'] = ingest_settings.pop("max_batch")
+    ingest = IngestQueue(deliver_batch, **ingest_settings)
+    app.config['ingest'] = ingest
+    ingest.start()
+    rollup_timer = None
+    aggregate_settings = get_aggregate_settings(config)
+    if aggregate_settings:
+        aggregator = Aggregator(**aggregate_settings)
+        app.config['aggregator'] = aggregator
+        rollup_timer = RollupTimer(
+            aggregator,
+            lambda records, on_delivered: push_to_sinks(router.current(), records,
+                                                        on_delivered=on_delivered),
+            interval=min(60, aggregator.window),
+        )
+        rollup_timer.start()
+    dedup_settings = get_dedup_settings(config)
+    if dedup_settings:
+        app.config['dedup'] = Deduplicator(**dedup_settings)
+    if spool_settings:
+        spool = Spool(sinks=router.routes.sinks, **spool_settings)
+        app.config['spool'] = spool
+        router.add_listener(sync_spool_sinks)
+        replayed = 0
+        for record, sinks in spool.replay():
+            if 'dedup' in app.config:
+                # a retry of a spooled batch is a duplicate after the restart too
+                app.config['dedup'].filter(record.batch)
+            # by project like accept_batch, the workers may have changed since
+            parts = split_batch(record.batch, ingest.workers, processes)
+            commit = _commit_parts(len(parts), functools.partial(spool.commit, record))
+            for partition, part in parts.items():
+                ingest.submit((part, commit, sinks, None), wait=True, partition=partition)
+            replayed += 1
+        LOG.info("replaying %s spooled batches", replayed)
+    source = None
+    amqp_settings = get_amqp_settings(config)
+    if amqp_settings and worker is None and not job:
+        # in the multi-process mode the front consumes for all workers
+        source = AmqpSource(**amqp_settings)
+        app.config['source'] = source
+        source.start(accept_batch)
+
+    # the stats of the components are scraped as gauges
+    register_collector(lambda: stats_to_families(local_stats()))
+
+    if verbose or config.get("DEFAULT", "log_level") == "DEBUG":
+        LOG.setLevel(logging.DEBUG)
+        logging.getLogger("metersink.lib").setLevel(logging.DEBUG)
+
+    def stop_pipeline():
+        if source:
+            source.stop(timeout=30)
+        ingest.stop(timeout=30)
+        if rollup_timer:
+            rollup_timer.stop()
+            # whatever is over by now, the spool keeps the open windows
+            rollup_timer.run_once()
+        app.config['fanout'].shutdown()
+        if reconciler:
+            # what was recorded by now goes to odoo before the exit
+            reconciler.stop()
+        if 'ledger' in app.config:
+            set_ledger(None)
+            app.config.pop('ledger').close()
+        stop_coalescers()
+        close_file_sinks()
+
+    return stop_pipeline
+
+
+def front_accept(batch, on_done=None) -> int:
+    """
+    hands a batch of a source to the worker processes, it is safe once
+    they took it into their spool, which main makes sure they have
+    """
+    accepted = app.config['front'].accept(batch)
+    if on_done:
+        on_done(True)
+    return accepted
+
+
+def redrive(sink_name=None) -> dict:
+    """
+    puts the dead letters of one sink or of all through the sink they
+    failed at again, spread by project over the ingest workers. letters
+    which fail again are dead-lettered anew.
+    """
+    dead_letters = app.config['dead_letters']
+    ingest = app.config['ingest']
+    routes = app.config['router'].current()
+    report = {"files": 0, "batches": 0, "messages": 0, "skipped": 0}
+    for sink, path in dead_letters.pending(sink_name):
+        if sink not in routes.sinks:
+            LOG.warning("keeping the dead letters of %s, it is not configured", sink)
+            report["skipped"] += 1
+            continue
+        taken = dead_letters.take(path)
+        for letter in iter_letters(taken):
+            for partition, part in split_batch(letter["messages"], ingest.workers).items():
+                ingest.submit((part, None, {sink}, None), wait=True, partition=partition)
+            report["batches"] += 1
+            report["messages"] += len(letter["messages"])
+        # the letters are delivered or in a new file by now
+        ingest.join()
+        os.remove(taken)
+        report["files"] += 1
+    report["failed"] = sum(stats["messages"] for stats in dead_letters.stats().values())
+    return report
+
+
+def run_redrive(args):
+    """the redrive command"""
+    stop_pipeline = start_pipeline(args.config_file, args.verbose, job=True)
+    start = time.monotonic()
+    try:
+        if not app.config.get('dead_letters'):
+            print("there is no [dead_letter] path in the config")
+            return 1
+        report = redrive(args.sink)
+    finally:
+        stop_pipeline()
+    print(f"redrove {report['messages']} messages in {report['batches']} batches "
+          f"of {report['files']} files in {time.monotonic() - start:.1f}s")
+    print(f"{report['failed']} messages failed again, "
+          f"{report['skipped']} files of unknown sinks were kept")
+    return 1 if report["failed"] else 0
+
+
+def run_backfill(args):
+    """the backfill command"""
+    stop_pipeline = start_pipeline(args.config_file, args.verbose, job=True)
+    try:
+        routes = app.config['router'].current()
+        # the input comes from the file sinks, by default it only goes to odoo
+        sinks = set(args.sinks or [name for name in routes.sinks if not name.startswith("file:")])
+        unknown = sinks - set(routes.sinks)
+        if unknown or not sinks:
+            print(f"no such sinks: {', '.join(sorted(unknown))}" if unknown
+                  else "there is no sink to backfill")
+            return 1
+        # every worker has a delivery slot of each sink, the pools start on first use
+        app.config['fanout'].sink_threads = max(app.config['fanout'].sink_threads, args.workers)
+        report = backfill(args.paths, deliver_batch, sinks, workers=args.workers,
+                          batch_size=args.batch, checkpoint_path=args.checkpoint)
+    finally:
+        stop_pipeline()
+    seconds = report["seconds"] or 1e-9
+    print(f"backfilled {report['messages']} messages of {report['files']} files "
+          f"to {', '.join(sorted(sinks))} in {seconds:.1f}s, "
+          f"{report['messages'] / seconds:,.0f} msg/s")
+    print(f"{report['skipped']} files were done before, {report['invalid']} lines were "
+          f"no json, {report['failed']} batches failed and are retried by a resume")
+    return 1 if report["failed"] else 0
+
+
+def run_worker(conn, number, processes, config_file, verbose):
+    """the main function of a worker process in the multi-process mode"""
+    # the front decides when to stop, ctrl-c or a service manager reach
+    # the whole process group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    stop_pipeline = start_pipeline(config_file, verbose, worker=number, processes=processes)
+    call_id = None
+    try:
+        call_id = worker_loop(conn, {
+            "ping": lambda _payload: number,
+            "batch": accept_batch,
+            "prepare": worker_prepare,
+            "commit": worker_commit,
+            "cancel": worker_cancel,
+            "stats": local_stats,
+            "metrics": lambda _payload: collect(),
+            "invalidate": lambda _payload: invalidate_caches(),
+            "traces": local_traces,
+            "ledger": local_ledger,
+            "tracing": set_tracing,
+            "profile": start_profile,
+            "profile_status": lambda _payload: PROFILER.status(),
+        })
+    finally:
+        stop_pipeline()
+        if call_id is not None:
+            conn.send((call_id, "ok", None))
 
 
 def main():
     """the main function"""
     parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    replay_parser = commands.add_parser(
+        "replay", help="post captured traffic to a running metersink again")
+    replay_parser.add_argument("paths", nargs="+", metavar="CAPTURE_FILE",
+                               help="capture files, also compressed segments, oldest first")
+    replay_parser.add_argument("--url", default=DEFAULT_URL, help="The /post_json url")
+    replay_parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="Replay faster by this factor, 0 replays as fast as possible",
+    )
+    replay_parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                               help="The number of parallel requests")
+    redrive_parser = commands.add_parser(
+        "redrive", help="deliver the dead letters to the sinks they failed at again")
+    redrive_parser.add_argument(
+        "--sink",
+        help="Only the dead letters of this sink, e.g. odoo:https://odoo.example/db",
+    )
+    backfill_parser = commands.add_parser(
+        "backfill", help="deliver archived file sink output to the sinks again")
+    backfill_parser.add_argument("paths", nargs="+", metavar="FILE",
+                                 help="file sink output, also compressed segments, oldest first")
+    backfill_parser.add_argument(
+        "--sink",
+        dest="sinks",
+        action="append",
+        help="A sink to deliver to, can be repeated, by default every odoo sink",
+    )
+    backfill_parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS,
+                                 help="The number of parallel deliveries")
+    backfill_parser.add_argument("--batch", type=int, default=DEFAULT_BATCH_SIZE,
+                                 help="The messages read per batch")
+    backfill_parser.add_argument(
+        "--checkpoint",
+        default=DEFAULT_CHECKPOINT,
+        help="The file of the progress, a second run resumes from it",
+    )
     parser.add_argument(
         "--config",
         "-c",
@@ -67,19 +946,74 @@ def main():
         action="store_true",
         help="increase output verbosity",
     )
+    parser.add_argument("--host", help="The address to listen on")
+    parser.add_argument("--port", type=int, help="The port to listen on")
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="The number of worker processes, the projects are shared out between them",
+    )
     args = parser.parse_args()
 
-    config = get_config(args.config_file)
-    app.config['conf'] = config
-
-    if args.verbose or config.get("DEFAULT", "log_level") == "DEBUG":
-        LOG.setLevel(logging.DEBUG)
-        logging.getLogger("metersink.lib").setLevel(logging.DEBUG)
+    if args.command == "replay":
+        logging.basicConfig(level=logging.INFO)
+        sys.exit(run_replay(args))
+    if args.command == "redrive":
+        logging.basicConfig(level=logging.INFO)
+        sys.exit(run_redrive(args))
+    if args.command == "backfill":
+        logging.basicConfig(level=logging.INFO)
+        sys.exit(run_backfill(args))
 
+    config = get_config(args.config_file)
+    server_settings = get_server_settings(config)
+    for key in ("host", "port", "processes"):
+        if getattr(args, key) is not None:
+            server_settings[key] = getattr(args, key)
 
     logging.info("starting the billing api server")
+    # the process which serves the requests parses the bodies
+    app.config['max_body'] = server_settings["max_body"]
+    app.config['max_message'] = server_settings["max_message"]
+    # the front records the traffic of all worker processes
+    app.config['capture_settings'] = get_capture_settings(config)
+    if app.config['capture_settings']["enabled"]:
+        set_capture(True)
 
-    app.run(
-        port=8088,
-        debug=True,
-    )
+    if server_settings["processes"] > 1:
+        amqp_settings = get_amqp_settings(config)
+        if amqp_settings and not get_spool_settings(config):
+            # the front can only acknowledge what the workers made durable
+            raise ValueError("[amqp] with more than one process needs a [spool] path")
+        front = Front(
+            run_worker,
+            server_settings["processes"],
+            args=(server_settings["processes"], args.config_file, args.verbose),
+        )
+        front.start()
+        app.config['front'] = front
+        app.config['accept'] = front.accept
+        app.config['max_batch'] = get_ingest_settings(config)["max_batch"]
+        if hasattr(signal, "SIGHUP"):
+            # the workers reload their routing table
+            signal.signal(signal.SIGHUP, front.signal)
+        source = None
+        if amqp_settings:
+            source = AmqpSource(**amqp_settings)
+            app.config['source'] = source
+            source.start(front_accept)
+        try:
+            serve(app, server_settings["host"], server_settings["port"])
+        finally:
+            if source:
+                source.stop(timeout=server_settings["shutdown_timeout"])
+            front.stop(timeout=server_settings["shutdown_timeout"])
+            set_capture(False)
+        return
+
+    stop_pipeline = start_pipeline(args.config_file, args.verbose)
+    try:
+        serve(app, server_settings["host"], server_settings["port"])
+    finally:
+        stop_pipeline()
+        set_capture(False)
@@ -0,0 +1,203 @@
+"""
+delivers the archived output of a file sink to the sinks again, in
+parallel by project and resumable from a checkpoint file
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from metersink.ingest import IngestQueue, split_batch
+from metersink.output_textfile import open_segment
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT = "backfill.checkpoint"
+DEFAULT_WORKERS = 8
+DEFAULT_BATCH_SIZE = 500
+CHECKPOINT_INTERVAL = 5.0
+PROGRESS_INTERVAL = 10.0
+
+
+class Checkpoints:
+    """
+    the number of leading lines of every input file which went through
+    all sinks and the (first, end) line ranges after them which did too,
+    stored as json in path
+    """
+
+    def __init__(self, path=DEFAULT_CHECKPOINT):
+        self.path = path
+        self.files = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as stored:
+                self.files = json.load(stored)
+        self._lock = threading.Lock()
+        self._stored = time.monotonic()
+
+    def lines(self, path) -> int:
+        """returns the number of lines of a file which are delivered"""
+        return self.files.get(path, {}).get("lines", 0)
+
+    def delivered(self, path) -> list:
+        """returns the (first, end) ranges of lines after lines() which are delivered"""
+        return [tuple(span) for span in self.files.get(path, {}).get("delivered", [])]
+
+    def complete(self, path) -> bool:
+        """tells if a file was delivered to its end"""
+        return self.files.get(path, {}).get("complete", False)
+
+    def advance(self, path, lines, delivered=(), complete=False):
+        """moves the checkpoint of a file, stored every few seconds"""
+        with self._lock:
+            self.files[path] = {"lines": lines, "delivered": [list(span) for span in delivered],
+                                "complete": complete}
+            due = complete or time.monotonic() - self._stored >= CHECKPOINT_INTERVAL
+        if due:
+            self.store()
+
+    def store(self):
+        """writes the checkpoints"""
+        with self._lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as stored:
+                json.dump(self.files, stored)
+            os.replace(tmp_path, self.path)
+            self._stored = time.monotonic()
+
+
+class _Watermark:
+    """
+    the end of the lines of a file up to which every chunk was delivered,
+    and the chunks after it which were delivered as well
+    """
+
+    def __init__(self, lines, delivered=()):
+        self.lines = lines
+        self._done = {first: (end, True) for first, end in delivered}
+        self._lock = threading.Lock()
+        self._advance()
+
+    def _advance(self):
+        while self.lines in self._done and self._done[self.lines][1]:
+            self.lines = self._done.pop(self.lines)[0]
+
+    def done(self, first, end, delivered) -> tuple:
+        """
+        marks the chunk of lines first to end, returns the watermark and
+        the ranges of the delivered chunks after it
+        """
+        with self._lock:
+            self._done[first] = (end, delivered)
+            # a failed chunk holds the watermark, a resume tries it again
+            # and skips the delivered chunks after it
+            self._advance()
+            ranges = []
+            for chunk_first in sorted(self._done):
+                chunk_end, chunk_delivered = self._done[chunk_first]
+                if not chunk_delivered:
+                    continue
+                if ranges and ranges[-1][1] == chunk_first:
+                    ranges[-1] = (ranges[-1][0], chunk_end)
+                else:
+                    ranges.append((chunk_first, chunk_end))
+            return self.lines, ranges
+
+
+def backfill(paths, deliver, sinks, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE,
+             checkpoint_path=DEFAULT_CHECKPOINT) -> dict:
+    """
+    streams the json lines of file sink output, also compressed rotated
+    segments oldest first, in chunks of batch_size messages. a chunk is
+    split by project over workers, the messages of a project stay in
+    order. deliver((messages, None, sinks, on_done)) is the delivery of
+    the ingest pipeline. returns the counters of the backfill.
+    """
+    checkpoints = Checkpoints(checkpoint_path)
+    queue = IngestQueue(deliver, queue_size=workers * 4, workers=workers, name="backfill")
+    report = {"files": 0, "skipped": 0, "messages": 0, "invalid": 0, "failed": 0}
+    lock = threading.Lock()
+    started = time.monotonic()
+    progress = started + PROGRESS_INTERVAL
+
+    def submit(path, watermark, first, end, chunk):
+        parts = split_batch(chunk, workers)
+        remaining = [len(parts)]
+        results = []
+
+        def part_done(delivered):
+            with lock:
+                results.append(delivered)
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+                if not all(results):
+                    report["failed"] += 1
+            checkpoints.advance(path, *watermark.done(first, end, all(results)))
+
+        if not parts:
+            # blank or broken lines only
+            checkpoints.advance(path, *watermark.done(first, end, True))
+            return
+        for partition, part in parts.items():
+            queue.submit((part, None, sinks, part_done), wait=True, partition=partition)
+
+    queue.start()
+    try:
+        for number, path in enumerate(paths, 1):
+            if checkpoints.complete(path):
+                LOG.info("skipping %s, it was backfilled before", path)
+                report["skipped"] += 1
+                continue
+            resume = checkpoints.lines(path)
+            # the chunks delivered after a failed one, they are not sent again
+            skips = checkpoints.delivered(path)
+            if resume:
+                LOG.info("resuming %s after line %s, skipping %s delivered ranges after it",
+                         path, resume, len(skips))
+            watermark = _Watermark(resume, skips)
+            skips.reverse()
+            chunk = []
+            first = end = resume
+            with open_segment(path) as lines:
+                for end, line in enumerate(lines, 1):
+                    while skips and end > skips[-1][1]:
+                        skips.pop()
+                    if skips and end > skips[-1][0]:
+                        # a chunk ends where a delivered range starts
+                        skip_first, skip_end = skips[-1]
+                        if first < skip_first:
+                            submit(path, watermark, first, skip_first, chunk)
+                            report["messages"] += len(chunk)
+                            chunk = []
+                        first = skip_end
+                        continue
+                    if end <= resume or not line.strip():
+                        continue
+                    try:
+                        chunk.append(json.loads(line))
+                    except ValueError:
+                        report["invalid"] += 1
+                        continue
+                    if len(chunk) >= batch_size:
+                        submit(path, watermark, first, end, chunk)
+                        report["messages"] += len(chunk)
+                        chunk, first = [], end
+                    now = time.monotonic()
+                    if now >= progress:
+                        progress = now + PROGRESS_INTERVAL
+                        LOG.info("queued %s messages in %.0fs, %.0f msg/s, file %s of %s",
+                                 report["messages"], now - started,
+                                 report["messages"] / (now - started), number, len(paths))
+            submit(path, watermark, first, max(end, resume), chunk)
+            report["messages"] += len(chunk)
+            queue.join()
+            report["files"] += 1
+            if watermark.lines == max(end, resume):
+                checkpoints.advance(path, watermark.lines, complete=True)
+    finally:
+        queue.stop()
+        checkpoints.store()
+    report["seconds"] = time.monotonic() - started
+    return report
@@ -0,0 +1,89 @@
+"""
+a bounded, thread-safe lru cache with time-to-live
+"""
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_CACHE_SIZE = 4096
+DEFAULT_CACHE_TTL = 600.0
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    least recently used cache whose entries expire ttl seconds after they
+    were stored
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, name="cache"):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    def get(self, key, default=None):
+        """returns the value of key or default if it is missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self._stats["misses"] += 1
+                return default
+            value, expires = entry
+            if expires <= now:
+                del self._data[key]
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return default
+            self._data.move_to_end(key)
+            self._stats["hits"] += 1
+            return value
+
+    def put(self, key, value):
+        """stores a value, evicts the least recently used entry if full"""
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, key=None, prefix=None):
+        """
+        drops one key, all tuple keys starting with prefix or, without
+        arguments, everything
+        """
+        with self._lock:
+            if key is not None:
+                self._data.pop(key, None)
+            elif prefix is not None:
+                for cached_key in [k for k in self._data if k[:len(prefix)] == prefix]:
+                    del self._data[cached_key]
+            else:
+                self._data.clear()
+
+    def configure(self, maxsize, ttl):
+        """changes the size and ttl, shrinks the cache if needed"""
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        """returns the hit and miss counters and the size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._data)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def __len__(self):
+        return len(self._data)
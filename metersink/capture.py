@@ -0,0 +1,71 @@
+"""
+records the posted batches with their arrival time for a later replay
+"""
+import itertools
+import logging
+import threading
+
+from metersink.output_textfile import JsonLinesWriter
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CAPTURE_PATH = "captured_traffic.jsonl"
+
+
+class TrafficCapture:
+    """
+    writes every batch read from a request as one json line of
+    {"time": arrival, "request": number, "messages": batch}, the batches
+    of one request have the same arrival time and number
+    """
+
+    def __init__(self, path=DEFAULT_CAPTURE_PATH, rotate_size=0, rotate_interval=0.0,
+                 compression="gzip"):
+        self.path = path
+        self._writer = JsonLinesWriter(
+            path,
+            rotate_size=rotate_size,
+            rotate_interval=rotate_interval,
+            compression=compression,
+        )
+        self._requests = itertools.count()
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def next_request(self) -> int:
+        """returns the number of the next request"""
+        with self._lock:
+            return next(self._requests)
+
+    def record(self, request, arrived, batch):
+        """
+        buffers a batch of a request which arrived at the epoch time arrived,
+        a request still running when the capture was closed is not recorded
+        """
+        with self._lock:
+            if self._closed:
+                LOG.debug("capture %s is closed, request %s is not recorded", self.path, request)
+                return
+            self._writer.write({"time": arrived, "request": request, "messages": batch})
+
+    def close(self):
+        """waits for the batches being recorded, writes what is buffered and closes the file"""
+        with self._lock:
+            self._closed = True
+            self._writer.close()
+
+    def stats(self) -> dict:
+        """returns the write counters of the capture file"""
+        return self._writer.stats()
+
+
+def get_capture_settings(conf) -> dict:
+    """reads the [capture] section of the config"""
+    section = "capture"
+    return {
+        "enabled": conf.getboolean(section, "enabled", fallback=False),
+        "path": conf.get(section, "path", fallback=DEFAULT_CAPTURE_PATH),
+        "rotate_size": conf.getint(section, "rotate_size", fallback=0),
+        "rotate_interval": conf.getfloat(section, "rotate_interval", fallback=0.0),
+        "compression": conf.get(section, "compression", fallback="gzip"),
+    }
@@ -0,0 +1,284 @@
+"""
+coalesced, batched writes of sale order lines
+"""
+import logging
+import threading
+import xmlrpc.client
+from concurrent.futures import Future
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_INTERVAL = 0.0
+# a create needs these values, odoo rejects a line without them
+REQUIRED_VALUES = ("order_id", "product_id")
+# errors of the connection, a retry with the next flush may go through
+TRANSIENT_ERRORS = (OSError, xmlrpc.client.ProtocolError)
+
+
+class WriteCoalescer:
+    """
+    collects the line writes of one odoo sink over a flush window
+
+    only the latest values of a line are kept. on flush all buffered new
+    lines are created with one multi-record create and the updates are
+    sent as one write per distinct set of values. a create or write odoo
+    rejects is handed to on_failed(lines, error) with the values of the
+    lines, the key of a create under "key" and the line id of a write under
+    "id", and not tried again.
+    """
+
+    def __init__(self, odoo, create, write, model="sale.order.line",
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, on_created=None, on_failed=None):
+        self.odoo = odoo
+        self.model = model
+        self.flush_interval = flush_interval
+        self.on_created = on_created
+        self.on_failed = on_failed
+        self._create = create
+        self._write = write
+        self._creates = {}
+        self._inflight = {}
+        self._followups = {}
+        self._updates = {}
+        # the futures of written(), done with the next flush of everything
+        self._waiters = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {
+            "updates": 0,
+            "creates": 0,
+            "coalesced": 0,
+            "write_calls": 0,
+            "create_calls": 0,
+            "failed": 0,
+        }
+
+    def start(self):
+        """starts the periodic flush"""
+        self._thread = threading.Thread(
+            target=self._run, name=f"coalescer-{self.odoo['url']}", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("failed to flush the line writes to %s", self.odoo["url"])
+
+    def stop(self):
+        """stops the periodic flush and writes what is left"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def update(self, record_id, values):
+        """buffers an update of an existing line, later values win"""
+        with self._lock:
+            self._stats["updates"] += 1
+            if record_id in self._updates:
+                self._stats["coalesced"] += 1
+                self._updates[record_id].update(values)
+            else:
+                self._updates[record_id] = dict(values)
+
+    def create(self, key, values):
+        """
+        buffers a new line under a key (the resource uuid), a create for a
+        key which is still buffered only updates its values. a new line
+        without the REQUIRED_VALUES is failed right away.
+        """
+        missing = [name for name in REQUIRED_VALUES if not values.get(name)]
+        rejected = False
+        with self._lock:
+            self._stats["creates"] += 1
+            if key in self._inflight:
+                # the create is on its way, write these values once it has an id
+                self._stats["coalesced"] += 1
+                self._followups.setdefault(key, {}).update(values)
+            elif key in self._creates:
+                self._stats["coalesced"] += 1
+                self._creates[key].update(values)
+            elif not missing:
+                self._creates[key] = dict(values)
+            else:
+                rejected = True
+        if rejected:
+            self._fail([{**values, "key": key}], ValueError(f"a {self.model} needs {', '.join(missing)}"))
+
+    def update_pending(self, key, values) -> bool:
+        """
+        updates the values of a line which is buffered or on its way to be
+        created, returns False if there is none, then the line index has
+        the id of a line created before
+        """
+        with self._lock:
+            if key in self._inflight:
+                self._stats["coalesced"] += 1
+                self._followups.setdefault(key, {}).update(values)
+            elif key in self._creates:
+                self._stats["coalesced"] += 1
+                self._creates[key].update(values)
+            else:
+                return False
+            self._stats["creates"] += 1
+            return True
+
+    def written(self) -> Future:
+        """
+        returns a future which is done once the writes buffered by now are
+        in odoo, after the next flush which wrote everything it took
+        """
+        future = Future()
+        with self._lock:
+            self._waiters.append(future)
+        return future
+
+    def flush(self) -> dict:
+        """writes the buffered lines, returns the ids of the created ones by key"""
+        with self._flush_lock:
+            with self._lock:
+                creates, self._creates = self._creates, {}
+                self._inflight = creates
+                waiters, self._waiters = self._waiters, []
+            try:
+                created = self._flush(creates)
+            except BaseException:
+                with self._lock:
+                    # they wait for the next flush
+                    self._waiters[:0] = waiters
+                raise
+            for waiter in waiters:
+                waiter.set_result(True)
+            return created
+
+    def _flush(self, creates) -> dict:
+        created = {}
+        # the in-flight keys stay as they are until the ids are indexed
+        pending = dict(creates)
+        failed = []
+        error = None
+        try:
+            if pending:
+                self._flush_creates(pending, created)
+        except TRANSIENT_ERRORS as exc:
+            # the updates are written anyway
+            error = exc
+        finally:
+            with self._lock:
+                followups, self._followups = self._followups, {}
+                for key, values in followups.items():
+                    if key in created:
+                        self._updates.setdefault(created[key], {}).update(values)
+                    elif key in pending:
+                        pending[key].update(values)
+                    else:
+                        # its create was failed
+                        failed.append({**values, "key": key})
+                # the create did not get through, try again with the next flush
+                self._put_back(pending, {})
+                if created and self.on_created:
+                    # the ids are known before the keys stop being in flight
+                    self.on_created(created)
+                self._inflight = {}
+        if failed:
+            self._fail(failed, ValueError("the create of the line failed"))
+        with self._lock:
+            updates, self._updates = self._updates, {}
+        try:
+            if updates:
+                self._flush_updates(updates)
+                updates = {}
+        finally:
+            if updates:
+                self._requeue({}, updates)
+        if error is not None:
+            raise error
+        return created
+
+    def _flush_creates(self, creates, created):
+        """
+        creates the lines and moves their keys from creates to created, the
+        lines odoo rejected are failed, creates keeps what is left to retry
+        """
+        keys = list(creates)
+        try:
+            # a list of values as the only argument makes odoo create them all at once
+            new_ids = self._create(self.odoo, self.model, [[creates[key] for key in keys]])
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.warning("odoo rejected %s new %s records at once, creating them one by one: %s",
+                        len(keys), self.model, exc)
+        else:
+            if not isinstance(new_ids, list):
+                new_ids = [new_ids]
+            with self._lock:
+                self._stats["create_calls"] += 1
+            LOG.debug("created %s %s records in one call", len(keys), self.model)
+            created.update(zip(keys, new_ids))
+            creates.clear()
+            return
+        for key in keys:
+            try:
+                created[key] = self._create(self.odoo, self.model, [creates[key]])
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                self._fail([{**creates[key], "key": key}], exc)
+            finally:
+                with self._lock:
+                    self._stats["create_calls"] += 1
+            del creates[key]
+
+    def _flush_updates(self, updates):
+        groups = {}
+        for record_id, values in updates.items():
+            group_key = tuple(sorted(values.items()))
+            groups.setdefault(group_key, []).append(record_id)
+        for group_key, record_ids in groups.items():
+            try:
+                self._write(self.odoo, self.model, record_ids, dict(group_key))
+            except TRANSIENT_ERRORS:
+                raise
+            except Exception as exc:  # pylint: disable=broad-except
+                self._fail([{"id": record_id, **dict(group_key)} for record_id in record_ids],
+                           exc)
+            with self._lock:
+                self._stats["write_calls"] += 1
+            for record_id in record_ids:
+                updates.pop(record_id)
+        LOG.debug("updated %s %s records in %s calls",
+                  sum(len(ids) for ids in groups.values()), self.model, len(groups))
+
+    def _fail(self, lines, error):
+        """gives up on lines odoo does not take, they would fail every flush"""
+        with self._lock:
+            self._stats["failed"] += len(lines)
+        if self.on_failed:
+            self.on_failed(lines, error)
+        else:
+            LOG.error("dropped %s %s records: %s", len(lines), self.model, error)
+
+    def _requeue(self, creates, updates):
+        """puts back what failed to flush unless newer values arrived meanwhile"""
+        with self._lock:
+            self._put_back(creates, updates)
+
+    def _put_back(self, creates, updates):
+        for key, values in creates.items():
+            self._creates[key] = {**values, **self._creates.get(key, {})}
+        for record_id, values in updates.items():
+            self._updates[record_id] = {**values, **self._updates.get(record_id, {})}
+
+    def stats(self) -> dict:
+        """returns the coalescing counters and the buffered amounts"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending_creates"] = len(self._creates)
+            stats["pending_updates"] = len(self._updates)
+        return stats
@@ -0,0 +1,112 @@
+"""
+batches a sink failed to take, kept on disk until they are re-driven
+"""
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import quote, unquote
+
+LOG = logging.getLogger(__name__)
+
+SUFFIX = ".jsonl"
+# a file taken by a redrive, which is deleted once it went through
+TAKEN_SUFFIX = ".redrive"
+
+
+class DeadLetterStore:
+    """
+    appends every failed batch as one json line of {"time", "sink",
+    "error", "messages"} to the file of its sink below directory
+    """
+
+    def __init__(self, directory, fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _path(self, sink_name) -> str:
+        return os.path.join(self.directory, quote(sink_name, safe="") + SUFFIX)
+
+    def add(self, sink_name, batch, error):
+        """stores a batch which sink_name failed to take with error"""
+        line = json.dumps({
+            "time": time.time(),
+            "sink": sink_name,
+            "error": f"{type(error).__name__}: {error}",
+            "messages": batch,
+        }) + "\n"
+        with self._lock:
+            with open(self._path(sink_name), "a", encoding="utf-8") as letters:
+                letters.write(line)
+                letters.flush()
+                if self.fsync:
+                    os.fsync(letters.fileno())
+            stats = self._stats.setdefault(sink_name, {"batches": 0, "messages": 0})
+            stats["batches"] += 1
+            stats["messages"] += len(batch)
+        LOG.warning("dead-lettered %s messages of %s: %s", len(batch), sink_name, error)
+
+    def pending(self, sink_name=None) -> list:
+        """
+        returns (sink_name, path) of the files with dead letters, also in
+        the directories of worker processes and those of broken redrives
+        """
+        found = []
+        for directory, _dirs, names in os.walk(self.directory):
+            for name in sorted(names):
+                if name.endswith(TAKEN_SUFFIX):
+                    # <sink>.jsonl.<stamp>.redrive
+                    sink = unquote(name[:-len(TAKEN_SUFFIX)].rsplit(".", 1)[0][:-len(SUFFIX)])
+                elif name.endswith(SUFFIX):
+                    sink = unquote(name[:-len(SUFFIX)])
+                else:
+                    continue
+                if sink_name is None or sink == sink_name:
+                    found.append((sink, os.path.join(directory, name)))
+        return found
+
+    def take(self, path) -> str:
+        """
+        moves a file of dead letters aside for a redrive, new letters of
+        its sink go to a new file meanwhile
+        """
+        if path.endswith(TAKEN_SUFFIX):
+            return path
+        taken = f"{path}.{time.time_ns()}{TAKEN_SUFFIX}"
+        with self._lock:
+            os.replace(path, taken)
+        return taken
+
+    def stats(self) -> dict:
+        """returns the batches and messages dead-lettered by sink since the start"""
+        with self._lock:
+            return {sink_name: dict(stats) for sink_name, stats in self._stats.items()}
+
+
+def iter_letters(path):
+    """yields the dead letters of a file"""
+    with open(path, encoding="utf-8") as letters:
+        for line in letters:
+            if line.strip():
+                yield json.loads(line)
+
+
+def get_dead_letter_settings(conf, worker=None) -> dict:
+    """
+    reads the [dead_letter] section of the config, returns None if it is
+    off. every worker process has its own directory below the path
+    """
+    section = "dead_letter"
+    if not conf.has_option(section, "path"):
+        return None
+    directory = conf.get(section, "path")
+    if worker is not None:
+        directory = os.path.join(directory, f"worker-{worker}")
+    return {
+        "directory": directory,
+        "fsync": conf.getboolean(section, "fsync", fallback=True),
+    }
@@ -0,0 +1,196 @@
+"""
+memory-bounded detection of messages which were already accepted
+"""
+import hashlib
+import math
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_CAPACITY = 1000000
+DEFAULT_ERROR_RATE = 0.0001
+DEFAULT_WINDOW = 3600.0
+
+
+class BloomFilter:
+    """
+    a fixed size bloom filter for capacity keys at error_rate false
+    positives, keys are looked up and added a whole batch at a time
+    """
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = np.zeros((self.size + 7) // 8, dtype=np.uint8)
+        self.count = 0
+        self._steps = np.arange(self.hashes, dtype=np.uint64)
+
+    def positions(self, digests):
+        """returns the bit positions of (n, 2) uint64 key digests, by double hashing"""
+        first = digests[:, :1]
+        second = digests[:, 1:] | np.uint64(1)
+        # wraps around at 2**64 the same way for every lookup
+        return (first + self._steps * second) % np.uint64(self.size)
+
+    def contains(self, positions):
+        """tells for every row of positions if all its bits are set"""
+        bits = self.bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)
+        return (bits & 1).all(axis=1)
+
+    def add(self, positions):
+        """sets the bits of every row of positions"""
+        np.bitwise_or.at(
+            self.bits,
+            positions >> np.uint64(3),
+            np.left_shift(1, positions & np.uint64(7)).astype(np.uint8),
+        )
+        self.count += len(positions)
+
+    def clear(self):
+        """forgets all keys"""
+        self.bits[:] = 0
+        self.count = 0
+
+
+class Deduplicator:
+    """
+    remembers the message ids of the last window seconds in two rotating
+    bloom filters, the current one and the one before. a message id is a
+    duplicate if either filter has it. the memory is fixed at two filters
+    of capacity ids each, a filter is rotated when it is full or older
+    than window. the ids of batches on their way in are claimed until they
+    are remembered or released, a concurrent retry of such a batch is a
+    duplicate as well.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE,
+                 window=DEFAULT_WINDOW):
+        self.window = window
+        self._current = BloomFilter(capacity, error_rate)
+        self._previous = BloomFilter(capacity, error_rate)
+        self._started = time.monotonic()
+        self._claimed = set()
+        self._lock = threading.Lock()
+        self._stats = {"checked": 0, "duplicates": 0, "without_id": 0, "rotations": 0}
+
+    def _rotate(self, now):
+        self._previous, self._current = self._current, self._previous
+        self._current.clear()
+        self._started = now
+        self._stats["rotations"] += 1
+
+    @staticmethod
+    def _digests(message_ids):
+        return np.frombuffer(b"".join(
+            hashlib.blake2b(str(message_id).encode(), digest_size=16).digest()
+            for message_id in message_ids
+        ), dtype=np.uint64).reshape(-1, 2)
+
+    @staticmethod
+    def _message_ids(batch) -> list:
+        return list(dict.fromkeys(
+            message["message_id"] for message in batch if message.get("message_id")
+        ))
+
+    def unseen(self, batch) -> list:
+        """
+        returns the messages of a batch which were not seen before, the
+        first of every message id, without remembering them
+        """
+        return self._fresh(batch, claim=False)
+
+    def claim(self, batch) -> list:
+        """
+        returns the messages of a batch which were not seen before and are
+        not claimed by another batch, and claims their ids. they are then
+        remembered once the batch is taken or released if it is not.
+        """
+        return self._fresh(batch, claim=True)
+
+    def _fresh(self, batch, claim) -> list:
+        message_ids = self._message_ids(batch)
+        new_ids = set()
+        if message_ids:
+            digests = self._digests(message_ids)
+            with self._lock:
+                positions = self._current.positions(digests)
+                seen = self._current.contains(positions) | self._previous.contains(positions)
+                new_ids = {
+                    message_id for message_id, dup in zip(message_ids, seen.tolist())
+                    if not dup and message_id not in self._claimed
+                }
+                if claim:
+                    self._claimed.update(new_ids)
+        # the first message of every new id, in the order of the batch
+        fresh = []
+        without_id = 0
+        for message in batch:
+            message_id = message.get("message_id")
+            if not message_id:
+                without_id += 1
+                fresh.append(message)
+            elif message_id in new_ids:
+                new_ids.remove(message_id)
+                fresh.append(message)
+        with self._lock:
+            self._stats["checked"] += len(batch) - without_id
+            self._stats["duplicates"] += len(batch) - len(fresh)
+            self._stats["without_id"] += without_id
+        return fresh
+
+    def release(self, batch):
+        """gives up the claims of a batch which was not taken"""
+        message_ids = self._message_ids(batch)
+        with self._lock:
+            self._claimed.difference_update(message_ids)
+
+    def remember(self, batch):
+        """remembers the message ids of a batch which was taken and drops their claims"""
+        message_ids = self._message_ids(batch)
+        # a filter takes at most its capacity, a larger batch fills one after the other
+        capacity = self._current.capacity
+        for start in range(0, len(message_ids), capacity):
+            chunk = message_ids[start:start + capacity]
+            digests = self._digests(chunk)
+            now = time.monotonic()
+            with self._lock:
+                if (now - self._started >= self.window
+                        or self._current.count + len(chunk) > capacity):
+                    self._rotate(now)
+                positions = self._current.positions(digests)
+                # the count only grows by the ids the filter does not hold yet
+                self._current.add(positions[~self._current.contains(positions)])
+                self._claimed.difference_update(chunk)
+
+    def filter(self, batch) -> list:
+        """returns the messages of a batch which were not seen before and remembers them"""
+        fresh = self.claim(batch)
+        self.remember(fresh)
+        return fresh
+
+    def stats(self) -> dict:
+        """returns the duplicate counters, the hit rate and the memory used"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["remembered"] = self._current.count + self._previous.count
+            stats["claimed"] = len(self._claimed)
+        stats["hit_rate"] = stats["duplicates"] / stats["checked"] if stats["checked"] else 0.0
+        stats["memory"] = self._current.bits.nbytes + self._previous.bits.nbytes
+        return stats
+
+
+def get_dedup_settings(conf):
+    """reads the [dedup] section of the config, returns None if it is off"""
+    section = "dedup"
+    if not conf.getboolean(section, "enabled", fallback=False):
+        return None
+    error_rate = conf.getfloat(section, "error_rate", fallback=DEFAULT_ERROR_RATE)
+    if not 0 < error_rate < 1:
+        raise ValueError("[dedup] error_rate must be between 0 and 1")
+    return {
+        "capacity": conf.getint(section, "capacity", fallback=DEFAULT_CAPACITY),
+        "error_rate": error_rate,
+        "window": conf.getfloat(section, "window", fallback=DEFAULT_WINDOW),
+    }
@@ -0,0 +1,334 @@
+"""
+concurrent delivery to the sinks with per sink isolation
+"""
+import logging
+import random
+import threading
+import time
+import xmlrpc.client
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from metersink.ingest import DEFAULT_SINK_BACKLOG, DEFAULT_SINK_THREADS
+from metersink.metrics import ERRORS, SINK_DELIVERIES, SINK_LATENCY
+from metersink.routing import SinkPolicy
+
+LOG = logging.getLogger(__name__)
+
+# errors worth another attempt, anything else is a bug or a bad message
+TRANSIENT_ERRORS = (OSError, xmlrpc.client.ProtocolError, TimeoutError)
+MAX_BACKOFF = 30.0
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """a sink is not tried while its circuit breaker is open"""
+
+
+class SinkBusy(Exception):
+    """a sink has its whole backlog of batches running or waiting"""
+
+
+class SinkTimeout(Exception):
+    """a batch is given up after the delivery timeout of its sink"""
+
+
+class CircuitBreaker:
+    """
+    opens after threshold transient failures in a row, so that batches
+    fail fast instead of waiting on a dead sink. after reset seconds one
+    delivery is let through, it closes the breaker again if it works.
+    """
+
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """tells if a delivery may be tried now"""
+        if self.threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.reset:
+                self.state = HALF_OPEN
+                self._trial = False
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        """records a delivery which worked"""
+        with self._lock:
+            self.failures = 0
+            self.state = CLOSED
+
+    def failure(self) -> bool:
+        """records a transient failure, returns True if the breaker opened"""
+        with self._lock:
+            self.failures += 1
+            if self.threshold <= 0 or self.state == OPEN:
+                return False
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                return True
+            return False
+
+
+def backoff_delay(attempt, backoff) -> float:
+    """returns the seconds before retry attempt, exponential with full jitter"""
+    return random.uniform(0, min(MAX_BACKOFF, backoff * 2 ** attempt))
+
+
+class SinkState:
+    """the error accounting and the circuit breaker of one sink"""
+
+    def __init__(self, name, policy=None):
+        policy = policy or SinkPolicy(0.0, 0)
+        self.name = name
+        self.breaker = CircuitBreaker(policy.breaker_threshold, policy.breaker_reset)
+        self._lock = threading.Lock()
+        self._stats = {
+            "delivered": 0,
+            "failed": 0,
+            "retries": 0,
+            "timeouts": 0,
+            "rejected": 0,
+            "dead_lettered": 0,
+            "consecutive_failures": 0,
+            "seconds": 0.0,
+        }
+        self.last_error = None
+
+    def count(self, key, amount=1):
+        """increments a counter"""
+        with self._lock:
+            self._stats[key] += amount
+
+    def success(self, seconds):
+        """records a delivered batch"""
+        with self._lock:
+            self._stats["delivered"] += 1
+            self._stats["seconds"] += seconds
+            self._stats["consecutive_failures"] = 0
+
+    def failure(self, exc):
+        """records a batch which could not be delivered"""
+        with self._lock:
+            self._stats["failed"] += 1
+            self._stats["consecutive_failures"] += 1
+            self.last_error = f"{type(exc).__name__}: {exc}"
+
+    def stats(self) -> dict:
+        """returns the counters and the last error"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats["last_error"] = self.last_error
+        stats["breaker"] = self.breaker.state
+        stats["breaker_opened"] = self.breaker.opened
+        return stats
+
+
+class Progress:
+    """
+    the number of leading messages of a batch which a sink took, a retry
+    goes on after them and only the rest is dead-lettered
+    """
+
+    __slots__ = ("delivered",)
+
+    def __init__(self):
+        self.delivered = 0
+
+
+class FanOut:
+    """
+    runs the delivery to every sink in the sink's own thread pool, so a
+    slow or dead sink neither delays nor blocks the others. a sink holds
+    up to backlog batches, running or waiting. with a DeadLetterStore a
+    batch a sink fails to take is stored there and counts as taken.
+    """
+
+    def __init__(self, sink_threads=DEFAULT_SINK_THREADS, dead_letters=None,
+                 backlog=DEFAULT_SINK_BACKLOG):
+        self.sink_threads = sink_threads
+        self.backlog = backlog
+        self.dead_letters = dead_letters
+        self._executors = {}
+        self._states = {}
+        self._slots = {}
+        # the flags which give up a batch which is not finished in time
+        self._cancels = {}
+        self._lock = threading.Lock()
+
+    def _get(self, sink_name, policy=None):
+        with self._lock:
+            if sink_name not in self._executors:
+                self._executors[sink_name] = ThreadPoolExecutor(
+                    max_workers=self.sink_threads,
+                    thread_name_prefix=f"sink-{sink_name}",
+                )
+                self._states[sink_name] = SinkState(sink_name, policy)
+                self._slots[sink_name] = threading.BoundedSemaphore(
+                    max(self.backlog, self.sink_threads))
+            state = self._states[sink_name]
+            if policy:
+                # the policy may have changed with a reload of the routes
+                state.breaker.threshold = policy.breaker_threshold
+                state.breaker.reset = policy.breaker_reset
+            return self._executors[sink_name], state
+
+    def submit(self, sink_name, func, *args, policy=None, dead_letter=None, progress=None):
+        """
+        runs func(*args) for a sink, retrying transient errors after a
+        jittered exponential backoff. func moves progress on as messages
+        are taken, a retry is left to go on from there. fails fast while
+        the circuit breaker of the sink is open or its backlog is full. if
+        it fails for good, the part of dead_letter (the batch) which was
+        not taken goes to the dead letter store if there is one.
+        """
+        policy = policy or SinkPolicy(0.0, 0)
+        executor, state = self._get(sink_name, policy)
+        slots = self._slots[sink_name]
+        cancelled = threading.Event()
+
+        def give_up(exc) -> bool:
+            if self.dead_letters is None or dead_letter is None:
+                return False
+            # the messages before progress are in the sink already
+            remainder = dead_letter[progress.delivered:] if progress else dead_letter
+            if remainder:
+                self.dead_letters.add(sink_name, remainder, exc)
+            state.count("dead_lettered")
+            SINK_DELIVERIES.inc(sink_name, "dead_letter")
+            return True
+
+        def run():
+            try:
+                return deliver()
+            except Exception as exc:  # pylint: disable=broad-except
+                if not give_up(exc):
+                    raise
+                return None
+
+        def deliver():
+            start = time.monotonic()
+            for attempt in range(policy.retries + 1):
+                if cancelled.is_set():
+                    # the batch is past its timeout, the ingest worker went on
+                    exc = SinkTimeout(f"gave up a batch after the {policy.timeout}s "
+                                      f"timeout of {sink_name}")
+                    state.failure(exc)
+                    raise exc
+                if not state.breaker.allow():
+                    state.count("rejected")
+                    SINK_DELIVERIES.inc(sink_name, "rejected")
+                    raise CircuitOpen(f"the circuit breaker of {sink_name} is open")
+                try:
+                    result = func(*args)
+                except TRANSIENT_ERRORS as exc:
+                    ERRORS.inc("sink", type(exc).__name__)
+                    if state.breaker.failure():
+                        LOG.warning("opened the circuit breaker of %s for %ss after %s",
+                                    sink_name, state.breaker.reset, exc)
+                    if attempt < policy.retries and state.breaker.state == CLOSED:
+                        state.count("retries")
+                        SINK_DELIVERIES.inc(sink_name, "retry")
+                        LOG.info("retrying %s after %s", sink_name, exc)
+                        time.sleep(backoff_delay(attempt, policy.backoff))
+                        continue
+                    state.failure(exc)
+                    SINK_DELIVERIES.inc(sink_name, "failed")
+                    raise
+                except Exception as exc:
+                    ERRORS.inc("sink", type(exc).__name__)
+                    # the sink answered, the batch is the problem
+                    state.breaker.success()
+                    state.failure(exc)
+                    SINK_DELIVERIES.inc(sink_name, "failed")
+                    raise
+                seconds = time.monotonic() - start
+                state.breaker.success()
+                state.success(seconds)
+                SINK_DELIVERIES.inc(sink_name, "delivered")
+                SINK_LATENCY.observe(seconds, sink_name)
+                return result
+            return None
+
+        if not slots.acquire(blocking=False):
+            state.count("rejected")
+            SINK_DELIVERIES.inc(sink_name, "rejected")
+            exc = SinkBusy(f"the backlog of {self.backlog} batches of {sink_name} is full")
+            future = Future()
+            if give_up(exc):
+                future.set_result(None)
+            else:
+                state.failure(exc)
+                future.set_exception(exc)
+            return future
+        future = executor.submit(run)
+        with self._lock:
+            self._cancels[future] = cancelled
+
+        def finished(done):
+            with self._lock:
+                self._cancels.pop(done, None)
+            slots.release()
+
+        future.add_done_callback(finished)
+        return future
+
+    def wait(self, jobs) -> list:
+        """
+        waits for (sink_name, future, timeout) jobs, each up to its own
+        timeout, and returns the names of the sinks which finished in time.
+        a job which is not finished by then is given up before its next
+        attempt.
+        """
+        started = time.monotonic()
+        done = []
+        for sink_name, future, timeout in jobs:
+            remaining = max(0.0, started + timeout - time.monotonic())
+            try:
+                future.result(timeout=remaining)
+            except FutureTimeoutError:
+                _executor, state = self._get(sink_name)
+                state.count("timeouts")
+                SINK_DELIVERIES.inc(sink_name, "timeout")
+                LOG.warning("%s did not finish within %ss", sink_name, timeout)
+                with self._lock:
+                    cancelled = self._cancels.get(future)
+                if cancelled:
+                    cancelled.set()
+                continue
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("failed to push to %s", sink_name)
+                continue
+            done.append(sink_name)
+        return done
+
+    def stats(self) -> dict:
+        """returns the error accounting of every sink"""
+        with self._lock:
+            states = dict(self._states)
+        return {name: state.stats() for name, state in states.items()}
+
+    def shutdown(self, wait=True):
+        """stops the sink thread pools"""
+        with self._lock:
+            executors = list(self._executors.values())
+        for executor in executors:
+            executor.shutdown(wait=wait)
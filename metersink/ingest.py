@@ -0,0 +1,241 @@
+"""
+the bounded ingestion queue between the api endpoint and the sinks
+"""
+import collections
+import itertools
+import logging
+import queue
+import threading
+import time
+import zlib
+
+from metersink.metrics import ERRORS
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 1000
+DEFAULT_WORKERS = 4
+DEFAULT_RETRY_AFTER = 5
+DEFAULT_SINK_THREADS = 4
+DEFAULT_SINK_BACKLOG = 16
+DEFAULT_MAX_BATCH = 1000
+
+_STOP = object()
+
+
+class QueueFull(Exception):
+    """raised when a batch can not be accepted because the queue is full"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"ingestion queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def project_of(message):
+    """returns the project id of an event or a sample, or None"""
+    traits = message.get("traits")
+    if isinstance(traits, dict):
+        return traits.get("project_id")
+    if traits:
+        for trait in traits:
+            if trait[0] == "project_id":
+                return trait[2]
+    return message.get("project_id")
+
+
+def partition_of(message, partitions, divisor=1) -> int:
+    """
+    returns the partition of a message by the crc32 of its project id,
+    divisor skips the part of the hash already used by an outer partition
+    """
+    project_id = project_of(message) or ""
+    return zlib.crc32(str(project_id).encode()) // divisor % partitions
+
+
+def split_batch(batch, partitions, divisor=1) -> dict:
+    """splits a batch into {partition: messages}, keeping the order of each"""
+    if partitions == 1:
+        return {0: batch}
+    parts = {}
+    for message in batch:
+        parts.setdefault(partition_of(message, partitions, divisor), []).append(message)
+    return parts
+
+
+class IngestQueue:
+    """
+    accepts message batches and delivers them with a pool of worker threads
+
+    every worker has its own queue. batches submitted with the same
+    partition are delivered one after the other by the same worker, there
+    is no ordering between partitions
+    """
+
+    def __init__(self, deliver,
+                 queue_size=DEFAULT_QUEUE_SIZE,
+                 workers=DEFAULT_WORKERS,
+                 retry_after=DEFAULT_RETRY_AFTER,
+                 name="ingest",
+                 ):
+        self.deliver = deliver
+        self.workers = workers
+        self.retry_after = retry_after
+        self.name = name
+        # the capacity is shared out between the workers, a queue is full
+        # when its batches and the room reserved for batches reach it
+        self.capacity = max(1, -(-queue_size // workers))
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._taken = [0] * workers
+        self._room = threading.Condition()
+        self._next = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._busy = 0
+        self._busy_seconds = 0.0
+        self._started = time.monotonic()
+        self._stats = {
+            "accepted": 0,
+            "rejected": 0,
+            "delivered": 0,
+            "failed": 0,
+        }
+
+    def start(self):
+        """starts the worker threads"""
+        self._started = time.monotonic()
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, args=(number,),
+                name=f"{self.name}-{number}", daemon=True,
+            )
+            thread.start()
+            self._threads.append(thread)
+        LOG.info("started %s ingestion workers", self.workers)
+
+    def stop(self, timeout=None):
+        """delivers the queued batches and stops the worker threads"""
+        for number, _thread in enumerate(self._threads):
+            self._queues[number].put(_STOP)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _index(self, partition):
+        if partition is None:
+            partition = next(self._next)
+        return partition % self.workers
+
+    def _fits(self, counts) -> bool:
+        # a queue without batches takes more than its capacity at once
+        return all(
+            not self._taken[index] or self._taken[index] + count <= self.capacity
+            for index, count in counts.items()
+        )
+
+    def full(self, partitions=None) -> bool:
+        """
+        tells if there is no room right now for one batch of each of
+        partitions, without partitions if any queue is full
+        """
+        with self._room:
+            if partitions is None:
+                return any(taken >= self.capacity for taken in self._taken)
+            return not self._fits(collections.Counter(self._index(p) for p in partitions))
+
+    def reserve(self, partitions, wait=False):
+        """
+        reserves room for one batch of each of partitions, for all of them
+        or none. raises QueueFull if there is no room unless wait is set,
+        then it blocks until there is. the room is used by submit with
+        reserved set or handed back with release.
+        """
+        counts = collections.Counter(self._index(partition) for partition in partitions)
+        with self._room:
+            while not self._fits(counts):
+                if not wait:
+                    with self._lock:
+                        self._stats["rejected"] += 1
+                    raise QueueFull(self.retry_after)
+                self._room.wait()
+            for index, count in counts.items():
+                self._taken[index] += count
+
+    def release(self, partitions):
+        """hands back room reserved for batches which are not submitted"""
+        with self._room:
+            for partition in partitions:
+                self._taken[partition % self.workers] -= 1
+            self._room.notify_all()
+
+    def submit(self, batch, wait=False, partition=None, reserved=False):
+        """
+        queues a batch for delivery, raises QueueFull if there is no room
+        unless wait is set, then it blocks until there is room. batches
+        without partition are spread over the workers. with reserved the
+        batch takes room reserved before.
+        """
+        index = self._index(partition)
+        if not reserved:
+            self.reserve([index], wait=wait)
+        self._queues[index].put(batch)
+        with self._lock:
+            self._stats["accepted"] += 1
+
+    def _work(self, number):
+        work_queue = self._queues[number]
+        while True:
+            batch = work_queue.get()
+            if batch is _STOP:
+                work_queue.task_done()
+                return
+            self.release([number])
+            with self._lock:
+                self._busy += 1
+            start = time.monotonic()
+            result = "failed"
+            try:
+                self.deliver(batch)
+                result = "delivered"
+            except Exception as exc:  # pylint: disable=broad-except
+                ERRORS.inc("ingest", type(exc).__name__)
+                LOG.exception("failed to deliver a batch to the sinks")
+            finally:
+                with self._lock:
+                    self._busy -= 1
+                    self._busy_seconds += time.monotonic() - start
+                    self._stats[result] += 1
+                work_queue.task_done()
+
+    def join(self):
+        """blocks until all queued batches are handled"""
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def stats(self) -> dict:
+        """returns queue depth, worker utilisation and counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            busy = self._busy
+            busy_seconds = self._busy_seconds
+        elapsed = max(time.monotonic() - self._started, 1e-9)
+        stats.update({
+            "depth": sum(work_queue.qsize() for work_queue in self._queues),
+            "capacity": self.capacity * self.workers,
+            "workers": self.workers,
+            "busy_workers": busy,
+            "utilisation": busy_seconds / (elapsed * max(self.workers, 1)),
+        })
+        return stats
+
+
+def get_ingest_settings(conf) -> dict:
+    """reads the [ingest] section of the config"""
+    section = "ingest"
+    return {
+        "queue_size": conf.getint(section, "queue_size", fallback=DEFAULT_QUEUE_SIZE),
+        "workers": conf.getint(section, "workers", fallback=DEFAULT_WORKERS),
+        "retry_after": conf.getint(section, "retry_after", fallback=DEFAULT_RETRY_AFTER),
+        "sink_threads": conf.getint(section, "sink_threads", fallback=DEFAULT_SINK_THREADS),
+        "sink_backlog": conf.getint(section, "sink_backlog", fallback=DEFAULT_SINK_BACKLOG),
+        "max_batch": conf.getint(section, "max_batch", fallback=DEFAULT_MAX_BATCH),
+    }
@@ -0,0 +1,484 @@
+"""
+a local sqlite ledger of the billed usage by project, resource and billing
+period, reconciled with odoo in bulk
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from metersink.ingest import partition_of
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_LEDGER_PATH = "usage_ledger.sqlite"
+DEFAULT_RECONCILE_INTERVAL = 300.0
+DEFAULT_RECONCILE_BATCH = 1000
+DEFAULT_KEEP_EVENTS = 35.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    sink TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    event_type TEXT,
+    generated TEXT,
+    received REAL NOT NULL,
+    PRIMARY KEY (sink, message_id)
+);
+CREATE INDEX IF NOT EXISTS events_received ON events (received);
+CREATE TABLE IF NOT EXISTS resources (
+    sink TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    product TEXT NOT NULL,
+    display_name TEXT,
+    state TEXT,
+    start TEXT NOT NULL,
+    last_event TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    sizes TEXT NOT NULL,
+    PRIMARY KEY (sink, resource_id)
+);
+CREATE TABLE IF NOT EXISTS usage (
+    sink TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    period TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    product TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    sizes TEXT NOT NULL,
+    last_event TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    synced_version INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (sink, resource_id, period)
+);
+CREATE INDEX IF NOT EXISTS usage_project ON usage (project_id, period);
+CREATE INDEX IF NOT EXISTS usage_dirty ON usage (sink, resource_id)
+    WHERE version > synced_version;
+CREATE TEMP TABLE IF NOT EXISTS unresolved (
+    sink TEXT NOT NULL,
+    resource_id TEXT NOT NULL,
+    reason TEXT,
+    PRIMARY KEY (sink, resource_id)
+);
+"""
+
+
+def period_of(moment) -> str:
+    """returns the billing period, the month, of a point in time"""
+    return f"{moment.year:04d}-{moment.month:02d}"
+
+
+def _next_period_start(moment) -> datetime:
+    if moment.month == 12:
+        return moment.replace(year=moment.year + 1, month=1, day=1,
+                              hour=0, minute=0, second=0, microsecond=0)
+    return moment.replace(month=moment.month + 1, day=1,
+                          hour=0, minute=0, second=0, microsecond=0)
+
+
+def _period_end(period) -> datetime:
+    year, month = period.split("-")
+    return _next_period_start(datetime(int(year), int(month), 1))
+
+
+def split_by_period(start, end) -> list:
+    """returns (period, seconds) of the time between start and end per period"""
+    if end <= start:
+        return [(period_of(end), 0.0)]
+    parts = []
+    while start < end:
+        boundary = min(_next_period_start(start), end)
+        parts.append((period_of(start), (boundary - start).total_seconds()))
+        start = boundary
+    return parts
+
+
+def _add_sizes(sizes, more, fraction=1.0) -> dict:
+    merged = dict(sizes)
+    for size, seconds in more.items():
+        merged[size] = merged.get(size, 0.0) + seconds * fraction
+    return merged
+
+
+class ResourceTotal(NamedTuple):
+    """the usage of a resource over all periods, as it goes into its so line"""
+    resource_id: str
+    project_id: str
+    product: str
+    display_name: str
+    start: datetime
+    end: datetime
+    seconds: float
+    sizes: dict
+
+    @property
+    def minutes(self) -> int:
+        """the runtime as so line quantity"""
+        return int(round(self.seconds / 60))
+
+
+class UsageLedger:
+    """
+    keeps the usage of every resource per odoo sink and billing period
+
+    an event is one local transaction: it is appended to the events and
+    the runtime it adds is split over the periods since the previous event
+    of the resource. the state between two events does not change, so the
+    split is exact. rows changed since the last reconcile are dirty. a
+    resource the reconcile could not resolve, e.g. without a sale order,
+    is left out until its next event or restart. a job may write to the
+    ledger of the running service, the versions are read in the
+    transaction. synchronous is the sqlite sync mode, FULL when the spool counts on the
+    ledger having the events it committed.
+    """
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH, synchronous="NORMAL"):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # with NORMAL a crash may lose the last transactions but never
+        # corrupts the ledger, FULL syncs every transaction
+        if synchronous not in ("NORMAL", "FULL"):
+            raise ValueError(f"unknown ledger synchronous mode: {synchronous}")
+        self._db.execute(f"PRAGMA synchronous={synchronous}")
+        self._db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+        self._version = self._db.execute(
+            "SELECT COALESCE(MAX(version), 0) FROM usage"
+        ).fetchone()[0]
+        self._stats = {"events": 0, "duplicates": 0, "reconciled": 0}
+
+    def billed(self, sink, resource_id):
+        """returns (start, end) of what the ledger billed for a resource or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT start, seconds FROM resources WHERE sink = ? AND resource_id = ?",
+                (sink, resource_id),
+            ).fetchone()
+        if not row:
+            return None
+        start = datetime.fromisoformat(row[0])
+        return start, start + timedelta(seconds=row[1])
+
+    def record(self, sink, event, product, usage) -> bool:
+        """
+        appends an Event with the usage of its resource after it, returns
+        False for an event which is in the ledger already
+        """
+        resource_id = event.resource_id
+        project_id = event.project_id
+        with self._lock:
+            # the write lock up front, the versions of other writers are read after it
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._version = max(self._version, self._db.execute(
+                    "SELECT COALESCE(MAX(version), 0) FROM usage").fetchone()[0])
+                if event.message_id:
+                    inserted = self._db.execute(
+                        "INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?, ?, ?)",
+                        (sink, event.message_id, resource_id, event.event_type,
+                         event.generated.isoformat() if event.generated else None,
+                         time.time()),
+                    ).rowcount
+                    if not inserted:
+                        self._db.execute("COMMIT")
+                        self._stats["duplicates"] += 1
+                        return False
+                previous = self._db.execute(
+                    "SELECT last_event, seconds, sizes FROM resources "
+                    "WHERE sink = ? AND resource_id = ?",
+                    (sink, resource_id),
+                ).fetchone()
+                if previous:
+                    since = datetime.fromisoformat(previous[0])
+                    seconds = previous[1]
+                    sizes = json.loads(previous[2])
+                else:
+                    since, seconds, sizes = usage.start, 0.0, {}
+                end = max(usage.end, since)
+                added = max(0.0, usage.seconds - seconds)
+                added_sizes = {size: value - sizes.get(size, 0.0)
+                               for size, value in usage.sizes.items()
+                               if value > sizes.get(size, 0.0)}
+                parts = split_by_period(since, end)
+                span_seconds = sum(part for _period, part in parts)
+                for period, part in parts:
+                    fraction = part / span_seconds if span_seconds else 1.0
+                    self._add_period(sink, resource_id, project_id, product, period,
+                                     added * fraction, added_sizes, fraction, end)
+                # an event may resolve what the reconcile missed
+                self._db.execute("DELETE FROM unresolved WHERE sink = ? AND resource_id = ?",
+                                 (sink, resource_id))
+                self._db.execute(
+                    "INSERT OR REPLACE INTO resources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (sink, resource_id, project_id, product, event.display_name,
+                     usage.state, usage.start.isoformat(), end.isoformat(),
+                     max(usage.seconds, seconds), json.dumps(_add_sizes(sizes, added_sizes))),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._stats["events"] += 1
+        return True
+
+    def _add_period(self, sink, resource_id, project_id, product, period,
+                    seconds, sizes, fraction, end):
+        row = self._db.execute(
+            "SELECT seconds, sizes, last_event FROM usage "
+            "WHERE sink = ? AND resource_id = ? AND period = ?",
+            (sink, resource_id, period),
+        ).fetchone()
+        if row:
+            seconds += row[0]
+            sizes = _add_sizes(json.loads(row[1]), sizes, fraction)
+            last_event = max(row[2], min(end, _period_end(period)).isoformat())
+        else:
+            sizes = _add_sizes({}, sizes, fraction)
+            last_event = min(end, _period_end(period)).isoformat()
+        self._version += 1
+        self._db.execute(
+            "INSERT INTO usage (sink, resource_id, period, project_id, product, seconds, "
+            "sizes, last_event, version) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (sink, resource_id, period) DO UPDATE SET project_id = excluded.project_id, "
+            "product = excluded.product, seconds = excluded.seconds, sizes = excluded.sizes, "
+            "last_event = excluded.last_event, version = excluded.version",
+            (sink, resource_id, period, project_id, product, seconds, json.dumps(sizes),
+             last_event, self._version),
+        )
+
+    def dirty(self, sink, limit=DEFAULT_RECONCILE_BATCH) -> tuple:
+        """
+        returns the ResourceTotal of up to limit resources with usage
+        changed since they were reconciled, and the version they are at
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                version = self._db.execute(
+                    "SELECT COALESCE(MAX(version), 0) FROM usage").fetchone()[0]
+                rows = self._db.execute(
+                    "SELECT resource_id, project_id, product, display_name, start, last_event, "
+                    "seconds, sizes FROM resources WHERE sink = ? AND resource_id IN "
+                    "(SELECT DISTINCT resource_id FROM usage "
+                    "WHERE sink = ? AND version > synced_version AND resource_id NOT IN "
+                    "(SELECT resource_id FROM unresolved WHERE sink = ?) LIMIT ?)",
+                    (sink, sink, sink, limit),
+                ).fetchall()
+            finally:
+                self._db.execute("COMMIT")
+        totals = [
+            ResourceTotal(
+                resource_id=row[0],
+                project_id=row[1],
+                product=row[2],
+                display_name=row[3],
+                start=datetime.fromisoformat(row[4]),
+                end=datetime.fromisoformat(row[5]),
+                seconds=row[6],
+                sizes=json.loads(row[7]),
+            )
+            for row in rows
+        ]
+        return totals, version
+
+    def mark_synced(self, sink, resource_ids, version):
+        """marks the usage of resources up to version as reconciled"""
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "UPDATE usage SET synced_version = version "
+                "WHERE sink = ? AND resource_id = ? AND version <= ? "
+                "AND version > synced_version",
+                [(sink, resource_id, version) for resource_id in resource_ids],
+            )
+            self._db.execute("COMMIT")
+            self._stats["reconciled"] += len(resource_ids)
+
+    def flag_unresolved(self, sink, reasons):
+        """
+        leaves resources out of the reconcile until their next event,
+        reasons maps their ids to why they could not be reconciled
+        """
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO unresolved VALUES (?, ?, ?)",
+                [(sink, resource_id, reason) for resource_id, reason in reasons.items()],
+            )
+
+    def period_totals(self, period, project_id=None) -> list:
+        """returns the usage rows of a period, of one project or of all"""
+        query = ("SELECT sink, project_id, resource_id, product, seconds, sizes, last_event, "
+                 "version > synced_version FROM usage WHERE period = ?")
+        params = [period]
+        if project_id:
+            query += " AND project_id = ?"
+            params.append(project_id)
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY project_id, resource_id",
+                                    params).fetchall()
+        return [
+            {
+                "sink": row[0],
+                "project_id": row[1],
+                "resource_id": row[2],
+                "product": row[3],
+                "period": period,
+                "minutes": int(round(row[4] / 60)),
+                "sizes": {size: int(round(value / 60))
+                          for size, value in json.loads(row[5]).items()},
+                "last_event": row[6],
+                "reconciled": not row[7],
+            }
+            for row in rows
+        ]
+
+    def prune(self, keep_days=DEFAULT_KEEP_EVENTS) -> int:
+        """drops the events received more than keep_days ago"""
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM events WHERE received < ?",
+                (time.time() - keep_days * 86400,),
+            ).rowcount
+
+    def stats(self) -> dict:
+        """returns the event counters and the number of dirty resources"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["resources"] = self._db.execute(
+                "SELECT COUNT(*) FROM resources").fetchone()[0]
+            stats["dirty"] = self._db.execute(
+                "SELECT COUNT(DISTINCT resource_id) FROM usage "
+                "WHERE version > synced_version").fetchone()[0]
+            stats["unresolved"] = self._db.execute(
+                "SELECT COUNT(*) FROM unresolved").fetchone()[0]
+        return stats
+
+    def close(self):
+        """checkpoints the write-ahead log and closes the database"""
+        with self._lock:
+            self._db.close()
+
+
+class PartitionedLedger:
+    """
+    the ledgers of the worker processes of the service for a job, an event
+    goes to the ledger of the worker of its project
+    """
+
+    def __init__(self, ledgers):
+        self.ledgers = ledgers
+
+    def _ledger_of(self, project_id) -> UsageLedger:
+        return self.ledgers[partition_of({"project_id": project_id}, len(self.ledgers))]
+
+    def billed(self, sink, resource_id):
+        """returns (start, end) of what any of the ledgers billed for a resource or None"""
+        for ledger in self.ledgers:
+            billed = ledger.billed(sink, resource_id)
+            if billed:
+                return billed
+        return None
+
+    def record(self, sink, event, product, usage) -> bool:
+        """records an event in the ledger of its project"""
+        return self._ledger_of(event.project_id).record(sink, event, product, usage)
+
+    def period_totals(self, period, project_id=None) -> list:
+        """returns the usage rows of a period in all ledgers"""
+        return [row for ledger in self.ledgers
+                for row in ledger.period_totals(period, project_id=project_id)]
+
+    def stats(self) -> dict:
+        """returns the counters of all ledgers added up"""
+        totals = {}
+        for ledger in self.ledgers:
+            for key, value in ledger.stats().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def close(self):
+        """closes all ledgers"""
+        for ledger in self.ledgers:
+            ledger.close()
+
+
+def open_job_ledger(conf, processes=1):
+    """
+    opens the ledger of the service for a job like the backfill, those of
+    all processes if it runs worker processes. the job does not reconcile,
+    the service writes what the job recorded to odoo.
+    """
+    if processes <= 1:
+        return UsageLedger(get_ledger_settings(conf)["path"], synchronous="FULL")
+    return PartitionedLedger([
+        UsageLedger(get_ledger_settings(conf, worker=number)["path"], synchronous="FULL")
+        for number in range(processes)
+    ])
+
+
+class LedgerReconciler:
+    """hands the ledger to reconcile periodically and prunes its old events"""
+
+    def __init__(self, ledger, reconcile, interval=DEFAULT_RECONCILE_INTERVAL,
+                 keep_events=DEFAULT_KEEP_EVENTS):
+        self.ledger = ledger
+        self.reconcile = reconcile
+        self.interval = interval
+        self.keep_events = keep_events
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="reconcile", daemon=True)
+
+    def start(self):
+        """starts the periodic reconcile"""
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """reconciles once, a failed sink stays dirty until the next run"""
+        try:
+            self.reconcile(self.ledger)
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("failed to reconcile the usage ledger")
+        pruned = self.ledger.prune(self.keep_events)
+        if pruned:
+            LOG.debug("pruned %s ledger events", pruned)
+
+    def stop(self):
+        """stops the periodic reconcile and reconciles what is left"""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.run_once()
+
+
+def get_ledger_settings(conf, worker=None) -> dict:
+    """
+    reads the [ledger] section of the config, returns None if it is off.
+    every worker process has its own ledger file
+    """
+    section = "ledger"
+    if not conf.getboolean(section, "enabled", fallback=False):
+        return None
+    path = conf.get(section, "path", fallback=DEFAULT_LEDGER_PATH)
+    if worker is not None:
+        path = f"{path}.{worker}"
+    return {
+        "path": path,
+        "interval": conf.getfloat(section, "reconcile_interval",
+                                  fallback=DEFAULT_RECONCILE_INTERVAL),
+        "batch": conf.getint(section, "reconcile_batch", fallback=DEFAULT_RECONCILE_BATCH),
+        "keep_events": conf.getfloat(section, "keep_events", fallback=DEFAULT_KEEP_EVENTS),
+    }
@@ -4,9 +4,14 @@ import configparser
 import logging
 import re
 from datetime import datetime, timedelta
+from typing import NamedTuple
 
 LOG = logging.getLogger(__name__)
 
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# the fields of an Event the ledger and the so lines can not do without
+REQUIRED_EVENT_FIELDS = ("message_id", "project_id", "resource_id")
+
 def dump_config(cfg):
     """
     Emit a config dump to the DEBUG log level.
@@ -75,12 +80,27 @@ def get_time(param):
     return _time
 
 
+def parse_time(value) -> datetime:
+    """returns a naive datetime from a ceilometer or so line timestamp"""
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.strptime(value, TIME_FORMAT)
+    except ValueError:
+        return datetime.fromisoformat(value).replace(tzinfo=None)
+
+
+def format_time(value) -> str:
+    """returns the timestamp format used in the so line display_name"""
+    return parse_time(value).strftime(TIME_FORMAT)
+
+
 def calculate_cloud_time(value1, value2=None):
     """returns the time between value1 and now or value2 in minutes"""
     if not value2:
         value2 = get_time("month_end")
 
-    delta = value2 - datetime.strptime(value1, "%Y-%m-%dT%H:%M:%S")
+    delta = parse_time(value2) - parse_time(value1)
     value = int(round(delta.total_seconds() / 60))
     return value
 
@@ -91,7 +111,8 @@ def parse_so_line_name(text):
     :param text:
     :return:
     """
-    pattern = r"(?P<uuid>[0-9a-z-]+)\n\((?P<values>\S+)\)\n(?P<start>[\d.T:]+) - (?P<end>[\d.T:]+)"
+    pattern = (r"(?P<uuid>[0-9a-z-]+)\n(?:(?P<name>.*)\n)?\((?P<values>[^)]*)\)\n"
+               r"(?P<start>[\d\-.T: ]+) - (?P<end>[\d\-.T: ]+)")
     data_dict = re.search(pattern, text)
     return data_dict
 
@@ -108,19 +129,77 @@ def get_name_from_info(info) -> str:
     """
     returns the so line display_name
     """
+    values = info["values"]
+    if isinstance(values, (list, tuple)):
+        values = ", ".join(str(value) for value in values)
     display_name = (f"{info['uuid']}\n"
                     f"{info['name']}\n"
-                    f"({info['values']})\n"
-                    f"{info['start']} - {info['end']}")
+                    f"({values})\n"
+                    f"{format_time(info['start'])} - {format_time(info['end'])}")
     return display_name
 
 
-def message_to_dict(message) -> dict:
-    """turns the ceilometer message into a python dict"""
-    traits = message["traits"]
-    traits_dict = {}
-    for trait in traits:
-        traits_dict[trait[0]] = trait[2]
-    data_dict = message
-    data_dict["traits"] = traits_dict
-    return data_dict
+class Event(NamedTuple):
+    """
+    the fields of a ceilometer event which the billing needs, with parsed
+    timestamps, built once per message and shared by every odoo sink
+    """
+    event_type: str
+    message_id: str
+    generated: datetime
+    project_id: str
+    resource_id: str
+    flavor_name: str
+    size: int
+    created_at: datetime
+    display_name: str
+
+
+def traits_of(message) -> dict:
+    """returns the traits of a message as dict, without changing the message"""
+    traits = message.get("traits") or {}
+    if isinstance(traits, dict):
+        return traits
+    return {trait[0]: trait[2] for trait in traits}
+
+
+def message_to_event(message):
+    """returns the Event of a ceilometer event, other messages like samples as they are"""
+    if not message.get("event_type"):
+        return message
+    traits = traits_of(message)
+    return Event(
+        event_type=message["event_type"],
+        message_id=message.get("message_id"),
+        generated=parse_time(message["generated"]) if message.get("generated") else None,
+        project_id=traits.get("project_id"),
+        resource_id=traits.get("resource_id"),
+        flavor_name=traits.get("flavor_name"),
+        size=traits.get("size"),
+        created_at=parse_time(traits["created_at"]) if traits.get("created_at") else None,
+        display_name=traits.get("display_name"),
+    )
+
+
+def messages_to_events(batch) -> list:
+    """
+    returns message_to_event of every message in the order of the batch,
+    None for a message which can not be read or is missing one of
+    REQUIRED_EVENT_FIELDS, it is skipped by the sinks
+    """
+    events = []
+    for message in batch:
+        try:
+            event = message_to_event(message)
+        except (LookupError, TypeError, ValueError) as exc:
+            LOG.warning("skipping the unreadable message %s: %s", message.get("message_id"), exc)
+            events.append(None)
+            continue
+        if isinstance(event, Event):
+            missing = [field for field in REQUIRED_EVENT_FIELDS if not getattr(event, field)]
+            if missing:
+                LOG.warning("skipping the event %s without %s", event.message_id,
+                            ", ".join(missing))
+                event = None
+        events.append(event)
+    return events
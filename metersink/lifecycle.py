@@ -0,0 +1,193 @@
+"""
+lifecycle state of the billed resources, kept as intervals of runtime per size
+"""
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple
+
+RUNNING = "running"
+STOPPED = "stopped"
+DELETED = "deleted"
+
+# event type suffixes and the state they lead to, the first match wins
+TRANSITIONS = (
+    ("unshelve.end", RUNNING),
+    ("shelve_offload.end", STOPPED),
+    ("shelve.end", STOPPED),
+    ("delete.end", DELETED),
+    ("create.end", RUNNING),
+)
+DEFAULT_TOMBSTONES = 10000
+
+
+class Interval(NamedTuple):
+    """a closed stretch of runtime with one flavor or volume size"""
+    start: datetime
+    end: datetime
+    size: str
+
+
+class Usage(NamedTuple):
+    """the billed usage of a resource as of its last event"""
+    state: str
+    size: str
+    start: datetime
+    end: datetime
+    seconds: float
+    sizes: dict
+
+    @property
+    def minutes(self) -> int:
+        """the runtime as so line quantity"""
+        return int(round(self.seconds / 60))
+
+
+def next_state(event_type):
+    """returns the state an event leads to or None if it does not change it"""
+    for suffix, state in TRANSITIONS:
+        if event_type.endswith(suffix):
+            return state
+    return None
+
+
+class ResourceState:
+    """the closed intervals and the open one of a resource"""
+
+    __slots__ = ("state", "size", "start", "since", "updated", "message_id",
+                 "intervals", "seconds", "sizes")
+
+    def __init__(self, state, size, start, since):
+        self.state = state
+        self.size = size
+        self.start = start
+        # the start of the open interval, or when it was closed
+        self.since = since
+        self.updated = since
+        self.message_id = None
+        self.intervals = []
+        self.seconds = 0.0
+        self.sizes = {}
+
+    def close(self, end):
+        """closes the open interval at end"""
+        if self.state != RUNNING or end <= self.since:
+            return
+        seconds = (end - self.since).total_seconds()
+        self.intervals.append(Interval(self.since, end, self.size))
+        self.seconds += seconds
+        self.sizes[self.size] = self.sizes.get(self.size, 0.0) + seconds
+        self.since = end
+
+    def usage(self, until) -> Usage:
+        """returns the usage including the open interval up to until"""
+        seconds = self.seconds
+        sizes = dict(self.sizes)
+        if self.state == RUNNING and until > self.since:
+            running = (until - self.since).total_seconds()
+            seconds += running
+            sizes[self.size] = sizes.get(self.size, 0.0) + running
+        sizes.setdefault(self.size, 0.0)
+        return Usage(self.state, self.size, self.start, until, seconds, sizes)
+
+
+class IntervalStore:
+    """
+    applies lifecycle events to the state of every resource
+
+    each event costs one dict lookup and closes at most one interval.
+    events are applied once per message id, so every odoo sink can hand
+    in the same message, and events older than the last one are ignored.
+    """
+
+    def __init__(self, tombstones=DEFAULT_TOMBSTONES):
+        self._states = {}
+        # the final usage of deleted resources, for late duplicates
+        self._deleted = OrderedDict()
+        self.tombstones = tombstones
+        self._lock = threading.Lock()
+        self._stats = {"events": 0, "duplicates": 0, "stale": 0, "transitions": 0}
+
+    def apply(self, resource_id, event_type, timestamp, size,
+              created_at=None, message_id=None, billed=None) -> Usage:
+        """
+        applies an event of a resource and returns its usage up to the
+        event, billed is (start, end) of what was billed before the state
+        of a resource was known, e.g. from the so line index
+        """
+        state_after = next_state(event_type)
+        with self._lock:
+            self._stats["events"] += 1
+            resource = self._states.get(resource_id)
+            if resource is None:
+                if resource_id in self._deleted:
+                    self._stats["duplicates"] += 1
+                    return self._deleted[resource_id]
+                resource = self._adopt(resource_id, event_type, timestamp, size,
+                                       created_at, billed)
+            if message_id is not None and message_id == resource.message_id:
+                self._stats["duplicates"] += 1
+                return resource.usage(resource.updated)
+            if timestamp < resource.updated:
+                self._stats["stale"] += 1
+                return resource.usage(resource.updated)
+            resource.message_id = message_id
+            resource.updated = timestamp
+
+            if size is not None and size != resource.size:
+                # resized, the old size is billed up to now
+                resource.close(timestamp)
+                resource.size = size
+                self._stats["transitions"] += 1
+            if state_after and state_after != resource.state:
+                resource.close(timestamp)
+                if state_after == RUNNING:
+                    resource.since = timestamp
+                resource.state = state_after
+                self._stats["transitions"] += 1
+            usage = resource.usage(timestamp)
+            if resource.state == DELETED:
+                del self._states[resource_id]
+                self._deleted[resource_id] = usage
+                while len(self._deleted) > self.tombstones:
+                    self._deleted.popitem(last=False)
+            return usage
+
+    def _adopt(self, resource_id, event_type, timestamp, size, created_at, billed):
+        if billed:
+            # continue after what is billed, earlier gaps are unknown
+            start, end = billed
+            resource = ResourceState(RUNNING, size, start, start)
+            resource.close(end)
+        else:
+            # running since its creation, also if it is first seen later on
+            start = created_at or timestamp
+            resource = ResourceState(RUNNING, size, start, start)
+        resource.updated = min(resource.since, timestamp)
+        self._states[resource_id] = resource
+        return resource
+
+    def get(self, resource_id, until=None):
+        """returns the usage of a resource or None if it is unknown"""
+        with self._lock:
+            resource = self._states.get(resource_id)
+            if resource is None:
+                return self._deleted.get(resource_id)
+            return resource.usage(until or resource.updated)
+
+    def intervals(self, resource_id) -> list:
+        """returns the closed intervals of a resource"""
+        with self._lock:
+            resource = self._states.get(resource_id)
+            return list(resource.intervals) if resource else []
+
+    def stats(self) -> dict:
+        """returns the event counters and the number of tracked resources"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["resources"] = len(self._states)
+            stats["running"] = sum(
+                1 for resource in self._states.values() if resource.state == RUNNING
+            )
+            stats["deleted"] = len(self._deleted)
+        return stats
@@ -0,0 +1,74 @@
+"""
+in-memory index of the sale order lines by resource uuid
+"""
+import threading
+from datetime import datetime
+from typing import NamedTuple
+
+
+class LineEntry(NamedTuple):
+    """what the sink knows about the so line of one resource"""
+    line_id: int
+    order_id: int
+    product_id: int
+    start: datetime
+    end: datetime
+
+
+class LineIndex:
+    """
+    maps resource uuids to their so line of one odoo sink
+
+    the index is warm once it was filled from odoo, from then on a missing
+    uuid means that the resource has no line yet
+    """
+
+    def __init__(self):
+        self.warm = False
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "updates": 0}
+
+    def get(self, uuid):
+        """returns the entry of a resource or None"""
+        entry = self._entries.get(uuid)
+        with self._lock:
+            self._stats["hits" if entry else "misses"] += 1
+        return entry
+
+    def put(self, uuid, entry):
+        """stores or replaces the entry of a resource"""
+        with self._lock:
+            self._entries[uuid] = entry
+            self._stats["updates"] += 1
+
+    def update_end(self, uuid, end):
+        """moves the last billed end of a resource"""
+        with self._lock:
+            entry = self._entries.get(uuid)
+            if entry:
+                self._entries[uuid] = entry._replace(end=end)
+                self._stats["updates"] += 1
+
+    def remove(self, uuid):
+        """drops a resource from the index"""
+        with self._lock:
+            self._entries.pop(uuid, None)
+
+    def load(self, entries, warm=True):
+        """bulk loads (uuid, entry) pairs, entries stored meanwhile win"""
+        with self._lock:
+            for uuid, entry in entries:
+                self._entries.setdefault(uuid, entry)
+            self.warm = self.warm or warm
+
+    def stats(self) -> dict:
+        """returns the hit and miss counters and the size"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+        stats["warm"] = self.warm
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
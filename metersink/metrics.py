@@ -0,0 +1,245 @@
+"""
+counters and histograms in the prometheus text format
+
+the hot path only touches a dict of the calling thread, the values of
+all threads are added up when the metrics are scraped
+"""
+import bisect
+import re
+import threading
+from abc import ABC, abstractmethod
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# shards of finished threads are folded into one when there are more
+MAX_SHARDS = 64
+
+_METRICS = []
+_COLLECTORS = []
+_REGISTRY_LOCK = threading.Lock()
+
+
+class _Sharded(ABC):
+    """a metric whose values are kept per thread"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+        with _REGISTRY_LOCK:
+            _METRICS.append(self)
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                if len(self._shards) >= MAX_SHARDS:
+                    self._fold()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _fold(self):
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                for key, value in values.items():
+                    self._retired[key] = self._merge(self._retired.get(key), value)
+        self._shards = alive
+
+    @abstractmethod
+    def _merge(self, total, value):
+        """adds the value of a thread to a total, which is None at first"""
+
+    def values(self) -> dict:
+        """returns the values of all threads added up by label values"""
+        with self._lock:
+            self._fold()
+            totals = dict(self._retired)
+            shards = [values for _thread, values in self._shards]
+        for values in shards:
+            # the owning thread may add keys meanwhile, items() is atomic
+            for key, value in list(values.items()):
+                totals[key] = self._merge(totals.get(key), value)
+        return totals
+
+    @abstractmethod
+    def samples(self) -> list:
+        """returns the (suffix, labels, value) samples of the metric"""
+
+    def _label_dict(self, key) -> dict:
+        return dict(zip(self.labels, key))
+
+
+class Counter(_Sharded):
+    """a monotonic counter per label values"""
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount=1):
+        """adds amount to the counter of the label values"""
+        values = self._shard()
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def _merge(self, total, value):
+        return (total or 0) + value
+
+    def samples(self) -> list:
+        return [
+            ("", self._label_dict(key), value)
+            for key, value in sorted(self.values().items())
+        ]
+
+
+class Histogram(_Sharded):
+    """observations per label values counted into cumulative buckets"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        """counts one observation of the label values"""
+        values = self._shard()
+        entry = values.get(label_values)
+        if entry is None:
+            # the last bucket is +Inf, then the sum
+            entry = values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    def _merge(self, total, value):
+        if total is None:
+            return list(value)
+        return [left + right for left, right in zip(total, value)]
+
+    def samples(self) -> list:
+        samples = []
+        for key, entry in sorted(self.values().items()):
+            labels = self._label_dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), entry):
+                cumulative += count
+                samples.append(("_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append(("_sum", labels, entry[-1]))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+def register_collector(collect):
+    """
+    registers a function which returns (name, kind, help, samples) families
+    at scrape time, e.g. for gauges read from the stats of a component
+    """
+    with _REGISTRY_LOCK:
+        _COLLECTORS.append(collect)
+
+
+def collect() -> list:
+    """returns the (name, kind, help, samples) families of all metrics"""
+    with _REGISTRY_LOCK:
+        metrics = list(_METRICS)
+        collectors = list(_COLLECTORS)
+    families = [
+        (metric.name, metric.kind, metric.documentation, metric.samples())
+        for metric in metrics
+    ]
+    for collector in collectors:
+        families.extend(collector())
+    return families
+
+
+def stats_to_families(stats, prefix="metersink") -> list:
+    """
+    turns the numbers of a /stats dict into gauges, e.g. ingest.depth into
+    metersink_ingest_depth and sinks.<name>.failed into
+    metersink_sinks_failed{name="<name>"}
+    """
+    families = {}
+
+    def add(component, key, labels, value):
+        name = re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{component}_{key}")
+        family = families.setdefault(name, (name, "gauge", f"{component} {key}", []))
+        family[3].append(("", labels, value))
+
+    for component, values in stats.items():
+        if not isinstance(values, dict):
+            continue
+        for key, value in values.items():
+            if isinstance(value, (bool, int, float)):
+                add(component, key, {}, float(value))
+            elif isinstance(value, dict):
+                for inner_key, inner_value in value.items():
+                    if isinstance(inner_value, (bool, int, float)):
+                        add(component, inner_key, {"name": key}, float(inner_value))
+    return list(families.values())
+
+
+def merge(families_by_label) -> list:
+    """
+    merges the families of several processes into one list, each sample
+    gets the label value of its process, e.g. {"0": families}
+    """
+    merged = {}
+    for label, families in families_by_label.items():
+        for name, kind, documentation, samples in families:
+            family = merged.setdefault(name, (name, kind, documentation, []))
+            family[3].extend(
+                (suffix, {"worker": label, **labels}, value)
+                for suffix, labels, value in samples
+            )
+    return list(merged.values())
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(families) -> str:
+    """returns families in the prometheus text exposition format"""
+    lines = []
+    for name, kind, documentation, samples in families:
+        lines.append(f"# HELP {name} {documentation}")
+        lines.append(f"# TYPE {name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels.items())
+            lines.append(
+                f"{name}{suffix}{{{label_text}}} {_format_value(value)}"
+                if label_text else f"{name}{suffix} {_format_value(value)}"
+            )
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUESTS = Counter(
+    "metersink_http_requests_total", "HTTP requests by endpoint and status", ("endpoint", "status"))
+MESSAGES = Counter(
+    "metersink_messages_total", "messages by stage: received, accepted, duplicate, unreadable", ("stage",))
+SINK_DELIVERIES = Counter(
+    "metersink_sink_deliveries_total", "batch deliveries per sink by result", ("sink", "result"))
+SINK_LATENCY = Histogram(
+    "metersink_sink_delivery_seconds", "time to deliver one batch to a sink", ("sink",))
+ODOO_RPCS = Counter(
+    "metersink_odoo_rpcs_total", "odoo rpc calls by url, model and method",
+    ("url", "model", "method"))
+ODOO_RPC_LATENCY = Histogram(
+    "metersink_odoo_rpc_seconds", "odoo rpc call duration by model and method",
+    ("model", "method"))
+ERRORS = Counter(
+    "metersink_errors_total", "errors by component and exception type", ("component", "type"))
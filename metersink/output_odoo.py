@@ -2,32 +2,91 @@
 Library to find odoo related functions
 """
 import logging
+import threading
+import time
 import xmlrpc.client
-from datetime import datetime
+from datetime import datetime, timedelta
 from pprint import pformat
 
 from metersink.lib import (
-    calculate_cloud_time,
+    Event,
+    get_info_from_name,
     get_name_from_info,
-    message_to_dict,
-    get_config_section,
+    parse_time,
 )
+from metersink.lifecycle import IntervalStore
+from metersink.line_index import LineEntry, LineIndex
+from metersink.cache import DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL, TTLCache
+from metersink.coalesce import DEFAULT_FLUSH_INTERVAL, WriteCoalescer
+from metersink.ledger import DEFAULT_RECONCILE_BATCH
+from metersink.metrics import ERRORS
+from metersink.rpc import get_proxy
+from metersink.tracing import span
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_SESSION_TTL = 3600.0
+SESSION_SETTINGS = {"ttl": DEFAULT_SESSION_TTL}
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+# lookups which almost never change, shared by all ingest workers and
+# keyed by (url, db, ...) of the sink
+PRODUCT_CACHE = TTLCache(name="product")
+CONTACT_CACHE = TTLCache(name="contact")
+SALE_ORDER_CACHE = TTLCache(name="sale_order")
+LOOKUP_CACHES = (PRODUCT_CACHE, CONTACT_CACHE, SALE_ORDER_CACHE)
+
+DEFAULT_INDEX_PAGE_SIZE = 500
+INDEX_SETTINGS = {"page_size": DEFAULT_INDEX_PAGE_SIZE}
+_LINE_INDEXES = {}
+_LINE_INDEXES_LOCK = threading.Lock()
+
+# the lifecycle of every resource, shared by all odoo sinks
+LIFECYCLE = IntervalStore()
+
+COALESCE_SETTINGS = {"flush_interval": DEFAULT_FLUSH_INTERVAL}
+# with a ledger the events are recorded locally and reconciled in bulk
+LEDGER_SETTINGS = {"ledger": None}
+_COALESCERS = {}
+_COALESCERS_LOCK = threading.Lock()
+# so lines odoo rejected go to the dead letters as lines:<sink>, kept
+# there for a look as the redrive has no sink of that name
+DEAD_LETTER_SETTINGS = {"store": None}
+
 
 def get_client(odoo, client="common"):
-    """returns the client"""
+    """returns a client which uses the pooled keep-alive connections of the url"""
     if "url" in odoo:
         url = odoo["url"]
     else:
         url = odoo
     if client == "models":
         client = "object"
-    client = xmlrpc.client.ServerProxy(f"{url}/xmlrpc/2/{client}")
+    client = get_proxy(url, client)
     return client
 
 
+def execute_kw(odoo, model, method, *args):
+    """
+    calls a method of an odoo model, a session odoo rejected is renewed
+    and the call is tried once more
+    """
+    models = get_client(odoo, client="models")
+    try:
+        return models.execute_kw(
+            odoo["db"], odoo["user_id"], odoo["password"], model, method, *args
+        )
+    except xmlrpc.client.Fault as exc:
+        if not is_auth_fault(exc):
+            raise
+        LOG.info("odoo session of %s was rejected, renewing it", odoo["url"])
+        renew_odoo_session(odoo)
+        return models.execute_kw(
+            odoo["db"], odoo["user_id"], odoo["password"], model, method, *args
+        )
+
+
 def get_odoo_version(url):
     """gets the odoo version"""
     try:
@@ -131,42 +190,15 @@ def odoo_get(odoo, model,
     elif mode == "count":  # returns the amount of records
         mode = "search_count"
 
-    models = get_client(odoo, client="models")
-
-    # todo make that less ugly
     if not projection_dict:
-        records = models.execute_kw(
-            odoo["db"],
-            odoo["user_id"],
-            odoo["password"],
-            model,
-            mode,
-            o_filter,
-        )
-
+        records = execute_kw(odoo, model, mode, o_filter)
     else:
-        records = models.execute_kw(
-            odoo["db"],
-            odoo["user_id"],
-            odoo["password"],
-            model,
-            mode,
-            o_filter,
-            projection_dict,
-        )
+        records = execute_kw(odoo, model, mode, o_filter, projection_dict)
 
     if not records and creation_dict and create:
         records = [odoo_create(odoo, model, [creation_dict])]
         if mode == "search_read":
-            records = models.execute_kw(
-                odoo["db"],
-                odoo["user_id"],
-                odoo["password"],
-                model,
-                "read",
-                [records],
-                projection_dict,
-            )
+            records = execute_kw(odoo, model, "read", [records], projection_dict)
     return records
 
 
@@ -194,6 +226,11 @@ def odoo_get_one(odoo, model,
 
 def odoo_get_contact_from_tag(odoo, tag_list, limit=None) -> list:
     """is looking for a res partner, that has special tags"""
+    cache_key = (odoo["url"], odoo["db"], tuple(tag_list), limit)
+    contact_list = CONTACT_CACHE.get(cache_key)
+    if contact_list:
+        return contact_list
+
     filter_list = [
         [
             ["category_id", "in", tag_list],
@@ -206,6 +243,8 @@ def odoo_get_contact_from_tag(odoo, tag_list, limit=None) -> list:
         LOG.info("No contact found for tags: %s", tag_list)
     else:
         LOG.debug("found contact: %s", pformat(contact_list))
+        # unknown projects are not cached, their contact may be added any time
+        CONTACT_CACHE.put(cache_key, contact_list)
     return contact_list
 
 
@@ -227,10 +266,7 @@ def odoo_create(odoo, model, record_list):
     """
     creates a record in odoo and returns its id
     """
-    models = get_client(odoo, client="models")
-    record_id = models.execute_kw(
-        odoo["db"], odoo["user_id"], odoo["password"], model, "create", record_list
-    )
+    record_id = execute_kw(odoo, model, "create", record_list)
     return record_id
 
 
@@ -239,19 +275,12 @@ def odoo_update(odoo, model, record_id, data_dict):
     updates an odoo record
     :param odoo:
     :param model:
-    :param record_id:
+    :param record_id: a record id or a list of record ids
     :param data_dict:
     :return: record_id
     """
-    models = get_client(odoo, client="models")
-    record_id = models.execute_kw(
-        odoo["db"],
-        odoo["user_id"],
-        odoo["password"],
-        model,
-        "write",
-        [[record_id], data_dict],
-    )
+    record_ids = record_id if isinstance(record_id, list) else [record_id]
+    record_id = execute_kw(odoo, model, "write", [record_ids, data_dict])
     return record_id
 
 
@@ -274,7 +303,8 @@ def get_odoo_partner(odoo, filter_list=None, projection_dict=None):
     """
     returns a res.partner record
     """
-    show_fields(odoo, "res.partner")
+    if LOG.isEnabledFor(logging.DEBUG):
+        show_fields(odoo, "res.partner")
 
     if not filter_list:
         filter_list = []
@@ -299,6 +329,83 @@ def setup_odoo_object(url, odoo_settings, settings_position):
     return odoo
 
 
+def configure_sessions(conf):
+    """reads the session cache settings from the [odoo] section of the config"""
+    SESSION_SETTINGS["ttl"] = conf.getfloat(
+        "odoo", "session_ttl", fallback=DEFAULT_SESSION_TTL
+    )
+
+
+def get_odoo_session(endpoint, refresh=False):
+    """
+    returns the odoo client information of an endpoint
+
+    the version probe and the authentication are done once and then cached
+    per (url, db, user) until the session_ttl expires or it is invalidated
+    """
+    key = (endpoint.url, endpoint.db, endpoint.user_name)
+    now = time.monotonic()
+    session = _SESSIONS.get(key)
+    if session and not refresh and session["expires"] > now:
+        return session["odoo"]
+
+    odoo_version = get_odoo_version(endpoint.url)
+    if not odoo_version:
+        raise xmlrpc.client.Error("The odoo endpoint could not be found.")
+    LOG.debug("Odoo version is %s", odoo_version)
+
+    odoo = {
+        "url": endpoint.url,
+        "db": endpoint.db,
+        "user_name": endpoint.user_name,
+        "password": endpoint.password,
+    }
+    odoo["user_id"] = get_odoo_user_id(odoo)
+    if not odoo["user_id"]:
+        raise xmlrpc.client.Error(f"The authentication at {endpoint.url} failed.")
+    odoo["version"] = odoo_version
+    with _SESSIONS_LOCK:
+        _SESSIONS[key] = {"odoo": odoo, "expires": now + SESSION_SETTINGS["ttl"]}
+    LOG.debug("cached odoo session for %s@%s/%s", endpoint.user_name, endpoint.url, endpoint.db)
+    return odoo
+
+
+def invalidate_odoo_session(odoo):
+    """drops the cached session of an odoo client information"""
+    key = (odoo["url"], odoo["db"], odoo["user_name"])
+    with _SESSIONS_LOCK:
+        _SESSIONS.pop(key, None)
+
+
+def renew_odoo_session(odoo):
+    """authenticates an odoo client information again, in place"""
+    invalidate_odoo_session(odoo)
+    user_id = get_odoo_user_id(odoo)
+    if not user_id:
+        raise xmlrpc.client.Error(f"The authentication at {odoo['url']} failed.")
+    odoo["user_id"] = user_id
+    key = (odoo["url"], odoo["db"], odoo["user_name"])
+    with _SESSIONS_LOCK:
+        _SESSIONS[key] = {"odoo": odoo, "expires": time.monotonic() + SESSION_SETTINGS["ttl"]}
+
+
+def is_auth_fault(exc) -> bool:
+    """tells if odoo rejected a call because of the credentials"""
+    if not isinstance(exc, xmlrpc.client.Fault):
+        return False
+    fault = str(exc.faultString)
+    return "AccessDenied" in fault or "Access Denied" in fault or "Session expired" in fault
+
+
+def warm_odoo_sessions(endpoints):
+    """fills the session cache for all configured odoo endpoints"""
+    for endpoint in endpoints:
+        try:
+            get_odoo_session(endpoint)
+        except (OSError, xmlrpc.client.Error):
+            LOG.exception("failed to set up the odoo session for %s", endpoint.url)
+
+
 def create_sale_order(odoo, customer, tag_list):
     """creates a new SO for customer with tags"""
     record_list = [
@@ -308,32 +415,146 @@ def create_sale_order(odoo, customer, tag_list):
         }
     ]
     new_id = odoo_create(odoo, "sale.order", record_list)
+    SALE_ORDER_CACHE.put((odoo["url"], odoo["db"], tuple(tag_list)), new_id)
     return new_id
 
 
-def create_sale_order_line(odoo, order_id, product_id, display_name, product_uom_qty):
-    """creates a new so line and returns its id"""
-    record_list = [
-        {
-            "order_id": order_id,
-            "product_id": product_id,
-            "display_name": display_name,
-            "product_uom_qty": product_uom_qty,
-        }
-    ]
-    new_id = odoo_create(odoo, "Sale.order.line", record_list)
+def create_sale_order_line(odoo, order_id, product_id, display_name, product_uom_qty,
+                           resource_id=None):
+    """
+    creates a new so line and returns its id, with write coalescing the
+    line is buffered under its resource_id and None is returned
+    """
+    values = {
+        "order_id": order_id,
+        "product_id": product_id,
+        "name": display_name,
+        "product_uom_qty": product_uom_qty,
+    }
+    coalescer = get_coalescer(odoo)
+    if coalescer and resource_id:
+        coalescer.create(resource_id, values)
+        return None
+    new_id = odoo_create(odoo, "sale.order.line", [values])
     return new_id
 
 
-def get_sale_order_id(odoo, tag_list):
+def update_sale_order_line(odoo, line_id, data_dict):
+    """updates a so line, buffered if write coalescing is on"""
+    coalescer = get_coalescer(odoo)
+    if coalescer:
+        coalescer.update(line_id, data_dict)
+        return line_id
+    return odoo_update(odoo, "sale.order.line", line_id, data_dict)
+
+
+def configure_coalescing(conf):
+    """reads the write coalescing settings from the [odoo] section of the config"""
+    COALESCE_SETTINGS["flush_interval"] = conf.getfloat(
+        "odoo", "flush_interval", fallback=DEFAULT_FLUSH_INTERVAL
+    )
+
+
+def get_coalescer(odoo):
+    """returns the write coalescer of an odoo sink, None if coalescing is off"""
+    if COALESCE_SETTINGS["flush_interval"] <= 0:
+        return None
+    key = (odoo["url"], odoo["db"])
+    coalescer = _COALESCERS.get(key)
+    if coalescer is None:
+        with _COALESCERS_LOCK:
+            coalescer = _COALESCERS.get(key)
+            if coalescer is None:
+                line_index = get_line_index(odoo)
+                coalescer = WriteCoalescer(
+                    odoo,
+                    create=odoo_create,
+                    write=odoo_update,
+                    flush_interval=COALESCE_SETTINGS["flush_interval"],
+                    on_created=lambda created: index_created_lines(line_index, created),
+                    on_failed=lambda lines, error: fail_lines(odoo, lines, error),
+                )
+                coalescer.start()
+                _COALESCERS[key] = coalescer
+    # write with the latest session of the sink
+    coalescer.odoo = odoo
+    return coalescer
+
+
+def index_created_lines(line_index, created):
+    """stores the ids of lines created by a coalescer flush in the line index"""
+    for resource_id, line_id in created.items():
+        entry = line_index.get(resource_id)
+        if entry:
+            line_index.put(resource_id, entry._replace(line_id=line_id))
+
+
+def set_dead_letters(store):
+    """makes the odoo sinks keep the so lines odoo rejected in a DeadLetterStore"""
+    DEAD_LETTER_SETTINGS["store"] = store
+
+
+def fail_lines(odoo, lines, error):
+    """dead-letters the values of so lines odoo did not take"""
+    ERRORS.inc("odoo", type(error).__name__, amount=len(lines))
+    store = DEAD_LETTER_SETTINGS["store"]
+    if store is None:
+        LOG.error("dropped %s so lines of %s: %s", len(lines), odoo["url"], error)
+        return
+    store.add(f"lines:{sink_key(odoo)}", lines, error)
+
+
+def odoo_written(endpoint):
+    """
+    returns a future which is done once the line writes an odoo sink
+    buffered by now are in odoo, None if it has no write coalescer
+    """
+    coalescer = _COALESCERS.get((endpoint.url, endpoint.db))
+    return coalescer.written() if coalescer else None
+
+
+def stop_coalescers():
+    """writes all buffered lines and stops the periodic flushes"""
+    with _COALESCERS_LOCK:
+        coalescers = list(_COALESCERS.values())
+        _COALESCERS.clear()
+    for coalescer in coalescers:
+        try:
+            coalescer.stop()
+        except (OSError, xmlrpc.client.Error):
+            LOG.exception("failed to flush the line writes to %s", coalescer.odoo["url"])
+
+
+def coalescer_stats() -> dict:
+    """returns the write coalescing statistics by odoo url and db"""
+    with _COALESCERS_LOCK:
+        coalescers = dict(_COALESCERS)
+    return {f"{url}/{db}": coalescer.stats() for (url, db), coalescer in coalescers.items()}
+
+
+def get_sale_order_id(odoo, tag_list, plan=None):
     """
     Returns the id of a Sale_order to further work on if the Customer is known.
     Else it gives nothing back.
     """
     # project_tag = f"project={project_id}"
+    cache_key = (odoo["url"], odoo["db"], tuple(tag_list))
+    sale_order_id = SALE_ORDER_CACHE.get(cache_key)
+    if sale_order_id:
+        return sale_order_id
 
-    [customer] = odoo_get_contact_from_tag(odoo, tag_list, limit=1)
-    if customer:
+    if plan and plan.covers(odoo) and len(tag_list) == 1 and tag_list[0] in plan.contacts:
+        # the batch was planned, only a missing sale order is left to create
+        customer = plan.contacts[tag_list[0]]
+        sale_order_id = plan.sale_orders.get(tag_list[0])
+        if customer and not sale_order_id:
+            sale_order_id = create_sale_order(odoo, customer, tag_list)
+            plan.sale_orders[tag_list[0]] = sale_order_id
+        return sale_order_id
+
+    contact_list = odoo_get_contact_from_tag(odoo, tag_list, limit=1)
+    if contact_list:
+        customer = contact_list[0]
         LOG.debug("%s", pformat(customer))
         LOG.debug("%s", customer["sale_order_ids"])
 
@@ -356,6 +577,8 @@ def get_sale_order_id(odoo, tag_list):
         if not sale_order_id:
             # create new sale order
             sale_order_id = create_sale_order(odoo, customer, tag_list)
+        else:
+            SALE_ORDER_CACHE.put(cache_key, sale_order_id)
         return sale_order_id
     return None
 
@@ -393,25 +616,166 @@ def get_sale_order_lines(odoo, o_filter, create=False, limit=None):
 def get_sale_order_line(odoo, o_filter, create=False):
     """returns a single sale_order_line"""
     sale_order_lines = get_sale_order_lines(odoo, o_filter, create=create, limit=1)
-    return sale_order_lines[0]
+    if sale_order_lines:
+        return sale_order_lines[0]
+    return None
 
 
-def get_product_id(odoo, product_name, create=True):
+def get_product_id(odoo, product_name, create=True, plan=None):
     """this is looking for the corresponding product_id in odoo"""
-    product_id = odoo_get_one(odoo,
-                              "res.product",
-                              mode="ids",
-                              o_filter=[["display_name", "=", product_name]],
-                              )
+    cache_key = (odoo["url"], odoo["db"], product_name)
+    product_id = PRODUCT_CACHE.get(cache_key)
+    if product_id:
+        return product_id
+
+    if plan and plan.covers(odoo) and product_name in plan.products:
+        # the batch was planned and the product is missing
+        product_id = plan.products[product_name]
+    else:
+        product_id = odoo_get_one(odoo,
+                                  "res.product",
+                                  mode="ids",
+                                  o_filter=[["display_name", "=", product_name]],
+                                  )
     if not product_id and create:
         product_id = odoo_create(odoo, "res.product", [
             {"display_name": product_name}
         ])
-    else:
+    elif not product_id:
         LOG.debug("There is no product %s", product_name)
+    if product_id:
+        PRODUCT_CACHE.put(cache_key, product_id)
+        if plan and plan.covers(odoo):
+            plan.products[product_name] = product_id
     return product_id
 
 
+def get_line_index(odoo) -> LineIndex:
+    """returns the resource uuid to so line index of an odoo sink"""
+    key = (odoo["url"], odoo["db"])
+    line_index = _LINE_INDEXES.get(key)
+    if line_index is None:
+        with _LINE_INDEXES_LOCK:
+            line_index = _LINE_INDEXES.setdefault(key, LineIndex())
+    return line_index
+
+
+def line_record_to_entry(line_record):
+    """
+    returns (uuid, LineEntry) from a so line record or None if its name
+    is not one of ours
+    """
+    info = get_info_from_name(line_record.get("name") or "")
+    if not info:
+        return None
+    order_id = line_record["order_id"]
+    product_id = line_record["product_id"]
+    start = parse_time(info["start"])
+    end = parse_time(info["end"])
+    if line_record.get("product_uom_qty"):
+        # the quantity is the billed runtime in minutes since the start
+        end = start + timedelta(minutes=line_record["product_uom_qty"])
+    entry = LineEntry(
+        line_id=line_record["id"],
+        # many2one fields are read as [id, name]
+        order_id=order_id[0] if isinstance(order_id, list) else order_id,
+        product_id=product_id[0] if isinstance(product_id, list) else product_id,
+        start=start,
+        end=end,
+    )
+    return info["uuid"], entry
+
+
+def warm_line_index(odoo, page_size=None) -> LineIndex:
+    """fills the line index of a sink with the lines of all open sale orders"""
+    page_size = page_size or INDEX_SETTINGS["page_size"]
+    line_index = get_line_index(odoo)
+    o_filter = [[["order_id.state", "in", ["draft", "sent", "sale"]]]]
+    offset = 0
+    entries = []
+    while True:
+        projection_dict = {
+            "fields": ["id", "name", "order_id", "product_id", "product_uom_qty"],
+            "limit": page_size,
+            "offset": offset,
+            "order": "id",
+        }
+        line_records = odoo_get(odoo, "sale.order.line",
+                                mode="records",
+                                o_filter=o_filter,
+                                projection_dict=projection_dict,
+                                )
+        for line_record in line_records:
+            uuid_entry = line_record_to_entry(line_record)
+            if uuid_entry:
+                entries.append(uuid_entry)
+        if len(line_records) < page_size:
+            break
+        offset += page_size
+    line_index.load(entries)
+    LOG.info("indexed %s so lines of %s", len(entries), odoo["url"])
+    return line_index
+
+
+def warm_line_indexes(endpoints):
+    """fills the line index of all configured odoo endpoints"""
+    for endpoint in endpoints:
+        try:
+            warm_line_index(get_odoo_session(endpoint))
+        except (OSError, xmlrpc.client.Error):
+            LOG.exception("failed to index the so lines of %s", endpoint.url)
+
+
+def find_line_entry(odoo, sale_order_id, product_id, resource_id):
+    """looks up the so line of a resource in odoo, for a line index which is not warm"""
+    o_filter = [[
+        ["order_id", "=", sale_order_id],
+        ["product_id", "=", product_id],
+        ["name", "=like", f"{resource_id}%"],
+    ]]
+    line_record = get_sale_order_line(odoo, o_filter, create=False)
+    if not line_record:
+        return None
+    LOG.debug("%s", pformat(line_record))
+    uuid_entry = line_record_to_entry(line_record)
+    return uuid_entry[1] if uuid_entry else None
+
+
+def lifecycle_stats() -> dict:
+    """returns the event counters of the resource lifecycle"""
+    return LIFECYCLE.stats()
+
+
+def line_index_stats() -> dict:
+    """returns the line index statistics by odoo url and db"""
+    with _LINE_INDEXES_LOCK:
+        line_indexes = dict(_LINE_INDEXES)
+    return {f"{url}/{db}": line_index.stats() for (url, db), line_index in line_indexes.items()}
+
+
+def configure_caches(conf):
+    """reads the lookup cache settings from the [odoo] section of the config"""
+    maxsize = conf.getint("odoo", "cache_size", fallback=DEFAULT_CACHE_SIZE)
+    ttl = conf.getfloat("odoo", "cache_ttl", fallback=DEFAULT_CACHE_TTL)
+    INDEX_SETTINGS["page_size"] = conf.getint(
+        "odoo", "index_page_size", fallback=DEFAULT_INDEX_PAGE_SIZE
+    )
+    for cache in LOOKUP_CACHES:
+        cache.configure(maxsize, ttl)
+
+
+def invalidate_caches(odoo=None):
+    """drops the cached lookups of one odoo sink or of all sinks"""
+    prefix = (odoo["url"], odoo["db"]) if odoo else None
+    for cache in LOOKUP_CACHES:
+        cache.invalidate(prefix=prefix)
+
+
+def cache_stats() -> dict:
+    """returns the hit and miss counters of the lookup caches"""
+    return {cache.name: cache.stats() for cache in LOOKUP_CACHES}
+
+
 def is_supported() -> tuple:
     """
     this returns a tuple of supported resources
@@ -427,116 +791,450 @@ def is_supported() -> tuple:
     return supported_resources
 
 
-def odoo_handle_os_resource(odoo, data):
-    """
-    reads and writes into odoo sale-order
-    """
-    if LOG.isEnabledFor(logging.DEBUG):
-        show_fields(odoo, "sale.order")
-        show_fields(odoo, "sale.order.line")
-
-    project_id = data["traits"]["project_id"]
-    tag_list = [f"project={project_id}"]
-    sale_order_id = get_sale_order_id(odoo, tag_list)
-    LOG.debug("so id %s", sale_order_id)
-
+def get_product_and_size(data) -> tuple:
+    """returns the product name and the size or flavor of an Event"""
     product_name = "noname"
-    value_list = []
+    size = None
 
-    if data["event_type"].startswith("volume"):
+    if data.event_type.startswith("volume"):
         product_name = "volume"
-        value_list = [str(data["traits"]["size"])]
-    elif data["event_type"].startswith("compute"):
+        size = str(data.size)
+    elif data.event_type.startswith("compute"):
         product_name = "compute"
-        value_list = [data["traits"]["flavor_name"]]
-    elif data["event_type"].startswith("image"):
+        size = data.flavor_name
+    elif data.event_type.startswith("image"):
         # todo to be implemented
         # image.send
         pass
-    elif data["event_type"].startswith("scheduler"):
+    elif data.event_type.startswith("scheduler"):
         # todo to be implemented
         # scheduler.select_destinations.start
         # scheduler.select_destinations.end
         pass
-    elif data["event_type"].startswith("port"):
+    elif data.event_type.startswith("port"):
         # todo to be implemented
         # port.create.start
         # port.create.end
         # port.update.start
         # port.update.end
         pass
+    return product_name, size
+
+
+class BatchPlan:
+    """
+    the partners, sale orders, products and so lines of the events of a
+    batch, looked up with one search_read per model. None marks a record
+    which odoo does not have.
+    """
+
+    def __init__(self, odoo):
+        self.key = (odoo["url"], odoo["db"])
+        # by project tag
+        self.contacts = {}
+        self.sale_orders = {}
+        # by product name
+        self.products = {}
+        # resource uuids without a so line
+        self.lines = set()
+
+    def covers(self, odoo) -> bool:
+        """tells if the plan was made for an odoo sink"""
+        return self.key == (odoo["url"], odoo["db"])
+
+
+def _many2one_id(value):
+    # many2one fields are read as [id, name]
+    return value[0] if isinstance(value, list) else value
+
+
+def _partner_tags(odoo, partners, tags) -> dict:
+    """returns the first partner of every tag in tags"""
+    category_ids = {value for partner in partners for value in partner.get("category_id") or []
+                    if isinstance(value, int)}
+    names = {}
+    if category_ids:
+        # many2many fields are read as ids
+        names = {
+            category["id"]: category["name"]
+            for category in odoo_get(odoo, "res.partner.category", mode="read",
+                                     o_filter=[sorted(category_ids)],
+                                     projection_dict={"fields": ["id", "name"]})
+        }
+    contacts = {}
+    for partner in sorted(partners, key=lambda record: record["id"]):
+        for value in partner.get("category_id") or []:
+            tag = names.get(value, value)
+            if tag in tags:
+                contacts.setdefault(tag, partner)
+    return contacts
+
 
-    product_id = get_product_id(odoo, product_name)
-    end_date = datetime.now()
-    time_calc = calculate_cloud_time(
-        data["traits"]["created_at"], end_date
+def plan_batch(odoo, messages) -> BatchPlan:
+    """
+    looks up what the events of a batch need and is not cached, one
+    search_read per model with in domains. found records go into the
+    caches and the line index, the plan keeps the missing ones.
+    """
+    tags = set()
+    product_names = set()
+    resource_ids = set()
+    for data in messages:
+        if not isinstance(data, Event) or not data.event_type.startswith(is_supported()):
+            continue
+        tags.add(f"project={data.project_id}")
+        product_names.add(get_product_and_size(data)[0])
+        resource_ids.add(data.resource_id)
+    return plan_lookups(odoo, tags, product_names, resource_ids)
+
+
+def plan_lookups(odoo, tags, product_names, resource_ids) -> BatchPlan:
+    """the lookups of plan_batch by project tag, product name and resource uuid"""
+    plan = BatchPlan(odoo)
+    url, db = plan.key
+
+    tags = {tag for tag in tags if not SALE_ORDER_CACHE.get((url, db, (tag,)))}
+    if tags:
+        partners = get_odoo_partner(
+            odoo,
+            filter_list=[[["category_id", "in", sorted(tags)]]],
+            projection_dict=get_projection_dict(model="res.partner"),
+        )
+        contacts = _partner_tags(odoo, partners, tags)
+        for tag in tags:
+            plan.contacts[tag] = contacts.get(tag)
+            if tag in contacts:
+                CONTACT_CACHE.put((url, db, (tag,), 1), [contacts[tag]])
+        orders = {}
+        if contacts:
+            for order in odoo_get(odoo, "sale.order", mode="records",
+                                  o_filter=[[["customer_id", "in", sorted(
+                                      {contact["id"] for contact in contacts.values()})]]],
+                                  projection_dict={"fields": ["id", "customer_id"],
+                                                   "order": "id"}):
+                orders.setdefault(_many2one_id(order["customer_id"]), order["id"])
+        for tag, contact in contacts.items():
+            plan.sale_orders[tag] = orders.get(contact["id"])
+            if plan.sale_orders[tag]:
+                SALE_ORDER_CACHE.put((url, db, (tag,)), plan.sale_orders[tag])
+
+    product_names = {name for name in product_names if not PRODUCT_CACHE.get((url, db, name))}
+    if product_names:
+        products = odoo_get(odoo, "res.product", mode="records",
+                            o_filter=[[["display_name", "in", sorted(product_names)]]],
+                            projection_dict={"fields": ["id", "display_name"]})
+        for product in sorted(products, key=lambda record: record["id"]):
+            plan.products.setdefault(product["display_name"], product["id"])
+        for name in product_names:
+            plan.products.setdefault(name, None)
+            if plan.products[name]:
+                PRODUCT_CACHE.put((url, db, name), plan.products[name])
+
+    line_index = get_line_index(odoo)
+    if not line_index.warm:
+        resource_ids = {resource_id for resource_id in resource_ids
+                        if line_index.get(resource_id) is None}
+    else:
+        resource_ids = set()
+    if resource_ids:
+        # the names of our lines start with the resource uuid
+        domain = ["|"] * (len(resource_ids) - 1) + [
+            ["name", "=like", f"{resource_id}%"] for resource_id in sorted(resource_ids)
+        ]
+        line_records = odoo_get(odoo, "sale.order.line", mode="records", o_filter=[domain],
+                                projection_dict={"fields": ["id", "name", "order_id",
+                                                            "product_id", "product_uom_qty"]})
+        for line_record in line_records:
+            uuid_entry = line_record_to_entry(line_record)
+            if uuid_entry and uuid_entry[0] in resource_ids:
+                line_index.put(*uuid_entry)
+                resource_ids.discard(uuid_entry[0])
+        plan.lines = resource_ids
+    return plan
+
+
+def plan_odoo_batch(endpoint, messages):
+    """
+    returns the BatchPlan of messages for an odoo sink, None if the lookups
+    failed and every message has to look up its records itself
+    """
+    if LEDGER_SETTINGS["ledger"]:
+        # the events only go into the ledger, the reconcile plans its own lookups
+        return None
+    try:
+        return plan_batch(get_odoo_session(endpoint), messages)
+    except (OSError, xmlrpc.client.Error) as exc:
+        LOG.warning("failed to look up the records of a batch at %s: %s", endpoint.url, exc)
+        return None
+
+
+def odoo_handle_os_resource(odoo, data, plan=None):
+    """
+    reads and writes into odoo sale-order, with the records of a BatchPlan
+    if the batch of the message was planned
+    """
+    if LOG.isEnabledFor(logging.DEBUG):
+        show_fields(odoo, "sale.order")
+        show_fields(odoo, "sale.order.line")
+
+    ledger = LEDGER_SETTINGS["ledger"]
+    if ledger:
+        with span("ledger"):
+            record_in_ledger(odoo, data, ledger)
+        return
+
+    project_id = data.project_id
+    tag_list = [f"project={project_id}"]
+    # the contact lookup is part of finding the sale order
+    with span("sale_order"):
+        sale_order_id = get_sale_order_id(odoo, tag_list, plan=plan)
+    LOG.debug("so id %s", sale_order_id)
+    if not sale_order_id:
+        # odoo rejects a line without an order, and with the coalescer
+        # the lines buffered next to it
+        ERRORS.inc("odoo", "NoSaleOrder")
+        LOG.warning("skipping event %s of %s: no sale order for project %s in %s",
+                    data.message_id, data.resource_id, project_id, odoo["url"])
+        return
+
+    product_name, size = get_product_and_size(data)
+
+    with span("product"):
+        product_id = get_product_id(odoo, product_name, plan=plan)
+    if not product_id:
+        ERRORS.inc("odoo", "NoProduct")
+        LOG.warning("skipping event %s of %s: no product %s in %s",
+                    data.message_id, data.resource_id, product_name, odoo["url"])
+        return
+    resource_id = data.resource_id
+    line_index = get_line_index(odoo)
+    with span("line"):
+        entry = line_index.get(resource_id)
+        if entry is None and not line_index.warm and not (plan and resource_id in plan.lines):
+            entry = find_line_entry(odoo, sale_order_id, product_id, resource_id)
+
+    # the runtime grows by the intervals closed since the last event
+    usage = LIFECYCLE.apply(
+        resource_id,
+        data.event_type,
+        data.generated or datetime.now(),
+        size,
+        created_at=data.created_at,
+        message_id=data.message_id,
+        billed=(entry.start, entry.end) if entry else None,
     )
+    end_date = usage.end
+    time_calc = usage.minutes
 
     info_dict = {
-        "uuid": data["traits"]["resource_id"],
-        "name": data["traits"]["display_name"],
-        "values": value_list,
-        "start": data["traits"]["created_at"],
+        "uuid": resource_id,
+        "name": data.display_name,
+        # every flavor or size the resource had
+        "values": list(usage.sizes),
+        "start": usage.start,
         "end": end_date,
     }
     display_name = get_name_from_info(info_dict)
 
-    o_filter = {
-        "order_id": sale_order_id,
-        "prodict_id": product_id,
-    }
-
-    line_record = get_sale_order_line(odoo, o_filter, create=False)
-    if line_record:
-        # we are reading the last state of the line and
-        # calculate the time between this line and the update message.
-        LOG.debug("%s", pformat(line_record))
-        time_calc = calculate_cloud_time(line_record["name"])
-
-        odoo_update(
-            odoo,
-            "sale.order.line",
-            line_record["id"],
-            {"product_uom_qty": time_calc},
-        )
+    coalescer = get_coalescer(odoo)
+    if coalescer:
+        values = {"name": display_name, "product_uom_qty": time_calc}
+        if coalescer.update_pending(resource_id, values):
+            # the line of the resource is still waiting to be created
+            line_index.update_end(resource_id, end_date)
+            return
+        # a flush may have created the line since it was looked up
+        entry = line_index.get(resource_id) or entry
+
+    if entry and entry.line_id:
+        with span("update"):
+            update_sale_order_line(
+                odoo,
+                entry.line_id,
+                {"name": display_name, "product_uom_qty": time_calc},
+            )
+        line_index.put(resource_id, entry._replace(end=end_date))
 
     else:
         # If there is no line already for the ressource, create it.
-        line_id = create_sale_order_line(odoo,
-                                         sale_order_id,
-                                         product_id,
-                                         display_name,
-                                         time_calc,
-                                         )
+        with span("create"):
+            line_id = create_sale_order_line(odoo,
+                                             sale_order_id,
+                                             product_id,
+                                             display_name,
+                                             time_calc,
+                                             resource_id=resource_id,
+                                             )
         LOG.debug("%s", line_id)
+        line_index.put(resource_id, LineEntry(
+            line_id=line_id,
+            order_id=sale_order_id,
+            product_id=product_id,
+            start=usage.start,
+            end=end_date,
+        ))
+
+
+def sink_key(odoo) -> str:
+    """returns the name of an odoo sink in the stats and the ledger"""
+    return f"{odoo['url']}/{odoo['db']}"
+
+
+def set_ledger(ledger):
+    """makes the odoo sinks record into a UsageLedger, None writes to odoo directly"""
+    LEDGER_SETTINGS["ledger"] = ledger
+
+
+def record_in_ledger(odoo, data, ledger):
+    """applies an event to the lifecycle and records the usage in the ledger"""
+    resource_id = data.resource_id
+    product_name, size = get_product_and_size(data)
+    billed = None
+    if LIFECYCLE.get(resource_id) is None:
+        # first seen since the start, continue after what was billed
+        entry = get_line_index(odoo).get(resource_id)
+        billed = (entry.start, entry.end) if entry else ledger.billed(sink_key(odoo),
+                                                                      resource_id)
+    usage = LIFECYCLE.apply(
+        resource_id,
+        data.event_type,
+        data.generated or datetime.now(),
+        size,
+        created_at=data.created_at,
+        message_id=data.message_id,
+        billed=billed,
+    )
+    ledger.record(sink_key(odoo), data, product_name, usage)
 
 
-def odoo_handle(odoo_sinks, conf, data):
+def reconcile_odoo(odoo, ledger, limit=DEFAULT_RECONCILE_BATCH) -> int:
     """
-    handle multiple odoo instances and pipeline events and polling
+    writes the totals of the dirty resources of the ledger into the so
+    lines of an odoo sink, limit resources at a time with one lookup per
+    model, one create for the new lines and one write per distinct values.
+    a resource without a sale order or product, or whose line odoo
+    rejects, is flagged unresolved instead. returns the number of
+    reconciled resources.
     """
-    for index, sink_name in enumerate(odoo_sinks["name"]):
-        odoo_version = get_odoo_version(sink_name)
-        if not odoo_version:
-            raise xmlrpc.client.Error("The odoo endpoint could not be found.")
-        LOG.debug("Odoo version is %s", odoo_version)
-        odoo_conf = get_config_section(conf, section="odoo")
+    name = sink_key(odoo)
+    line_index = get_line_index(odoo)
+    reconciled = 0
+    while True:
+        totals, version = ledger.dirty(name, limit=limit)
+        if not totals:
+            break
+        plan = plan_lookups(
+            odoo,
+            {f"project={total.project_id}" for total in totals},
+            {total.product for total in totals},
+            {total.resource_id for total in totals},
+        )
+        unresolved = {}
+        line_resources = {}
 
-        odoo = setup_odoo_object(sink_name, odoo_conf, index)
+        def on_failed(lines, error):
+            for line in lines:
+                resource_id = line.get("key") or line_resources.get(line.get("id"))
+                unresolved[resource_id] = f"{type(error).__name__}: {error}"
+
+        writes = WriteCoalescer(
+            odoo,
+            create=odoo_create,
+            write=odoo_update,
+            on_created=lambda created: index_created_lines(line_index, created),
+            on_failed=on_failed,
+        )
+        for total in totals:
+            display_name = get_name_from_info({
+                "uuid": total.resource_id,
+                "name": total.display_name,
+                "values": list(total.sizes),
+                "start": total.start,
+                "end": total.end,
+            })
+            entry = line_index.get(total.resource_id)
+            if entry and entry.line_id:
+                line_resources[entry.line_id] = total.resource_id
+                writes.update(entry.line_id, {"name": display_name,
+                                              "product_uom_qty": total.minutes})
+                line_index.put(total.resource_id, entry._replace(end=total.end))
+                continue
+            sale_order_id = get_sale_order_id(odoo, [f"project={total.project_id}"], plan=plan)
+            product_id = get_product_id(odoo, total.product, plan=plan)
+            if not sale_order_id or not product_id:
+                unresolved[total.resource_id] = (
+                    f"no sale order for project {total.project_id}" if not sale_order_id
+                    else f"no product {total.product}")
+                continue
+            writes.create(total.resource_id, {
+                "order_id": sale_order_id,
+                "product_id": product_id,
+                "name": display_name,
+                "product_uom_qty": total.minutes,
+            })
+            line_index.put(total.resource_id, LineEntry(
+                line_id=None,
+                order_id=sale_order_id,
+                product_id=product_id,
+                start=total.start,
+                end=total.end,
+            ))
+        # raises if odoo could not be reached, the resources stay dirty
+        writes.flush()
+        if unresolved:
+            LOG.warning("could not reconcile %s resources with %s, e.g. %s: %s",
+                        len(unresolved), odoo["url"], *next(iter(unresolved.items())))
+            ledger.flag_unresolved(name, unresolved)
+        synced = [total.resource_id for total in totals if total.resource_id not in unresolved]
+        ledger.mark_synced(name, synced, version)
+        reconciled += len(synced)
+        if len(totals) < limit:
+            break
+    if reconciled:
+        LOG.info("reconciled %s resources with %s", reconciled, odoo["url"])
+    return reconciled
+
+
+def reconcile_ledger(ledger, endpoints, limit=DEFAULT_RECONCILE_BATCH):
+    """reconciles the ledger with every odoo sink, a failed sink is tried next time"""
+    for endpoint in endpoints:
+        try:
+            reconcile_odoo(get_odoo_session(endpoint), ledger, limit=limit)
+        except (OSError, xmlrpc.client.Error) as exc:
+            LOG.warning("failed to reconcile the ledger with %s: %s", endpoint.url, exc)
+
+
+def odoo_handle(endpoints, data, plan=None):
+    """
+    handle multiple odoo instances and pipeline events and polling,
+    events come as Event, the other messages as dicts
+    """
+    for endpoint in endpoints:
+        with span("session"):
+            odoo = get_odoo_session(endpoint)
 
-        data = message_to_dict(data)
         supported_resources = is_supported()
 
-        if data.get("event_type"):
-            LOG.debug("### Event %s", data["event_type"])
+        if isinstance(data, Event):
+            LOG.debug("### Event %s", data.event_type)
 
-            if data["event_type"].startswith(supported_resources):
-                odoo_handle_os_resource(odoo, data)
+            if data.event_type.startswith(supported_resources):
+                # a rejected session is renewed by the single call, a retry of
+                # the whole event would create its records twice
+                odoo_handle_os_resource(odoo, data, plan=plan)
             else:
-                LOG.info("### Event %s is not supported", data["event_type"])
+                LOG.info("### Event %s is not supported", data.event_type)
+
+        elif data.get("event_type"):
+            # messages_to_events reads the events, this one could not be read
+            LOG.warning("### Event %s can not be read", data.get("message_id"))
+
+        elif data.get("usage"):
+            # rolled up by metersink.aggregate, not mapped to products yet
+            LOG.debug("### Usage %s of %s", data["meter"], data["resource_id"])
 
         else:
-            LOG.debug("### Polling %s", data["name"])
+            LOG.debug("### Polling %s", data.get("counter_name", data.get("name")))
             # todo to be implemented
             # polling in observed chronological order
             # image.serve
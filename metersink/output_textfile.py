@@ -1,6 +1,284 @@
+"""
+json lines file sink with buffering, rotation and compression
+"""
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from datetime import datetime
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for compression = zstd
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+DEFAULT_FLUSH_INTERVAL = 1.0
+COMPRESSIONS = ("none", "gzip", "zstd")
+COMPRESSED_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+FILE_SETTINGS = {
+    "buffer_size": DEFAULT_BUFFER_SIZE,
+    "flush_interval": DEFAULT_FLUSH_INTERVAL,
+    "fsync": False,
+    "rotate_size": 0,
+    "rotate_interval": 0.0,
+    "compression": "gzip",
+}
+
+# set in the worker processes of the multi-process mode, which write
+# their own files next to each other
+WORKER_SETTINGS = {"suffix": ""}
+
+_WRITERS = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def encode_message(data) -> bytes:
+    """returns a message as one json line"""
+    return json.dumps(data, separators=(",", ":"), default=str).encode("utf-8") + b"\n"
+
+
+def compress_file(path, compression) -> str:
+    """compresses a closed segment next to it and removes the original"""
+    if compression == "none":
+        return path
+    target = path + COMPRESSED_SUFFIXES[compression]
+    tmp_target = target + ".tmp"
+    with open(path, "rb") as source:
+        if compression == "gzip":
+            with gzip.open(tmp_target, "wb") as destination:
+                shutil.copyfileobj(source, destination)
+        else:
+            with open(tmp_target, "wb") as destination:
+                zstandard.ZstdCompressor().copy_stream(source, destination)
+    os.replace(tmp_target, target)
+    os.remove(path)
+    return target
+
+
+class JsonLinesWriter:
+    """
+    a long-lived writer of one file sink
+
+    messages are buffered and written when the buffer is full, every
+    flush_interval seconds or when a caller needs them on disk. the file
+    is rotated by size or age and the closed segments are compressed.
+    """
+
+    def __init__(self, path,
+                 buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 fsync=False,
+                 rotate_size=0,
+                 rotate_interval=0.0,
+                 compression="gzip",
+                 ):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.rotate_size = rotate_size
+        self.rotate_interval = rotate_interval
+        self.compression = compression
+        self._buffer = bytearray()
+        self._lock = threading.Lock()
+        self._file = None
+        self._opened = 0.0
+        self._stop = threading.Event()
+        self._compressors = []
+        self._stats = {"messages": 0, "flushes": 0, "bytes": 0, "rotations": 0}
+        self._open()
+        self._thread = threading.Thread(
+            target=self._run, name=f"file-sink-{path}", daemon=True
+        )
+        self._thread.start()
+
+    def _open(self):
+        self._file = open(self.path, "ab")
+        # an existing file counts from now on, not from its creation
+        self._opened = time.monotonic()
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError:
+                LOG.exception("failed to flush the file sink %s", self.path)
+
+    def write(self, data):
+        """buffers one message"""
+        self.write_batch((data,))
+
+    def write_batch(self, batch, durable=False, progress=None):
+        """
+        buffers messages, with durable they are on disk when it returns.
+        progress counts them as taken once they are buffered, with durable
+        once they are on disk. a durable write which fails takes its
+        messages out of the buffer again for the retry, a buffered flush
+        leaves them there for the next one
+        """
+        lines = b"".join(encode_message(data) for data in batch)
+        with self._lock:
+            self._buffer += lines
+            if durable:
+                try:
+                    self._flush()
+                except OSError:
+                    if lines and self._buffer.endswith(lines):
+                        del self._buffer[-len(lines):]
+                    raise
+            elif len(self._buffer) >= self.buffer_size:
+                self._flush()
+            self._stats["messages"] += len(batch)
+            if progress is not None:
+                progress.delivered += len(batch)
+
+    def flush(self):
+        """writes the buffer to the file"""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._stats["flushes"] += 1
+            self._stats["bytes"] += len(self._buffer)
+            self._buffer.clear()
+        if self._due():
+            self._rotate()
+
+    def _due(self) -> bool:
+        if self.rotate_size and self._file.tell() >= self.rotate_size:
+            return True
+        if self.rotate_interval and self._file.tell():
+            return time.monotonic() - self._opened >= self.rotate_interval
+        return False
+
+    def _rotate(self):
+        self._file.close()
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        closed = f"{self.path}.{stamp}"
+        number = 1
+        while os.path.exists(closed) or any(
+            os.path.exists(closed + suffix) for suffix in COMPRESSED_SUFFIXES.values()
+        ):
+            closed = f"{self.path}.{stamp}-{number}"
+            number += 1
+        os.replace(self.path, closed)
+        self._open()
+        self._stats["rotations"] += 1
+        LOG.info("rotated the file sink %s to %s", self.path, closed)
+        if self.compression != "none":
+            thread = threading.Thread(target=self._compress, args=(closed,), daemon=True)
+            thread.start()
+            self._compressors = [t for t in self._compressors if t.is_alive()] + [thread]
+
+    def _compress(self, path):
+        try:
+            compress_file(path, self.compression)
+        except OSError:
+            LOG.exception("failed to compress %s", path)
+
+    def close(self):
+        """writes what is buffered and closes the file"""
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            self._flush()
+            self._file.close()
+        for thread in self._compressors:
+            thread.join()
+
+    def stats(self) -> dict:
+        """returns the write counters and the buffered bytes"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._buffer)
+        return stats
+
+
+def configure_file_sinks(conf, worker=None):
+    """
+    reads the writer settings from the [file] section of the config, the
+    files of a worker process get its number as suffix
+    """
+    section = "file"
+    compression = conf.get(section, "compression", fallback="gzip")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"[file] compression must be one of {', '.join(COMPRESSIONS)}")
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("[file] compression = zstd needs the zstandard package")
+    FILE_SETTINGS.update({
+        "buffer_size": conf.getint(section, "buffer_size", fallback=DEFAULT_BUFFER_SIZE),
+        "flush_interval": conf.getfloat(
+            section, "flush_interval", fallback=DEFAULT_FLUSH_INTERVAL),
+        "fsync": conf.getboolean(section, "fsync", fallback=False),
+        "rotate_size": conf.getint(section, "rotate_size", fallback=0),
+        "rotate_interval": conf.getfloat(section, "rotate_interval", fallback=0.0),
+        "compression": compression,
+    })
+    WORKER_SETTINGS["suffix"] = "" if worker is None else f".{worker}"
+
+
+def get_writer(path) -> JsonLinesWriter:
+    """returns the writer of a file sink, opens it on first use"""
+    writer = _WRITERS.get(path)
+    if writer is None:
+        with _WRITERS_LOCK:
+            writer = _WRITERS.get(path)
+            if writer is None:
+                writer = JsonLinesWriter(path + WORKER_SETTINGS["suffix"], **FILE_SETTINGS)
+                _WRITERS[path] = writer
+    return writer
+
+
+def close_file_sinks():
+    """flushes and closes all file sinks"""
+    with _WRITERS_LOCK:
+        writers = list(_WRITERS.values())
+        _WRITERS.clear()
+    for writer in writers:
+        writer.close()
+
+
+def file_sink_stats() -> dict:
+    """returns the write counters of every file sink"""
+    with _WRITERS_LOCK:
+        writers = dict(_WRITERS)
+    return {path: writer.stats() for path, writer in writers.items()}
+
+
+def open_segment(path):
+    """opens a file of a file sink for reading, rotated segments may be compressed"""
+    if path.endswith(COMPRESSED_SUFFIXES["gzip"]):
+        return gzip.open(path, "rb")
+    if path.endswith(COMPRESSED_SUFFIXES["zstd"]):
+        if zstandard is None:
+            raise ValueError(f"reading {path} needs the zstandard package")
+        # the zstd reader has no lines of its own
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+    return open(path, "rb")
+
+
 def output_file(path, data):
-    with open(path, "a") as file:
-        file.write(f"{data}\n")
+    """puts one message as json line into a file sink"""
+    get_writer(path).write(data)
+
+
+def output_file_batch(path, batch, durable=False, progress=None):
+    """puts messages as json lines into a file sink"""
+    get_writer(path).write_batch(batch, durable=durable, progress=progress)
 
 
 def output(sink, **kwargs):
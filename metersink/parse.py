@@ -0,0 +1,327 @@
+"""
+incremental decoding of posted batches, element by element
+"""
+import codecs
+import json
+import re
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+JSON_TYPES = ("application/json",)
+NDJSON_TYPES = ("application/x-ndjson", "application/ndjson", "application/jsonl")
+ENCODINGS = ("identity", "gzip", "x-gzip", "deflate")
+
+_WHITESPACE = " \t\n\r"
+# the characters which open, close or escape within a json value
+_STRUCTURE = re.compile(r'[][{}"\\]')
+_SCALAR_END = re.compile(r"[],}\s]")
+
+
+class ParseError(ValueError):
+    """the body is no valid batch"""
+
+
+class UnsupportedFormat(ParseError):
+    """the content type or encoding of the body is not supported"""
+
+
+class TooLarge(ParseError):
+    """the body or one of its messages is larger than allowed"""
+
+
+def _is_zlib(chunk) -> bool:
+    """tells a zlib header from the start of a raw deflate stream"""
+    return chunk[0] & 0x0F == 8 and (chunk[0] << 8 | chunk[1]) % 31 == 0
+
+
+def iter_chunks(stream, encoding="identity", chunk_size=CHUNK_SIZE, max_body=0):
+    """
+    reads a body stream and yields its decompressed chunks, raises
+    TooLarge once they add up to more than max_body bytes if it is set
+    """
+    encoding = (encoding or "identity").strip().lower()
+    if encoding not in ENCODINGS:
+        raise UnsupportedFormat(f"Content-Encoding {encoding} not supported")
+    decompressor = None
+    if encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    head = b""
+    size = 0
+
+    def counted(chunk):
+        nonlocal size
+        size += len(chunk)
+        if max_body and size > max_body:
+            raise TooLarge(f"the body is larger than {max_body} bytes")
+        return chunk
+
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            if head:
+                raise ParseError(f"truncated {encoding} body")
+            break
+        if encoding == "deflate" and decompressor is None:
+            # deflate is meant to be zlib wrapped, some clients send it raw
+            chunk = head = head + chunk
+            if len(head) < 2:
+                continue
+            wbits = zlib.MAX_WBITS if _is_zlib(head) else -zlib.MAX_WBITS
+            decompressor = zlib.decompressobj(wbits=wbits)
+            head = b""
+        if decompressor is None:
+            yield counted(chunk)
+            continue
+        # a small compressed chunk may inflate to a lot, it is taken in pieces
+        while chunk:
+            try:
+                piece = decompressor.decompress(chunk, chunk_size)
+            except zlib.error as exc:
+                raise ParseError(f"broken {encoding} body: {exc}") from exc
+            chunk = decompressor.unconsumed_tail
+            if piece:
+                yield counted(piece)
+    if decompressor is not None:
+        if not decompressor.eof:
+            raise ParseError(f"truncated {encoding} body")
+        tail = decompressor.flush()
+        if tail:
+            yield counted(tail)
+
+
+def _text(chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        for chunk in chunks:
+            text = decoder.decode(chunk)
+            if text:
+                yield text
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError as exc:
+        raise ParseError(f"body is no utf-8: {exc}") from exc
+
+
+class _Element:
+    """
+    finds the end of one json value while its text comes in, each piece
+    is scanned once and the value is decoded once it is complete
+    """
+    __slots__ = ("scalar", "depth", "in_string", "escaped")
+
+    def __init__(self, first):
+        self.scalar = first not in '[{"'
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def scan(self, text, index=0) -> int:
+        """returns the index in text past the end of the value, -1 if it goes on"""
+        if self.scalar:
+            # a number or a literal ends at the next delimiter
+            match = _SCALAR_END.search(text, index)
+            return match.start() if match else -1
+        if self.escaped:
+            # a backslash ended the last piece
+            self.escaped = False
+            index += 1
+        while True:
+            match = _STRUCTURE.search(text, index)
+            if match is None:
+                return -1
+            char = match.group()
+            index = match.end()
+            if self.in_string:
+                if char == "\\":
+                    if index >= len(text):
+                        self.escaped = True
+                        return -1
+                    index += 1
+                elif char == '"':
+                    self.in_string = False
+                    if not self.depth:
+                        return index
+            elif char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}":
+                self.depth -= 1
+                if not self.depth:
+                    return index
+
+
+def iter_json(chunks, max_message=0):
+    """
+    yields the elements of a json array, or the document if it is no
+    array, without holding more of the body than the current element.
+    raises TooLarge for an element of more than max_message characters
+    if it is set
+    """
+    decoder = json.JSONDecoder()
+    text = _text(chunks)
+    buffer = ""
+    position = 0
+
+    def fill():
+        nonlocal buffer, position
+        piece = next(text, None)
+        if piece is None:
+            return False
+        buffer = buffer[position:] + piece
+        position = 0
+        return True
+
+    def skip(separators=_WHITESPACE):
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position] in separators:
+                position += 1
+            if position < len(buffer) or not fill():
+                return
+
+    def decode():
+        nonlocal buffer, position
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            end = len(buffer)
+        if end < len(buffer):
+            if max_message and end - position > max_message:
+                raise TooLarge(f"a message is larger than {max_message} characters")
+            position = end
+            return value
+        # the element may go on in the next pieces, they are scanned for its
+        # end and joined once, a decode per piece would be quadratic
+        element = _Element(buffer[position])
+        end = element.scan(buffer, position)
+        if end < 0:
+            pieces = [buffer[position:]]
+            size = len(pieces[0])
+            for piece in text:
+                end = element.scan(piece)
+                if end >= 0:
+                    size += end
+                pieces.append(piece)
+                if end >= 0:
+                    break
+                size += len(piece)
+                if max_message and size > max_message:
+                    raise TooLarge(f"a message is larger than {max_message} characters")
+            buffer = "".join(pieces)
+            position = 0
+            end = size if end >= 0 else len(buffer)
+        if max_message and end - position > max_message:
+            raise TooLarge(f"a message is larger than {max_message} characters")
+        try:
+            value, stop = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as exc:
+            raise ParseError(f"invalid json: {exc}") from exc
+        if stop != end:
+            raise ParseError(f"invalid json at {buffer[stop:stop + 20]!r}")
+        position = end
+        return value
+
+    skip()
+    if position >= len(buffer):
+        raise ParseError("empty body")
+    if buffer[position] != "[":
+        yield decode()
+        skip()
+        if position < len(buffer):
+            raise ParseError("trailing data after the json document")
+        return
+    position += 1
+    skip()
+    if position < len(buffer) and buffer[position] == "]":
+        position += 1
+    else:
+        while True:
+            if position >= len(buffer):
+                raise ParseError("unterminated json array")
+            yield decode()
+            skip()
+            if position >= len(buffer):
+                raise ParseError("unterminated json array")
+            if buffer[position] == "]":
+                position += 1
+                break
+            if buffer[position] != ",":
+                raise ParseError(f"expected , or ] at {buffer[position:position + 20]!r}")
+            position += 1
+            skip()
+    skip()
+    if position < len(buffer):
+        raise ParseError("trailing data after the json array")
+
+
+def iter_ndjson(chunks, max_message=0):
+    """
+    yields the documents of newline delimited json, one per line. raises
+    TooLarge for a line of more than max_message bytes if it is set
+    """
+    pending = []
+    size = 0
+    number = 0
+    for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            if end < 0:
+                break
+            line = chunk[start:end]
+            if pending:
+                line = b"".join(pending) + line
+                pending = []
+                size = 0
+            start = end + 1
+            number += 1
+            if max_message and len(line) > max_message:
+                raise TooLarge(f"line {number} is larger than {max_message} bytes")
+            if line.strip():
+                yield _loads_line(line, number)
+        if start < len(chunk):
+            pending.append(chunk[start:])
+            size += len(chunk) - start
+            if max_message and size > max_message:
+                raise TooLarge(f"line {number + 1} is larger than {max_message} bytes")
+    line = b"".join(pending)
+    if line.strip():
+        yield _loads_line(line, number + 1)
+
+
+def _loads_line(line, number):
+    try:
+        return json.loads(line)
+    except ValueError as exc:
+        raise ParseError(f"invalid json in line {number}: {exc}") from exc
+
+
+def iter_messages(stream, content_type, encoding="identity", chunk_size=CHUNK_SIZE,
+                  max_body=0, max_message=0):
+    """
+    yields the messages of a posted body of a json or ndjson content type,
+    max_body limits the decompressed body and max_message a single message
+    """
+    chunks = iter_chunks(stream, encoding, chunk_size, max_body)
+    if content_type in NDJSON_TYPES:
+        return iter_ndjson(chunks, max_message)
+    if content_type in JSON_TYPES:
+        return iter_json(chunks, max_message)
+    raise UnsupportedFormat(f"Content-Type {content_type} not supported")
+
+
+def iter_batches(messages, batch_size):
+    """
+    groups messages into lists of up to batch_size while they are read,
+    raises ParseError at one which is not a json object
+    """
+    batch = []
+    for message in messages:
+        if not isinstance(message, dict):
+            raise ParseError(f"a message must be a json object, not {type(message).__name__}")
+        batch.append(message)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
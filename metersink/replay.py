@@ -0,0 +1,160 @@
+"""
+replays captured traffic against a running metersink at a chosen speed
+"""
+import http.client
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from metersink.output_textfile import open_segment
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_URL = "http://127.0.0.1:8088/post_json"
+DEFAULT_CONCURRENCY = 4
+PROGRESS_INTERVAL = 10.0
+
+
+class Poster:
+    """posts batches to /post_json over one keep-alive connection per thread"""
+
+    def __init__(self, url=DEFAULT_URL, timeout=60.0):
+        parts = urlsplit(url)
+        self.secure = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or "/post_json"
+        self.timeout = timeout
+        self.rejected = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection_class = (http.client.HTTPSConnection if self.secure
+                                else http.client.HTTPConnection)
+            connection = connection_class(self.host, self.port, timeout=self.timeout)
+            self._local.connection = connection
+        return connection
+
+    def _send(self, body):
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request("POST", self.path, body,
+                                   {"Content-Type": "application/json"})
+                response = connection.getresponse()
+                response.read()
+                return response
+            except (OSError, http.client.HTTPException):
+                # the server may have closed the kept connection
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+        return None
+
+    def post(self, batch) -> float:
+        """
+        posts a batch, waits out 503 answers as the ceilometer publisher
+        would and returns the seconds until it was accepted
+        """
+        body = json.dumps(batch).encode("utf-8")
+        start = time.perf_counter()
+        while True:
+            response = self._send(body)
+            if response.status != 503:
+                break
+            with self._lock:
+                self.rejected += 1
+            time.sleep(float(response.getheader("Retry-After", "1")))
+        if response.status != 202:
+            raise RuntimeError(f"{self.path} answered {response.status}")
+        return time.perf_counter() - start
+
+
+def iter_captured(paths):
+    """yields (arrival time, batch) of capture files, oldest file first"""
+    for path in paths:
+        with open_segment(path) as captured:
+            for line in captured:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record["time"], record["messages"]
+
+
+def percentile(values, fraction):
+    """returns the value below which fraction of the values are"""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def replay(paths, url=DEFAULT_URL, speed=1.0, concurrency=DEFAULT_CONCURRENCY) -> dict:
+    """
+    posts every captured batch at its original time offset divided by
+    speed, with speed 0 as fast as concurrency parallel requests allow.
+    returns the counters of the replay.
+    """
+    poster = Poster(url)
+    # at most two batches per request slot are read ahead
+    slots = threading.BoundedSemaphore(concurrency * 2)
+    lock = threading.Lock()
+    report = {"requests": 0, "messages": 0, "failed": 0, "max_lag": 0.0}
+    latencies = []
+
+    def send(batch):
+        try:
+            seconds = poster.post(batch)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.warning("failed to replay a batch of %s messages: %s", len(batch), exc)
+            with lock:
+                report["failed"] += 1
+        else:
+            with lock:
+                report["requests"] += 1
+                report["messages"] += len(batch)
+                latencies.append(seconds)
+        finally:
+            slots.release()
+
+    started = time.monotonic()
+    progress = started + PROGRESS_INTERVAL
+    first = None
+    with ThreadPoolExecutor(concurrency) as executor:
+        for arrived, batch in iter_captured(paths):
+            if first is None:
+                first = arrived
+            if speed > 0:
+                due = started + (arrived - first) / speed
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    report["max_lag"] = max(report["max_lag"], -delay)
+            slots.acquire()  # pylint: disable=consider-using-with
+            executor.submit(send, batch)
+            now = time.monotonic()
+            if now >= progress:
+                progress = now + PROGRESS_INTERVAL
+                LOG.info("replayed %s messages in %.0fs", report["messages"], now - started)
+    report["seconds"] = time.monotonic() - started
+    report["rejected"] = poster.rejected
+    report["p50"] = percentile(latencies, 0.5)
+    report["p99"] = percentile(latencies, 0.99)
+    return report
+
+
+def run_replay(args):
+    """the replay command"""
+    report = replay(args.paths, url=args.url, speed=args.speed, concurrency=args.concurrency)
+    seconds = report["seconds"] or 1e-9
+    print(f"replayed {report['messages']} messages in {report['requests']} requests "
+          f"in {seconds:.1f}s, {report['messages'] / seconds:,.0f} msg/s")
+    print(f"failed {report['failed']} requests, {report['rejected']} answers were 503")
+    print(f"request p50 {report['p50'] * 1000:.1f}ms, p99 {report['p99'] * 1000:.1f}ms, "
+          f"at most {report['max_lag']:.2f}s behind the schedule")
+    return 1 if report["failed"] else 0
@@ -0,0 +1,190 @@
+"""
+the compiled sink routing table and its hot reload
+"""
+import configparser
+import logging
+import os
+import signal
+import threading
+import time
+from types import MappingProxyType
+from typing import NamedTuple
+
+from metersink.lib import get_config, get_config_section, get_sinks
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_CHECK_INTERVAL = 2.0
+DEFAULT_DELIVERY_TIMEOUT = 60.0
+DEFAULT_DELIVERY_RETRIES = 1
+DEFAULT_RETRY_BACKOFF = 0.5
+DEFAULT_BREAKER_THRESHOLD = 5
+DEFAULT_BREAKER_RESET = 30.0
+
+
+class SinkPolicy(NamedTuple):
+    """
+    how long a batch may take and how often it is retried for a sink, and
+    after how many failures in a row its circuit breaker opens for how long
+    """
+    timeout: float
+    retries: int
+    backoff: float = DEFAULT_RETRY_BACKOFF
+    breaker_threshold: int = DEFAULT_BREAKER_THRESHOLD
+    breaker_reset: float = DEFAULT_BREAKER_RESET
+
+
+class OdooEndpoint(NamedTuple):
+    """an odoo url with its matching db, user and api key"""
+    url: str
+    db: str
+    user_name: str
+    password: str
+
+
+class RoutingTable(NamedTuple):
+    """
+    the sink topology of one config file version, read-only down to the
+    sinks mapping so a table handed out stays as it was compiled
+    """
+    files: tuple
+    odoo: tuple
+    mtime: float
+    sinks: MappingProxyType
+
+
+def _per_sink(section_dict, option, count, default, convert) -> list:
+    """returns an option given once for all sinks or once per sink"""
+    values = section_dict.get(option)
+    if not values:
+        return [default] * count
+    if len(values) == 1:
+        return [convert(values[0])] * count
+    if len(values) != count:
+        raise ValueError(f"{option} has {len(values)} values for {count} sinks")
+    return [convert(value) for value in values]
+
+
+def _policies(conf, section, count) -> list:
+    section_dict = get_config_section(conf, section=section)
+    timeouts = _per_sink(section_dict, "delivery_timeout", count,
+                         DEFAULT_DELIVERY_TIMEOUT, float)
+    retries = _per_sink(section_dict, "delivery_retries", count,
+                        DEFAULT_DELIVERY_RETRIES, int)
+    backoffs = _per_sink(section_dict, "retry_backoff", count,
+                         DEFAULT_RETRY_BACKOFF, float)
+    thresholds = _per_sink(section_dict, "breaker_threshold", count,
+                           DEFAULT_BREAKER_THRESHOLD, int)
+    resets = _per_sink(section_dict, "breaker_reset", count,
+                       DEFAULT_BREAKER_RESET, float)
+    return [SinkPolicy(*values)
+            for values in zip(timeouts, retries, backoffs, thresholds, resets)]
+
+
+def compile_routes(conf, mtime=0.0) -> RoutingTable:
+    """compiles the configured sinks into an immutable routing table"""
+    sinks = get_sinks(conf)
+    files = tuple(sinks["file"]["name"]) if "file" in sinks else ()
+    odoo = ()
+    if "odoo" in sinks:
+        urls = sinks["odoo"]["name"]
+        odoo_conf = get_config_section(conf, section="odoo")
+        triples = []
+        for option in ("odoo_db", "odoo_user_name", "odoo_api_key"):
+            values = odoo_conf.get(option, [])
+            if len(values) != len(urls):
+                raise ValueError(
+                    f"[odoo] {option} has {len(values)} values "
+                    f"for {len(urls)} odoo endpoints"
+                )
+            triples.append(values)
+        odoo = tuple(
+            OdooEndpoint(url, db, user_name, password)
+            for url, db, user_name, password in zip(urls, *triples)
+        )
+    # every sink by its unique name as (type, target, policy)
+    named_sinks = {}
+    for path, policy in zip(files, _policies(conf, "file", len(files))):
+        named_sinks[f"file:{path}"] = ("file", path, policy)
+    for endpoint, policy in zip(odoo, _policies(conf, "odoo", len(odoo))):
+        named_sinks[f"odoo:{endpoint.url}/{endpoint.db}"] = ("odoo", endpoint, policy)
+    return RoutingTable(files=files, odoo=odoo, mtime=mtime,
+                        sinks=MappingProxyType(named_sinks))
+
+
+def _load(path) -> tuple:
+    mtime = os.stat(path).st_mtime
+    conf = get_config(path)
+    return conf, compile_routes(conf, mtime=mtime)
+
+
+def load_routes(path) -> RoutingTable:
+    """reads the config file and compiles its routing table"""
+    return _load(path)[1]
+
+
+class Router:
+    """
+    holds the current routing table and swaps it when the config file
+    changes on disk or the process receives SIGHUP. conf is the config
+    the table was compiled from, for the settings outside of the routing
+    """
+
+    def __init__(self, path, check_interval=DEFAULT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self.conf, self.routes = _load(path)
+        self._next_check = time.monotonic() + check_interval
+        self._reload_requested = False
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        """calls callback(routes) after every successful reload"""
+        self._listeners.append(callback)
+
+    def current(self) -> RoutingTable:
+        """returns the routing table, reloads it first if it is outdated"""
+        now = time.monotonic()
+        if self._reload_requested or now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self._check()
+        return self.routes
+
+    def _check(self):
+        if not self._lock.acquire(blocking=False):
+            # another thread is already reloading
+            return
+        try:
+            forced = self._reload_requested
+            self._reload_requested = False
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                LOG.exception("can not stat the config file %s", self.path)
+                return
+            if forced or mtime != self.routes.mtime:
+                self.reload()
+        finally:
+            self._lock.release()
+
+    def reload(self):
+        """compiles the config file and swaps the routing table"""
+        try:
+            conf, routes = _load(self.path)
+        except (OSError, ValueError, configparser.Error):
+            LOG.exception("keeping the old sink routes, the new config is broken")
+            return
+        self.conf, self.routes = conf, routes
+        LOG.info("reloaded the sink routes from %s", self.path)
+        for callback in self._listeners:
+            callback(routes)
+
+    def request_reload(self, *_args):
+        """marks the routing table for reload, usable as a signal handler"""
+        self._reload_requested = True
+
+    def install_signal_handler(self):
+        """reloads the routing table on SIGHUP"""
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.request_reload)
@@ -0,0 +1,300 @@
+"""
+pooled keep-alive xml-rpc transport for the odoo sinks
+"""
+import http.client
+import logging
+import queue
+import threading
+import time
+import xmlrpc.client
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+from metersink.metrics import ERRORS, ODOO_RPC_LATENCY, ODOO_RPCS
+from metersink.tracing import span
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 4
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_READ_TIMEOUT = 30.0
+DEFAULT_CHECKOUT_TIMEOUT = 30.0
+
+POOL_SETTINGS = {
+    "pool_size": DEFAULT_POOL_SIZE,
+    "connect_timeout": DEFAULT_CONNECT_TIMEOUT,
+    "read_timeout": DEFAULT_READ_TIMEOUT,
+    "checkout_timeout": DEFAULT_CHECKOUT_TIMEOUT,
+}
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+class _TimeoutMixin:
+    """connects with the connect timeout and then switches to the read timeout"""
+
+    read_timeout = None
+
+    def connect(self):
+        super().connect()
+        self.sock.settimeout(self.read_timeout)
+
+
+class TimeoutHTTPConnection(_TimeoutMixin, http.client.HTTPConnection):
+    """http connection with separate connect and read timeouts"""
+
+
+class TimeoutHTTPSConnection(_TimeoutMixin, http.client.HTTPSConnection):
+    """https connection with separate connect and read timeouts"""
+
+
+class KeepAliveTransport(xmlrpc.client.Transport):
+    """
+    xml-rpc transport that keeps its http/1.1 connection open between calls
+    and reports new and reused connections to its pool
+    """
+
+    connection_class = TimeoutHTTPConnection
+
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+
+    def _new_connection(self, chost, x509):
+        return self.connection_class(chost, timeout=self.pool.connect_timeout)
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            self.pool.count("reused")
+            return self._connection[1]
+        chost, self._extra_headers, x509 = self.get_host_info(host)
+        connection = self._new_connection(chost, x509)
+        connection.read_timeout = self.pool.read_timeout
+        self._connection = host, connection
+        self.pool.count("opened")
+        return connection
+
+
+class SafeKeepAliveTransport(KeepAliveTransport):
+    """keep-alive transport for https endpoints"""
+
+    connection_class = TimeoutHTTPSConnection
+
+    def __init__(self, pool, context=None, **kwargs):
+        super().__init__(pool, **kwargs)
+        self.context = context
+
+    def _new_connection(self, chost, x509):
+        return self.connection_class(
+            chost,
+            timeout=self.pool.connect_timeout,
+            context=self.context,
+            **(x509 or {}),
+        )
+
+
+class ConnectionPool:
+    """
+    a bounded pool of keep-alive transports for one odoo url
+
+    transports are checked out by one thread at a time, the pool blocks
+    for checkout_timeout seconds when all of them are in use
+    """
+
+    def __init__(self, url,
+                 pool_size=DEFAULT_POOL_SIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT,
+                 checkout_timeout=DEFAULT_CHECKOUT_TIMEOUT,
+                 ):
+        self.url = url
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.checkout_timeout = checkout_timeout
+        self.secure = urlsplit(url).scheme == "https"
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,
+            "opened": 0,
+            "reused": 0,
+            "discarded": 0,
+        }
+
+    def count(self, key, amount=1):
+        """increments a pool statistic"""
+        with self._lock:
+            self._stats[key] += amount
+
+    def stats(self) -> dict:
+        """returns a snapshot of the pool statistics"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._created
+        stats["idle"] = self._idle.qsize()
+        stats["in_use"] = stats["size"] - stats["idle"]
+        return stats
+
+    def _new_transport(self):
+        if self.secure:
+            return SafeKeepAliveTransport(self)
+        return KeepAliveTransport(self)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                return self._new_transport()
+            self._stats["waits"] += 1
+        try:
+            return self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty as exc:
+            raise TimeoutError(
+                f"no free odoo connection for {self.url} "
+                f"after {self.checkout_timeout}s"
+            ) from exc
+
+    def _discard(self, transport):
+        transport.close()
+        with self._lock:
+            self._created -= 1
+            self._stats["discarded"] += 1
+
+    def _replace(self, transport):
+        # a fresh transport connects on its first call, putting it back
+        # wakes a thread which waits for a free one
+        transport.close()
+        self.count("discarded")
+        self._idle.put(self._new_transport())
+
+    @contextmanager
+    def checkout(self):
+        """yields a transport for exclusive use by the calling thread"""
+        transport = self._acquire()
+        self.count("checkouts")
+        try:
+            yield transport
+        except (OSError, http.client.HTTPException, xmlrpc.client.ProtocolError):
+            # the connection state is unknown, do not hand it out again
+            self._replace(transport)
+            raise
+        except BaseException:
+            self._idle.put(transport)
+            raise
+        self._idle.put(transport)
+
+    def close(self):
+        """closes all idle connections"""
+        while True:
+            try:
+                transport = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(transport)
+
+
+class _PooledMethod:
+    """a remote method that borrows a transport for the duration of the call"""
+
+    def __init__(self, proxy, name):
+        self._proxy = proxy
+        self._name = name
+
+    def __getattr__(self, name):
+        return _PooledMethod(self._proxy, f"{self._name}.{name}")
+
+    def __call__(self, *args):
+        pool = self._proxy.pool
+        if self._name == "execute_kw" and len(args) > 4:
+            # db, uid, password, model, method, ...
+            model, method = str(args[3]), str(args[4])
+        else:
+            model, method = "", self._name
+        ODOO_RPCS.inc(pool.url, model, method)
+        start = time.monotonic()
+        try:
+            with span(f"rpc {model}.{method}" if model else f"rpc {method}"), \
+                    pool.checkout() as transport:
+                server = xmlrpc.client.ServerProxy(
+                    self._proxy.uri, transport=transport, allow_none=True
+                )
+                return getattr(server, self._name)(*args)
+        except Exception as exc:
+            ERRORS.inc("odoo_rpc", type(exc).__name__)
+            raise
+        finally:
+            ODOO_RPC_LATENCY.observe(time.monotonic() - start, model, method)
+
+
+class PooledServerProxy:
+    """
+    drop-in replacement for xmlrpc.client.ServerProxy which uses the pool
+    of the odoo url for every call
+    """
+
+    def __init__(self, pool, uri):
+        self.pool = pool
+        self.uri = uri
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return _PooledMethod(self, name)
+
+    def __repr__(self):
+        return f"<PooledServerProxy for {self.uri}>"
+
+
+def configure_pools(conf):
+    """reads the pool settings from the [odoo] section of the config"""
+    section = "odoo"
+    POOL_SETTINGS["pool_size"] = conf.getint(
+        section, "pool_size", fallback=DEFAULT_POOL_SIZE)
+    POOL_SETTINGS["connect_timeout"] = conf.getfloat(
+        section, "connect_timeout", fallback=DEFAULT_CONNECT_TIMEOUT)
+    POOL_SETTINGS["read_timeout"] = conf.getfloat(
+        section, "read_timeout", fallback=DEFAULT_READ_TIMEOUT)
+    POOL_SETTINGS["checkout_timeout"] = conf.getfloat(
+        section, "checkout_timeout", fallback=DEFAULT_CHECKOUT_TIMEOUT)
+    LOG.debug("odoo connection pool settings: %s", POOL_SETTINGS)
+
+
+def get_pool(url) -> ConnectionPool:
+    """returns the connection pool of an odoo url, creates it on first use"""
+    pool = _POOLS.get(url)
+    if pool is None:
+        with _POOLS_LOCK:
+            pool = _POOLS.get(url)
+            if pool is None:
+                pool = ConnectionPool(url, **POOL_SETTINGS)
+                _POOLS[url] = pool
+    return pool
+
+
+def get_proxy(url, endpoint) -> PooledServerProxy:
+    """returns a pooled proxy for an xml-rpc endpoint (common, object) of odoo"""
+    return PooledServerProxy(get_pool(url), f"{url}/xmlrpc/2/{endpoint}")
+
+
+def pool_stats() -> dict:
+    """returns the statistics of all pools by url"""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+    return {pool.url: pool.stats() for pool in pools}
+
+
+def close_pools():
+    """closes the idle connections of all pools"""
+    with _POOLS_LOCK:
+        pools = list(_POOLS.values())
+        _POOLS.clear()
+    for pool in pools:
+        pool.close()
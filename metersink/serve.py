@@ -0,0 +1,263 @@
+"""
+the http server of the api, in one process or in front of worker processes
+"""
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from concurrent.futures import Future
+
+from werkzeug.serving import make_server
+
+from metersink.ingest import QueueFull, split_batch
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8088
+DEFAULT_PROCESSES = 1
+DEFAULT_SHUTDOWN_TIMEOUT = 30.0
+DEFAULT_MAX_BODY = 256 * 1024 * 1024
+DEFAULT_MAX_MESSAGE = 1024 * 1024
+DEFAULT_CALL_TIMEOUT = 60.0
+DEFAULT_START_TIMEOUT = 300.0
+
+
+class WorkerGone(RuntimeError):
+    """raised for calls to a worker process which exited"""
+
+
+def get_server_settings(conf) -> dict:
+    """reads the [server] section of the config"""
+    section = "server"
+    return {
+        "host": conf.get(section, "host", fallback=DEFAULT_HOST),
+        "port": conf.getint(section, "port", fallback=DEFAULT_PORT),
+        "processes": conf.getint(section, "processes", fallback=DEFAULT_PROCESSES),
+        "shutdown_timeout": conf.getfloat(
+            section, "shutdown_timeout", fallback=DEFAULT_SHUTDOWN_TIMEOUT),
+        "max_body": conf.getint(section, "max_body", fallback=DEFAULT_MAX_BODY),
+        "max_message": conf.getint(section, "max_message", fallback=DEFAULT_MAX_MESSAGE),
+    }
+
+
+def serve(app, host, port):
+    """
+    serves app with a thread per request until SIGTERM or SIGINT, then
+    stops accepting connections and waits for the running requests
+    """
+    server = make_server(host, port, app, threaded=True)
+    # server_close joins the request threads
+    server.daemon_threads = False
+
+    def stop(signum, _frame):
+        LOG.info("stopping the server on signal %s", signum)
+        # shutdown waits for serve_forever, which runs in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    previous = {
+        signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    LOG.info("serving on http://%s:%s", host, server.server_port)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+class WorkerProcess:
+    """a worker process and the pipe its calls and replies go through"""
+
+    def __init__(self, context, target, number, args):
+        self.number = number
+        self._conn, child = context.Pipe()
+        self.process = context.Process(
+            target=target, args=(child, number, *args),
+            name=f"metersink-worker-{number}", daemon=False,
+        )
+        self._child = child
+        self._send_lock = threading.Lock()
+        self._calls = {}
+        self._ids = itertools.count()
+        self._reader = threading.Thread(
+            target=self._read, name=f"worker-{number}-replies", daemon=True
+        )
+
+    def start(self):
+        """starts the process and the thread reading its replies"""
+        self.process.start()
+        self._child.close()
+        self._reader.start()
+
+    def call(self, kind, payload=None) -> Future:
+        """sends a call, the future resolves to its (status, value) reply"""
+        future = Future()
+        call_id = next(self._ids)
+        self._calls[call_id] = future
+        try:
+            with self._send_lock:
+                self._conn.send((call_id, kind, payload))
+        except (OSError, ValueError) as exc:
+            self._calls.pop(call_id, None)
+            raise WorkerGone(f"worker {self.number} is gone") from exc
+        return future
+
+    def _read(self):
+        while True:
+            try:
+                call_id, status, value = self._conn.recv()
+            except (EOFError, OSError):
+                break
+            future = self._calls.pop(call_id, None)
+            if future:
+                future.set_result((status, value))
+        for call_id in list(self._calls):
+            future = self._calls.pop(call_id, None)
+            if future:
+                future.set_exception(WorkerGone(f"worker {self.number} is gone"))
+
+    def signal(self, signum):
+        """passes a signal on to the process"""
+        if self.process.is_alive():
+            os.kill(self.process.pid, signum)
+
+    def stop(self, timeout):
+        """asks the process to drain and exit, kills it after timeout"""
+        try:
+            self.call("stop").result(timeout=timeout)
+        except Exception:  # pylint: disable=broad-except
+            LOG.warning("worker %s did not stop in time", self.number)
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            # the workers ignore SIGTERM
+            self.process.kill()
+            self.process.join()
+        self._conn.close()
+
+
+class Front:
+    """
+    hands the batches of the api to worker processes, the messages of a
+    project always go to the same worker so they stay in order
+    """
+
+    def __init__(self, target, processes, args=(), call_timeout=DEFAULT_CALL_TIMEOUT):
+        # forked workers would inherit the locks of the server threads
+        context = multiprocessing.get_context("spawn")
+        self.call_timeout = call_timeout
+        self._tokens = itertools.count()
+        self.workers = [
+            WorkerProcess(context, target, number, args) for number in range(processes)
+        ]
+
+    def start(self, timeout=DEFAULT_START_TIMEOUT):
+        """starts the workers and waits until they took over their spool and sinks"""
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            worker.call("ping").result(timeout=timeout)
+        LOG.info("started %s worker processes", len(self.workers))
+
+    def _results(self, calls):
+        for worker, future in calls:
+            status, value = future.result(timeout=self.call_timeout)
+            if status == "error":
+                raise RuntimeError(f"worker {worker.number}: {value}")
+            yield status, value
+
+    def accept(self, batch) -> int:
+        """
+        hands a batch to the workers of its projects and returns the number
+        of messages they took, raises QueueFull if one of them is full. the
+        workers first prepare their parts, room in their queue and spool,
+        and queue them only once all of them could, so a batch is taken as
+        a whole or not at all.
+        """
+        parts = split_batch(batch, len(self.workers))
+        workers = [self.workers[partition] for partition in parts]
+        token = next(self._tokens)
+        calls = [
+            (worker, worker.call("prepare", (token, part)))
+            for worker, part in zip(workers, parts.values())
+        ]
+        accepted = 0
+        retry_after = None
+        error = None
+        for worker, future in calls:
+            try:
+                status, value = future.result(timeout=self.call_timeout)
+            except Exception as exc:  # pylint: disable=broad-except
+                error = error or exc
+                continue
+            if status == "full":
+                retry_after = value
+            elif status == "error":
+                error = error or RuntimeError(f"worker {worker.number}: {value}")
+            else:
+                accepted += value
+        if error is not None or retry_after is not None:
+            # a worker which did not answer in time may still prepare its part
+            self._settle(workers, "cancel", token)
+            if error is not None:
+                raise error
+            raise QueueFull(retry_after)
+        self._settle(workers, "commit", token)
+        return accepted
+
+    def _settle(self, workers, kind, token):
+        calls = []
+        for worker in workers:
+            try:
+                calls.append((worker, worker.call(kind, token)))
+            except WorkerGone:
+                LOG.warning("worker %s is gone, it can not %s its part", worker.number, kind)
+        list(self._results(calls))
+
+    def broadcast(self, kind, payload=None) -> dict:
+        """calls every worker and returns their replies by worker number"""
+        calls = [(worker, worker.call(kind, payload)) for worker in self.workers]
+        return {
+            str(worker.number): value
+            for (worker, _future), (_status, value) in zip(calls, self._results(calls))
+        }
+
+    def signal(self, signum, _frame=None):
+        """passes a signal on to all workers"""
+        for worker in self.workers:
+            worker.signal(signum)
+
+    def stop(self, timeout=DEFAULT_SHUTDOWN_TIMEOUT):
+        """stops the workers, each delivers what it accepted first"""
+        threads = [
+            threading.Thread(target=worker.stop, args=(timeout,)) for worker in self.workers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def worker_loop(conn, handlers):
+    """
+    answers the calls of the front until it asks to stop or goes away,
+    handlers maps call kinds to functions of the payload
+    """
+    while True:
+        try:
+            call_id, kind, payload = conn.recv()
+        except (EOFError, OSError):
+            return None
+        if kind == "stop":
+            return call_id
+        try:
+            reply = ("ok", handlers[kind](payload))
+        except QueueFull as exc:
+            reply = ("full", exc.retry_after)
+        except Exception as exc:  # pylint: disable=broad-except
+            LOG.exception("failed to handle a %s call", kind)
+            reply = ("error", f"{type(exc).__name__}: {exc}")
+        conn.send((call_id, *reply))
@@ -0,0 +1,354 @@
+"""
+durable write-ahead spool for accepted metering messages
+
+every accepted batch is appended as one json line to the current segment
+file and fsynced before the api acknowledges it. each sink keeps its own
+checkpoint, the position after the last batch it delivered without a gap.
+segments which every sink has passed are deleted.
+"""
+import json
+import logging
+import os
+import threading
+from typing import NamedTuple
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_SUFFIX = ".log"
+CHECKPOINT_SUFFIX = ".checkpoint"
+
+
+class Position(NamedTuple):
+    """the position of a batch in the spool, ordered by segment and offset"""
+    segment: int
+    offset: int
+
+
+class SpoolRecord(NamedTuple):
+    """one spooled batch, end is the position right after it"""
+    start: Position
+    end: Position
+    batch: list
+
+
+def _segment_name(number) -> str:
+    return f"{number:010d}{SEGMENT_SUFFIX}"
+
+
+def _sink_file_name(sink) -> str:
+    return "".join(c if c.isalnum() or c in "-_." else "_" for c in sink)
+
+
+def _sync_directory(path):
+    """makes a rename in a directory durable"""
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Checkpoint:
+    """
+    the delivery watermark of one sink
+
+    batches may be delivered out of order by parallel workers, the stored
+    position only moves over batches without a gap before them
+    """
+
+    def __init__(self, path, position, fsync=True):
+        self.path = path
+        self.position = position
+        self.fsync = fsync
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def track(self, record):
+        """registers a spooled batch which the sink has to deliver"""
+        with self._lock:
+            self._pending[record.start] = [record.end, False]
+
+    def commit(self, record) -> bool:
+        """
+        marks a batch as delivered and moves the watermark if possible,
+        returns True if the watermark moved to a later segment
+        """
+        with self._lock:
+            entry = self._pending.get(record.start)
+            if entry is None:
+                return False
+            entry[1] = True
+            segment = self.position.segment
+            moved = False
+            while self.position in self._pending and self._pending[self.position][1]:
+                self.position = self._pending.pop(self.position)[0]
+                moved = True
+            if moved:
+                self._store()
+            return self.position.segment != segment
+
+    def _store(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(list(self.position), file)
+            if self.fsync:
+                # the segments before the position are deleted, a crash
+                # must not bring back an older one
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(tmp_path, self.path)
+        if self.fsync:
+            _sync_directory(os.path.dirname(self.path))
+
+
+class Spool:
+    """an append-only, segment rotated log of accepted batches"""
+
+    def __init__(self, directory, sinks, segment_size=DEFAULT_SEGMENT_SIZE, fsync=True):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # commits of different sinks may compact at the same time
+        self._compact_lock = threading.Lock()
+        self._sync = threading.Condition()
+        self._syncing = False
+        self._written = 0
+        self._synced = 0
+        segments = self.segments()
+        self._segment = segments[-1] if segments else 1
+        self._repair(self._segment_path(self._segment))
+        self._file = open(self._segment_path(self._segment), "ab")
+        first = Position(segments[0] if segments else 1, 0)
+        self.checkpoints = {}
+        for sink in sinks:
+            self.add_sink(sink, default=first)
+
+    @staticmethod
+    def _repair(path):
+        """cuts off a torn, never acknowledged batch at the end of a segment"""
+        if not os.path.exists(path):
+            return
+        with open(path, "rb+") as file:
+            size = file.seek(0, os.SEEK_END)
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                file.seek(start)
+                chunk = file.read(end - start)
+                newline = chunk.rfind(b"\n")
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end != size:
+                LOG.warning("truncating a torn write at %s:%s", path, end)
+                file.truncate(end)
+
+    def _segment_path(self, number) -> str:
+        return os.path.join(self.directory, _segment_name(number))
+
+    def segments(self) -> list:
+        """returns the numbers of the segments on disk in order"""
+        numbers = []
+        for name in os.listdir(self.directory):
+            if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+                numbers.append(int(name[:-len(SEGMENT_SUFFIX)]))
+        return sorted(numbers)
+
+    def add_sink(self, sink, default=None) -> Checkpoint:
+        """loads or creates the checkpoint of a sink"""
+        if sink in self.checkpoints:
+            return self.checkpoints[sink]
+        path = os.path.join(self.directory, _sink_file_name(sink) + CHECKPOINT_SUFFIX)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as file:
+                position = Position(*json.load(file))
+        else:
+            # without a default a new sink only gets batches accepted from now on
+            position = default or self.end()
+        checkpoint = Checkpoint(path, position, fsync=self.fsync)
+        self.checkpoints[sink] = checkpoint
+        return checkpoint
+
+    def remove_sink(self, sink):
+        """forgets a sink which is no longer configured"""
+        checkpoint = self.checkpoints.pop(sink, None)
+        if checkpoint and os.path.exists(checkpoint.path):
+            os.remove(checkpoint.path)
+
+    def end(self) -> Position:
+        """returns the position after the last appended batch"""
+        with self._lock:
+            return Position(self._segment, self._file.tell())
+
+    def append(self, batch) -> SpoolRecord:
+        """
+        appends a batch and returns its spool record once it is on disk
+
+        concurrent appends share one fsync (group commit)
+        """
+        line = json.dumps(batch, separators=(",", ":")).encode("utf-8") + b"\n"
+        with self._lock:
+            start = Position(self._segment, self._file.tell())
+            self._file.write(line)
+            self._file.flush()
+            self._written += 1
+            sequence = self._written
+            if self._file.tell() >= self.segment_size:
+                self._rotate()
+            end = Position(self._segment, self._file.tell())
+        if self.fsync:
+            self._group_sync(sequence)
+        record = SpoolRecord(start, end, batch)
+        for checkpoint in list(self.checkpoints.values()):
+            checkpoint.track(record)
+        return record
+
+    def _group_sync(self, sequence):
+        with self._sync:
+            while self._synced < sequence:
+                if self._syncing:
+                    self._sync.wait()
+                    continue
+                self._syncing = True
+                with self._lock:
+                    target = self._written
+                    file_descriptor = os.dup(self._file.fileno())
+                self._sync.release()
+                synced = False
+                try:
+                    os.fsync(file_descriptor)
+                    synced = True
+                finally:
+                    os.close(file_descriptor)
+                    self._sync.acquire()
+                    self._syncing = False
+                    if synced:
+                        self._synced = max(self._synced, target)
+                    self._sync.notify_all()
+
+    def _rotate(self):
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._segment += 1
+        self._file = open(self._segment_path(self._segment), "ab")
+        if self.fsync:
+            # make the new directory entry durable as well
+            _sync_directory(self.directory)
+        LOG.debug("spool rotated to segment %s", self._segment)
+
+    def read(self, position, until=None):
+        """yields the records from position up to until or the end of the spool"""
+        until = until or self.end()
+        for number in self.segments():
+            if number < position.segment or number > until.segment:
+                continue
+            offset = position.offset if number == position.segment else 0
+            limit = until.offset if number == until.segment else None
+            path = self._segment_path(number)
+            size = os.path.getsize(path)
+            with open(path, "rb") as file:
+                file.seek(offset)
+                while limit is None or offset < limit:
+                    line = file.readline()
+                    if not line.endswith(b"\n"):
+                        # a torn write of a batch which was never acknowledged
+                        break
+                    start = Position(number, offset)
+                    offset += len(line)
+                    end = Position(number, offset)
+                    if number < until.segment and offset >= size:
+                        # the end of a full segment is the start of the next one
+                        end = Position(number + 1, 0)
+                    yield SpoolRecord(start, end, json.loads(line))
+
+    def replay(self):
+        """
+        yields (record, sinks) for every batch which was not delivered to
+        all sinks, and tracks them for the sinks that still need it
+        """
+        if not self.checkpoints:
+            return
+        until = self.end()
+        oldest = min(checkpoint.position for checkpoint in self.checkpoints.values())
+        for record in self.read(oldest, until):
+            sinks = [
+                sink for sink, checkpoint in self.checkpoints.items()
+                if checkpoint.position <= record.start
+            ]
+            for sink in sinks:
+                self.checkpoints[sink].track(record)
+            yield record, sinks
+
+    def commit(self, record, sink):
+        """marks a record as delivered to a sink, compacts finished segments"""
+        checkpoint = self.checkpoints.get(sink)
+        if checkpoint and checkpoint.commit(record):
+            self.compact()
+
+    def discard(self, record):
+        """
+        marks a record as delivered to every sink, for a batch which was
+        appended but then not taken
+        """
+        for sink in list(self.checkpoints):
+            self.commit(record, sink)
+
+    def compact(self) -> int:
+        """deletes the segments every sink has fully delivered"""
+        if not self.checkpoints:
+            return 0
+        removed = 0
+        with self._compact_lock:
+            oldest = min(checkpoint.position.segment
+                         for checkpoint in list(self.checkpoints.values()))
+            for number in self.segments():
+                if number >= min(oldest, self._segment):
+                    break
+                try:
+                    os.remove(self._segment_path(number))
+                except FileNotFoundError:
+                    continue
+                removed += 1
+        if removed:
+            LOG.debug("spool compacted %s segments", removed)
+        return removed
+
+    def stats(self) -> dict:
+        """returns the spool size and the checkpoint of every sink"""
+        end = self.end()
+        return {
+            "segments": len(self.segments()),
+            "end": list(end),
+            "checkpoints": {
+                sink: list(checkpoint.position)
+                for sink, checkpoint in self.checkpoints.items()
+            },
+        }
+
+    def close(self):
+        """closes the current segment"""
+        with self._lock:
+            self._file.close()
+
+
+def get_spool_settings(conf, worker=None) -> dict:
+    """
+    reads the [spool] section of the config, returns None if it is off.
+    every worker process has its own spool below the path
+    """
+    section = "spool"
+    if not conf.has_option(section, "path"):
+        return None
+    directory = conf.get(section, "path")
+    if worker is not None:
+        directory = os.path.join(directory, f"worker-{worker}")
+    return {
+        "directory": directory,
+        "segment_size": conf.getint(section, "segment_size", fallback=DEFAULT_SEGMENT_SIZE),
+        "fsync": conf.getboolean(section, "fsync", fallback=True),
+    }
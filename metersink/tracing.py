@@ -0,0 +1,240 @@
+"""
+optional per message span timing and an on-demand sampling profiler
+
+both cost one dict lookup per call site while they are off
+"""
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import nullcontext
+from datetime import datetime
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_KEEP = 1000
+DEFAULT_SLOW_THRESHOLD = 1.0
+DEFAULT_PROFILE_INTERVAL = 0.005
+MAX_PROFILE_SECONDS = 600
+
+TRACE_SETTINGS = {
+    "enabled": False,
+    "slow_threshold": DEFAULT_SLOW_THRESHOLD,
+    "profile_dir": tempfile.gettempdir(),
+}
+
+_LOCAL = threading.local()
+_NULL = nullcontext()
+_TRACES = deque(maxlen=DEFAULT_KEEP)
+_TRACES_LOCK = threading.Lock()
+
+
+def correlation_id_of(message) -> str:
+    """returns the message id of a message or an Event, or a new random id"""
+    message_id = message.get("message_id") if isinstance(message, dict) else message.message_id
+    return str(message_id or uuid.uuid4().hex)
+
+
+class Trace:
+    """the spans recorded while one message was handled by one sink"""
+
+    __slots__ = ("correlation_id", "sink", "started", "start", "duration", "spans",
+                 "depth", "error")
+
+    def __init__(self, correlation_id, sink):
+        self.correlation_id = correlation_id
+        self.sink = sink
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration = 0.0
+        self.spans = []
+        self.depth = 0
+        self.error = None
+
+    def __enter__(self):
+        _LOCAL.trace = self
+        return self
+
+    def __exit__(self, exc_type, exc, _traceback):
+        _LOCAL.trace = None
+        self.duration = time.perf_counter() - self.start
+        if exc_type:
+            self.error = exc_type.__name__
+        with _TRACES_LOCK:
+            _TRACES.append(self)
+        threshold = TRACE_SETTINGS["slow_threshold"]
+        if threshold and self.duration >= threshold:
+            LOG.info("slow message %s on %s: %.3fs %s", self.correlation_id, self.sink,
+                     self.duration, ", ".join(
+                         f"{name} {duration * 1000:.1f}ms"
+                         for name, _offset, duration, _depth, _error, _attrs
+                         in sorted(self.spans, key=lambda span: span[1])
+                     ))
+        return False
+
+    def to_dict(self) -> dict:
+        """returns the trace with its spans in the order they started"""
+        return {
+            "correlation_id": self.correlation_id,
+            "sink": self.sink,
+            "started": datetime.fromtimestamp(self.started).isoformat(),
+            "seconds": self.duration,
+            "error": self.error,
+            "spans": [
+                {"name": name, "offset": offset, "seconds": duration, "depth": depth,
+                 "error": error, **attrs}
+                for name, offset, duration, depth, error, attrs
+                in sorted(self.spans, key=lambda span: span[1])
+            ],
+        }
+
+
+class _Span:
+    __slots__ = ("trace", "name", "attrs", "start", "depth")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self.depth = self.trace.depth
+        self.trace.depth += 1
+        return self
+
+    def __exit__(self, exc_type, _exc, _traceback):
+        end = time.perf_counter()
+        self.trace.depth -= 1
+        self.trace.spans.append((
+            self.name, self.start - self.trace.start, end - self.start, self.depth,
+            exc_type.__name__ if exc_type else None, self.attrs,
+        ))
+        return False
+
+
+def trace(correlation_id, sink=None):
+    """records the spans of the calling thread for one message, if tracing is on"""
+    if not TRACE_SETTINGS["enabled"]:
+        return _NULL
+    return Trace(correlation_id, sink)
+
+
+def span(name, **attrs):
+    """times a block as part of the trace of the calling thread, if there is one"""
+    if not TRACE_SETTINGS["enabled"]:
+        return _NULL
+    current = getattr(_LOCAL, "trace", None)
+    if current is None:
+        return _NULL
+    return _Span(current, name, attrs)
+
+
+def set_tracing(enabled) -> bool:
+    """switches tracing on or off"""
+    TRACE_SETTINGS["enabled"] = bool(enabled)
+    LOG.info("tracing is %s", "on" if enabled else "off")
+    return TRACE_SETTINGS["enabled"]
+
+
+def recent_traces(limit=100, correlation_id=None) -> list:
+    """returns the latest traces, newest first"""
+    with _TRACES_LOCK:
+        traces = list(_TRACES)
+    if correlation_id:
+        traces = [item for item in traces if item.correlation_id == correlation_id]
+    return [item.to_dict() for item in reversed(traces[-limit:])]
+
+
+def configure_tracing(conf):
+    """reads the [tracing] section of the config"""
+    global _TRACES  # pylint: disable=global-statement
+    section = "tracing"
+    keep = conf.getint(section, "keep", fallback=DEFAULT_KEEP)
+    with _TRACES_LOCK:
+        _TRACES = deque(_TRACES, maxlen=keep)
+    TRACE_SETTINGS.update({
+        "enabled": conf.getboolean(section, "enabled", fallback=False),
+        "slow_threshold": conf.getfloat(
+            section, "slow_threshold", fallback=DEFAULT_SLOW_THRESHOLD),
+        "profile_dir": conf.get(section, "profile_dir", fallback=tempfile.gettempdir()),
+    })
+
+
+class SamplingProfiler:
+    """
+    samples the stacks of all threads every interval seconds for a while
+    and writes them in the folded format of flamegraph tools
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._lock = threading.Lock()
+        self.last = None
+
+    def start(self, seconds, interval=DEFAULT_PROFILE_INTERVAL, label="") -> bool:
+        """starts profiling, returns False if a profile is already running"""
+        seconds = min(float(seconds), MAX_PROFILE_SECONDS)
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(
+                target=self._run, args=(seconds, float(interval), label),
+                name="profiler", daemon=True,
+            )
+            self._thread.start()
+        LOG.info("profiling for %ss", seconds)
+        return True
+
+    def running(self) -> bool:
+        """tells if a profile is being taken"""
+        with self._lock:
+            return bool(self._thread and self._thread.is_alive())
+
+    def _run(self, seconds, interval, label):
+        stacks = Counter()
+        own = threading.get_ident()
+        started = time.monotonic()
+        samples = 0
+        while time.monotonic() - started < seconds:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                                 f":{frame.f_lineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(interval)
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        path = os.path.join(TRACE_SETTINGS["profile_dir"],
+                            f"metersink-profile-{stamp}{label}.folded")
+        with open(path, "w", encoding="utf-8") as dump:
+            for stack, count in stacks.most_common():
+                dump.write(f"{stack} {count}\n")
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        self.last = {
+            "path": path,
+            "seconds": seconds,
+            "samples": samples,
+            "top": [[leaf, count] for leaf, count in leaves.most_common(20)],
+        }
+        LOG.info("wrote the profile of %s samples to %s", samples, path)
+
+    def status(self) -> dict:
+        """returns whether a profile is running and the summary of the last one"""
+        return {"running": self.running(), "last": self.last}
+
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,61 @@
+"""tests of the sample aggregation"""
+from datetime import datetime, timezone
+
+import pytest
+
+from metersink.aggregate import Aggregator
+
+WINDOW = 3600
+START = 1_700_000_000 // WINDOW * WINDOW
+
+
+def sample(meter, counter_type, volume, offset, resource_id="r1", **fields):
+    timestamp = datetime.fromtimestamp(START + offset, tz=timezone.utc).replace(tzinfo=None)
+    return {"counter_name": meter, "counter_type": counter_type, "counter_unit": "x",
+            "counter_volume": volume, "resource_id": resource_id, "project_id": "p1",
+            "timestamp": timestamp.isoformat(), **fields}
+
+
+def test_rollup_per_counter_type():
+    aggregator = Aggregator(window=WINDOW, grace=0)
+    aggregator.add_batch([
+        sample("network.incoming.bytes.delta", "delta", 5, 0),
+        sample("network.incoming.bytes.delta", "delta", 7, 1800),
+        sample("memory.usage", "gauge", 10, 0),
+        sample("memory.usage", "gauge", 30, 2700),
+        sample("cpu", "cumulative", 100, 0),
+        sample("cpu", "cumulative", 160, 1200),
+        # a counter reset
+        sample("cpu", "cumulative", 20, 2400),
+        # the next window, rolled up later
+        sample("cpu", "cumulative", 50, WINDOW + 10),
+    ])
+    records = {record.meter: record for record in aggregator.rollup(now=START + WINDOW)}
+    assert records["network.incoming.bytes.delta"].total == 12
+    memory = records["memory.usage"]
+    assert memory.mean == pytest.approx((10 * 2700 + 30 * 900) / WINDOW)
+    assert (memory.max, memory.last, memory.count) == (30, 30, 2)
+    assert records["cpu"].total == 60 + 20
+    later = aggregator.rollup(now=START + 2 * WINDOW)
+    assert [(record.meter, record.total) for record in later] == [("cpu", 30)]
+
+
+def test_invalid_samples_are_dropped_before_any_is_buffered():
+    aggregator = Aggregator(window=WINDOW, grace=0)
+    missing_timestamp = sample("memory.usage", "gauge", 1, 0)
+    del missing_timestamp["timestamp"]
+    rest = aggregator.add_batch([
+        sample("memory.usage", "gauge", 1, 0),
+        sample("memory.usage", "gauge", None, 60),
+        sample("memory.usage", "gauge", 1, 120, resource_id=None),
+        missing_timestamp,
+        sample("memory.usage", "gauge", float("nan"), 180),
+        sample("image.size", "gauge", 1, 0),
+        {"counter_name": None},
+        sample("memory.usage", "gauge", 3, 240),
+    ])
+    assert [message["counter_name"] for message in rest] == ["image.size"]
+    stats = aggregator.stats()
+    assert (stats["samples"], stats["invalid"], stats["ignored"]) == (2, 5, 1)
+    records = aggregator.rollup(now=START + WINDOW)
+    assert [(record.count, record.max) for record in records] == [(2, 3)]
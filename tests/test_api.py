@@ -0,0 +1,50 @@
+"""tests of the http endpoints"""
+import gzip
+import json
+
+import pytest
+
+from metersink.api import app
+from metersink.ingest import QueueFull
+
+
+@pytest.fixture(name="taken")
+def fixture_taken(monkeypatch):
+    taken = []
+
+    def accept(batch):
+        if batch and batch[0].get("full"):
+            raise QueueFull(retry_after=3)
+        taken.append(batch)
+        return len(batch)
+
+    monkeypatch.setitem(app.config, "accept", accept)
+    monkeypatch.setitem(app.config, "max_batch", 2)
+    monkeypatch.setitem(app.config, "max_message", 100)
+    return taken
+
+
+def post(body, **headers):
+    return app.test_client().post("/post_json", data=body, headers={
+        "Content-Type": "application/json", **headers})
+
+
+def test_body_is_queued_in_batches(taken):
+    messages = [{"message_id": str(number)} for number in range(5)]
+    response = post(gzip.compress(json.dumps(messages).encode()), **{"Content-Encoding": "gzip"})
+    assert response.status_code == 202
+    assert response.get_json() == {"received": 5, "accepted": 5}
+    assert taken == [messages[:2], messages[2:4], messages[4:]]
+
+
+@pytest.mark.parametrize("tail, status", [
+    (b'{"full": true}]', 503),
+    (b'broken]', 400),
+    (b'{"message_id": "' + b"x" * 200 + b'"}]', 413),
+])
+def test_error_answers_count_the_messages_taken(taken, tail, status):
+    body = b'[{"message_id": "a"}, {"message_id": "b"}, ' + tail
+    response = post(body)
+    assert response.status_code == status
+    assert response.get_json()["received"] == 2
+    assert taken == [[{"message_id": "a"}, {"message_id": "b"}]]
@@ -0,0 +1,56 @@
+"""tests of the backfill"""
+import json
+
+from metersink.backfill import Checkpoints, backfill
+
+
+def run(path, checkpoint, failing=()):
+    delivered = []
+
+    def deliver(item):
+        messages, _commit, _sinks, on_done = item
+        ok = not any(message["message_id"] in failing for message in messages)
+        if ok:
+            delivered.extend(message["message_id"] for message in messages)
+        on_done(ok)
+
+    report = backfill([path], deliver, ["odoo"], workers=1, batch_size=2,
+                      checkpoint_path=checkpoint)
+    return report, sorted(delivered, key=int)
+
+
+def test_resume_sends_only_the_failed_chunk_again(tmp_path):
+    path = str(tmp_path / "pushed.jsonl")
+    checkpoint = str(tmp_path / "backfill.checkpoint")
+    with open(path, "w", encoding="utf-8") as output:
+        for number in range(1, 11):
+            output.write(json.dumps({"message_id": str(number)}) + "\n")
+
+    report, delivered = run(path, checkpoint, failing={"3"})
+    assert report["failed"] == 1
+    assert delivered == ["1", "2", "5", "6", "7", "8", "9", "10"]
+    checkpoints = Checkpoints(checkpoint)
+    assert checkpoints.lines(path) == 2
+    assert checkpoints.delivered(path) == [(4, 10)]
+    assert not checkpoints.complete(path)
+
+    report, delivered = run(path, checkpoint)
+    assert delivered == ["3", "4"]
+    assert Checkpoints(checkpoint).complete(path)
+
+    report, delivered = run(path, checkpoint)
+    assert report["skipped"] == 1 and delivered == []
+
+
+def test_delivered_ranges_between_failed_chunks(tmp_path):
+    path = str(tmp_path / "pushed.jsonl")
+    checkpoint = str(tmp_path / "backfill.checkpoint")
+    with open(path, "w", encoding="utf-8") as output:
+        for number in range(1, 11):
+            output.write(json.dumps({"message_id": str(number)}) + "\n\n")
+
+    assert run(path, checkpoint, failing={"3", "7"})[1] == ["1", "2", "5", "6", "9", "10"]
+    assert run(path, checkpoint, failing={"7"})[1] == ["3", "4"]
+    assert Checkpoints(checkpoint).delivered(path) == [(15, 20)]
+    assert run(path, checkpoint)[1] == ["7", "8"]
+    assert Checkpoints(checkpoint).complete(path)
@@ -0,0 +1,64 @@
+"""tests of the traffic capture and its replay"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from metersink.capture import TrafficCapture
+from metersink.replay import iter_captured, replay
+
+
+def test_captured_batches_are_read_back(tmp_path):
+    path = str(tmp_path / "captured.jsonl")
+    capture = TrafficCapture(path)
+    request = capture.next_request()
+    capture.record(request, 100.0, [{"message_id": "a"}])
+    capture.record(request, 100.0, [{"message_id": "b"}])
+    capture.record(capture.next_request(), 101.5, [{"message_id": "c"}])
+    capture.close()
+    # a request still running at the close is not recorded
+    capture.record(capture.next_request(), 102.0, [{"message_id": "d"}])
+    assert list(iter_captured([path])) == [
+        (100.0, [{"message_id": "a"}]),
+        (100.0, [{"message_id": "b"}]),
+        (101.5, [{"message_id": "c"}]),
+    ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        with self.server.lock:
+            self.server.calls += 1
+            # every other answer is a 503, the replay waits it out
+            rejected = self.server.calls % 2
+            if not rejected:
+                self.server.batches.append(json.loads(body))
+        self.send_response(503 if rejected else 202)
+        self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *_args):
+        pass
+
+
+def test_replay_posts_every_batch(tmp_path):
+    path = str(tmp_path / "captured.jsonl")
+    capture = TrafficCapture(path)
+    for number in range(3):
+        capture.record(capture.next_request(), 100.0 + number, [{"message_id": str(number)}])
+    capture.close()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    server.lock, server.calls, server.batches = threading.Lock(), 0, []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        report = replay([path], url=f"http://127.0.0.1:{server.server_address[1]}/post_json",
+                        speed=0, concurrency=1)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert (report["requests"], report["messages"], report["failed"]) == (3, 3, 0)
+    assert report["rejected"] == 3
+    assert server.batches == [[{"message_id": str(number)}] for number in range(3)]
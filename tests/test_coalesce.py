@@ -0,0 +1,155 @@
+"""tests of the coalesced line writes"""
+import threading
+import time
+import xmlrpc.client
+
+from metersink.coalesce import WriteCoalescer
+
+ODOO = {"url": "http://odoo.test"}
+
+
+def line(quantity, order_id=1):
+    return {"order_id": order_id, "product_id": 2, "product_uom_qty": quantity}
+
+
+class FakeModel:
+    """records the creates and writes of a coalescer, create takes delay seconds"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.created = []
+        self.written = []
+        self._ids = iter(range(100, 10000))
+
+    def create(self, _odoo, _model, args):
+        time.sleep(self.delay)
+        values = args[0]
+        if isinstance(values, dict):
+            values = [values]
+        if any(value["order_id"] is None for value in values):
+            raise xmlrpc.client.Fault(1, "order_id is required")
+        self.created.extend(values)
+        ids = [next(self._ids) for _values in values]
+        return ids if isinstance(args[0], list) else ids[0]
+
+    def write(self, _odoo, _model, record_ids, values):
+        self.written.append((list(record_ids), values))
+
+
+def test_creates_and_updates_are_coalesced():
+    model = FakeModel()
+    coalescer = WriteCoalescer(ODOO, model.create, model.write)
+    coalescer.create("r1", line(1))
+    coalescer.create("r1", line(2))
+    coalescer.create("r2", line(5))
+    coalescer.update(7, {"product_uom_qty": 3})
+    coalescer.update(8, {"product_uom_qty": 3})
+    assert coalescer.flush() == {"r1": 100, "r2": 101}
+    assert model.created == [line(2), line(5)]
+    assert model.written == [([7, 8], {"product_uom_qty": 3})]
+
+
+def test_update_while_create_in_flight_follows_up():
+    model = FakeModel(delay=0.2)
+    coalescer = WriteCoalescer(ODOO, model.create, model.write)
+    coalescer.create("r1", line(1))
+    flush = threading.Thread(target=coalescer.flush)
+    flush.start()
+    time.sleep(0.1)
+    assert coalescer.update_pending("r1", {"product_uom_qty": 2})
+    flush.join()
+    assert model.created == [line(1)]
+    coalescer.flush()
+    assert model.written == [([100], {"product_uom_qty": 2})]
+
+
+def test_update_waits_for_the_line_index():
+    model = FakeModel(delay=0.1)
+    line_index = {}
+    indexing = threading.Event()
+
+    def on_created(created):
+        indexing.set()
+        time.sleep(0.2)
+        line_index.update(created)
+
+    coalescer = WriteCoalescer(ODOO, model.create, model.write, on_created=on_created)
+    coalescer.create("r1", line(1))
+    flush = threading.Thread(target=coalescer.flush)
+    flush.start()
+    assert indexing.wait(5)
+    started = time.monotonic()
+    # blocks until the id is indexed, then there is no pending create
+    assert not coalescer.update_pending("r1", {"product_uom_qty": 2})
+    assert time.monotonic() - started >= 0.1
+    assert line_index == {"r1": 100}
+    flush.join()
+    assert len(model.created) == 1
+
+
+def test_failed_create_is_retried_and_written_waits():
+    model = FakeModel()
+    calls = []
+
+    def create(odoo, name, args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise OSError("down")
+        return model.create(odoo, name, args)
+
+    coalescer = WriteCoalescer(ODOO, create, model.write)
+    coalescer.create("r1", line(1))
+    written = coalescer.written()
+    try:
+        coalescer.flush()
+    except OSError:
+        pass
+    assert not written.done()
+    assert coalescer.flush() == {"r1": 100}
+    assert written.result(timeout=1)
+
+
+def test_line_without_order_is_failed_right_away():
+    model = FakeModel()
+    failed = []
+    coalescer = WriteCoalescer(ODOO, model.create, model.write,
+                               on_failed=lambda lines, error: failed.extend(lines))
+    coalescer.create("r1", line(1, order_id=None))
+    assert failed == [{**line(1, order_id=None), "key": "r1"}]
+    assert coalescer.flush() == {}
+    assert not model.created
+
+
+def test_rejected_bulk_create_falls_back_to_single_creates():
+    model = FakeModel()
+    failed = []
+    coalescer = WriteCoalescer(ODOO, model.create, model.write,
+                               on_failed=lambda lines, error: failed.extend(lines))
+    coalescer.create("r1", line(1))
+    coalescer.create("r2", line(2))
+    # odoo rejects a line which passed the check, e.g. of a deleted order
+    coalescer._creates["r2"]["order_id"] = None  # pylint: disable=protected-access
+    coalescer.update(7, {"product_uom_qty": 3})
+    written = coalescer.written()
+    assert coalescer.flush() == {"r1": 100}
+    assert failed == [{**line(2, order_id=None), "key": "r2"}]
+    assert model.written == [([7], {"product_uom_qty": 3})]
+    assert written.result(timeout=1)
+    assert coalescer.stats()["pending_creates"] == 0
+
+
+def test_updates_are_written_while_creates_fail():
+    model = FakeModel()
+
+    def create(_odoo, _model, _args):
+        raise OSError("down")
+
+    coalescer = WriteCoalescer(ODOO, create, model.write)
+    coalescer.create("r1", line(1))
+    coalescer.update(7, {"product_uom_qty": 3})
+    try:
+        coalescer.flush()
+    except OSError:
+        pass
+    assert model.written == [([7], {"product_uom_qty": 3})]
+    assert coalescer.stats()["pending_creates"] == 1
@@ -0,0 +1,33 @@
+"""tests of the dead letter store"""
+import configparser
+import os
+
+from metersink.deadletter import DeadLetterStore, get_dead_letter_settings, iter_letters
+
+
+def test_letters_are_kept_per_sink_until_taken(tmp_path):
+    store = DeadLetterStore(str(tmp_path), fsync=False)
+    store.add("odoo/a", [{"message_id": "1"}], ValueError("bad"))
+    store.add("file", [{"message_id": "2"}, {"message_id": "3"}], OSError("full"))
+    assert sorted(sink for sink, _path in store.pending()) == ["file", "odoo/a"]
+    [(_sink, path)] = store.pending("odoo/a")
+    taken = store.take(path)
+    # a new letter of the sink goes to a new file while the redrive runs
+    store.add("odoo/a", [{"message_id": "4"}], ValueError("bad"))
+    assert sorted(path for _sink, path in store.pending("odoo/a")) == sorted(
+        [path, taken])
+    [letter] = iter_letters(taken)
+    assert letter["sink"] == "odoo/a" and letter["error"] == "ValueError: bad"
+    assert store.stats()["file"] == {"batches": 1, "messages": 2}
+
+
+def test_worker_processes_have_their_own_directory(tmp_path):
+    conf = configparser.ConfigParser()
+    assert get_dead_letter_settings(conf) is None
+    conf.read_dict({"dead_letter": {"path": str(tmp_path)}})
+    settings = get_dead_letter_settings(conf, worker=1)
+    assert settings["directory"] == os.path.join(str(tmp_path), "worker-1")
+    store = DeadLetterStore(**settings)
+    store.add("file", [{}], ValueError("bad"))
+    # the store of the front or a redrive finds them
+    assert [sink for sink, _path in DeadLetterStore(str(tmp_path)).pending()] == ["file"]
@@ -0,0 +1,80 @@
+"""tests of the message id deduplication"""
+import threading
+
+from metersink.dedup import Deduplicator
+
+
+def test_filter_drops_repeated_ids():
+    dedup = Deduplicator(capacity=1000)
+    batch = [{"message_id": "a"}, {"message_id": "b"}, {"message_id": "a"}]
+    assert dedup.filter(batch) == [{"message_id": "a"}, {"message_id": "b"}]
+    assert dedup.filter([{"message_id": "b"}, {"message_id": "c"}]) == [{"message_id": "c"}]
+    assert dedup.stats()["duplicates"] == 2
+
+
+def test_unseen_does_not_remember():
+    dedup = Deduplicator(capacity=1000)
+    batch = [{"message_id": "a"}]
+    assert dedup.unseen(batch) == batch
+    assert dedup.unseen(batch) == batch
+    dedup.remember(batch)
+    assert dedup.unseen(batch) == []
+
+
+def test_messages_without_id_pass():
+    dedup = Deduplicator(capacity=1000)
+    batch = [{"x": 1}, {"x": 1}]
+    assert dedup.filter(batch) == batch
+    assert dedup.filter(batch) == batch
+    assert dedup.stats()["without_id"] == 4
+
+
+def test_ids_outlive_one_rotation():
+    dedup = Deduplicator(capacity=2)
+    dedup.filter([{"message_id": "a"}, {"message_id": "b"}])
+    # rotates, the previous filter still has a and b
+    dedup.filter([{"message_id": "c"}])
+    assert dedup.unseen([{"message_id": "a"}]) == []
+    dedup.filter([{"message_id": "d"}, {"message_id": "e"}])
+    assert dedup.unseen([{"message_id": "a"}]) == [{"message_id": "a"}]
+
+
+def test_claimed_ids_are_duplicates_until_released():
+    dedup = Deduplicator(capacity=1000)
+    batch = [{"message_id": "a"}, {"message_id": "b"}]
+    assert dedup.claim(batch) == batch
+    # a concurrent retry of the same batch
+    assert dedup.claim(batch) == []
+    dedup.release(batch)
+    assert dedup.claim(batch) == batch
+    dedup.remember(batch)
+    assert dedup.stats()["claimed"] == 0
+    assert dedup.claim(batch) == []
+
+
+def test_concurrent_retries_are_taken_once():
+    dedup = Deduplicator(capacity=100000)
+    batch = [{"message_id": str(number)} for number in range(1000)]
+    taken = []
+    barrier = threading.Barrier(8)
+
+    def post():
+        barrier.wait()
+        taken.extend(dedup.claim(batch))
+
+    threads = [threading.Thread(target=post) for _number in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(taken, key=lambda message: int(message["message_id"])) == batch
+
+
+def test_batch_larger_than_capacity_rotates():
+    dedup = Deduplicator(capacity=100, error_rate=0.01)
+    dedup.filter([{"message_id": str(number)} for number in range(250)])
+    stats = dedup.stats()
+    assert stats["rotations"] == 2
+    assert stats["remembered"] <= 200
+    # the last chunks are still known
+    assert dedup.unseen([{"message_id": "249"}]) == []
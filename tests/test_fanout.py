@@ -0,0 +1,68 @@
+"""tests of the delivery to the sinks"""
+import threading
+
+import pytest
+
+from metersink.deadletter import DeadLetterStore, iter_letters
+from metersink.fanout import CircuitOpen, FanOut, Progress, SinkBusy
+from metersink.routing import SinkPolicy
+
+
+def test_transient_errors_are_retried():
+    calls = []
+
+    def deliver():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionResetError("reset")
+        return "done"
+
+    fanout = FanOut()
+    future = fanout.submit("odoo", deliver, policy=SinkPolicy(5.0, 2, backoff=0.0))
+    assert future.result(5) == "done"
+    assert fanout.stats()["odoo"]["retries"] == 2
+    fanout.shutdown()
+
+
+def test_failed_rest_of_a_batch_is_dead_lettered(tmp_path):
+    store = DeadLetterStore(str(tmp_path), fsync=False)
+    fanout = FanOut(dead_letters=store)
+    progress = Progress()
+
+    def deliver(batch):
+        progress.delivered = 2
+        raise ValueError(f"rejected {batch[2]}")
+
+    batch = [{"message_id": str(number)} for number in range(4)]
+    future = fanout.submit("file", deliver, batch, policy=SinkPolicy(5.0, 0),
+                           dead_letter=batch, progress=progress)
+    assert future.result(5) is None
+    [(_sink, path)] = store.pending()
+    assert [letter["messages"] for letter in iter_letters(path)] == [batch[2:]]
+    fanout.shutdown()
+
+
+def test_breaker_opens_after_failures_in_a_row():
+    def deliver():
+        raise ConnectionRefusedError("down")
+
+    fanout = FanOut()
+    policy = SinkPolicy(5.0, 0, breaker_threshold=2, breaker_reset=60.0)
+    for _attempt in range(2):
+        with pytest.raises(ConnectionRefusedError):
+            fanout.submit("odoo", deliver, policy=policy).result(5)
+    with pytest.raises(CircuitOpen):
+        fanout.submit("odoo", deliver, policy=policy).result(5)
+    assert fanout.stats()["odoo"]["breaker"] == "open"
+    fanout.shutdown()
+
+
+def test_full_backlog_fails_fast():
+    release = threading.Event()
+    fanout = FanOut(sink_threads=1, backlog=1)
+    running = fanout.submit("slow", release.wait, 5)
+    with pytest.raises(SinkBusy):
+        fanout.submit("slow", release.wait, 5).result(5)
+    release.set()
+    running.result(5)
+    fanout.shutdown()
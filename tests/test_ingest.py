@@ -0,0 +1,53 @@
+"""tests of the ingest queue"""
+import threading
+
+import pytest
+
+from metersink.ingest import IngestQueue, QueueFull, partition_of, split_batch
+
+
+def message(project_id, number):
+    return {"message_id": f"{project_id}-{number}", "traits": [["project_id", 1, project_id]]}
+
+
+def test_split_batch_keeps_the_order_of_a_project():
+    batch = [message(project_id, number) for number in range(5) for project_id in "abc"]
+    parts = split_batch(batch, 4)
+    for part in parts.values():
+        for project_id in "abc":
+            numbers = [m["message_id"] for m in part if m["message_id"][0] == project_id]
+            assert numbers == sorted(numbers)
+    assert sum(len(part) for part in parts.values()) == len(batch)
+    assert all(partition_of(m, 4) == partition for partition, part in parts.items()
+               for m in part)
+
+
+def test_reserve_takes_all_partitions_or_none():
+    queue = IngestQueue(lambda batch: None, queue_size=4, workers=2)
+    queue.reserve([0, 1])
+    with pytest.raises(QueueFull):
+        # both queues have room for one more batch, not for two
+        queue.reserve([0, 1, 1])
+    queue.reserve([0])
+    assert queue.full([0]) and not queue.full([1])
+    queue.release([0, 0, 1])
+    assert not queue.full()
+
+
+def test_batches_of_a_partition_are_delivered_in_order():
+    delivered = []
+    release = threading.Event()
+
+    def deliver(batch):
+        release.wait(5)
+        delivered.append(batch)
+
+    queue = IngestQueue(deliver, queue_size=100, workers=4)
+    queue.start()
+    for number in range(10):
+        queue.submit([number], partition=3)
+    release.set()
+    queue.join()
+    queue.stop()
+    assert delivered == [[number] for number in range(10)]
+    assert queue.stats()["delivered"] == 10
@@ -0,0 +1,106 @@
+"""tests of the usage ledger"""
+import configparser
+from datetime import datetime
+
+from benchmarks.fake_odoo import FakeOdoo
+from metersink import output_odoo
+from metersink.ingest import partition_of
+from metersink.ledger import UsageLedger, open_job_ledger, split_by_period
+from metersink.lib import Event
+from metersink.lifecycle import Usage
+
+START = datetime(2026, 1, 31, 22, 0)
+END = datetime(2026, 2, 1, 4, 0)
+
+
+def event(message_id, event_type, generated):
+    return Event(event_type=event_type, message_id=message_id, generated=generated,
+                 project_id="p1", resource_id="r1", flavor_name="m1", size=None,
+                 created_at=START, display_name="vm")
+
+
+def usage(end, seconds):
+    return Usage(state="active", size="m1", start=START, end=end, seconds=seconds,
+                 sizes={"m1": seconds})
+
+
+def test_split_by_period():
+    assert split_by_period(START, END) == [("2026-01", 7200.0), ("2026-02", 14400.0)]
+
+
+def test_usage_is_split_over_periods(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "ledger.sqlite"))
+    assert ledger.record("odoo", event("m1", "compute.instance.create.end", START),
+                         "vm", usage(START, 0.0))
+    # r1 runs 360 minutes, 120 of them in january and 240 in february
+    assert ledger.record("odoo", event("m2", "compute.instance.exists", END),
+                         "vm", usage(END, 21600.0))
+    january = ledger.period_totals("2026-01")
+    february = ledger.period_totals("2026-02", project_id="p1")
+    assert [row["minutes"] for row in january] == [120]
+    assert [row["minutes"] for row in february] == [240]
+    assert february[0]["sizes"] == {"m1": 240}
+    assert not february[0]["reconciled"]
+
+
+def test_duplicate_event_is_ignored(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "ledger.sqlite"))
+    ledger.record("odoo", event("m1", "compute.instance.create.end", START), "vm",
+                  usage(START, 0.0))
+    assert ledger.record("odoo", event("m2", "compute.instance.exists", END), "vm",
+                         usage(END, 21600.0))
+    assert not ledger.record("odoo", event("m2", "compute.instance.exists", END), "vm",
+                             usage(END, 21600.0))
+    assert ledger.stats()["duplicates"] == 1
+    assert ledger.period_totals("2026-02")[0]["minutes"] == 240
+
+
+def test_reconciled_rows_are_clean(tmp_path):
+    ledger = UsageLedger(str(tmp_path / "ledger.sqlite"), synchronous="FULL")
+    ledger.record("odoo", event("m1", "compute.instance.exists", END), "vm",
+                  usage(END, 21600.0))
+    totals, version = ledger.dirty("odoo")
+    assert [total.minutes for total in totals] == [360]
+    ledger.mark_synced("odoo", [total.resource_id for total in totals], version)
+    assert ledger.dirty("odoo")[0] == []
+    assert ledger.stats()["dirty"] == 0
+
+
+def test_reconcile_flags_resources_without_sale_order(tmp_path):
+    odoo_server = FakeOdoo(projects={"p1"}).start()
+    try:
+        odoo = {"url": odoo_server.url, "db": "test", "user_name": "u", "password": "p",
+                "user_id": 2}
+        ledger = UsageLedger(str(tmp_path / "ledger.sqlite"))
+        sink = output_odoo.sink_key(odoo)
+        ledger.record(sink, event("m1", "compute.instance.exists", END), "vm",
+                      usage(END, 21600.0))
+        orphan = event("m2", "compute.instance.exists", END)._replace(
+            project_id="p2", resource_id="r2")
+        ledger.record(sink, orphan, "vm", usage(END, 3600.0))
+
+        assert output_odoo.reconcile_odoo(odoo, ledger) == 1
+        lines = list(odoo_server.tables["sale.order.line"].values())
+        assert [line["product_uom_qty"] for line in lines] == [360]
+        assert ledger.stats()["unresolved"] == 1
+        # the next run leaves it out until its next event
+        assert output_odoo.reconcile_odoo(odoo, ledger) == 0
+        odoo_server.add_customer("p2")
+        output_odoo.invalidate_caches()
+        ledger.record(sink, orphan._replace(message_id="m3"), "vm", usage(END, 7200.0))
+        assert output_odoo.reconcile_odoo(odoo, ledger) == 1
+        assert ledger.stats()["dirty"] == 0
+    finally:
+        odoo_server.stop()
+
+
+def test_job_records_into_the_ledger_of_the_project_worker(tmp_path):
+    path = str(tmp_path / "ledger.sqlite")
+    conf = configparser.ConfigParser()
+    conf.read_dict({"ledger": {"enabled": "true", "path": path}})
+    ledger = open_job_ledger(conf, processes=2)
+    ledger.record("odoo", event("m1", "compute.instance.exists", END), "vm", usage(END, 60.0))
+    ledger.close()
+    worker = partition_of({"project_id": "p1"}, 2)
+    assert [len(UsageLedger(f"{path}.{number}").period_totals("2026-02"))
+            for number in range(2)] == [int(number == worker) for number in range(2)]
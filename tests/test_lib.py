@@ -0,0 +1,23 @@
+"""tests of the message helpers"""
+from metersink.lib import Event, messages_to_events
+
+
+def message(message_id="m1", **traits):
+    traits = {"project_id": "p1", "resource_id": "r1", "flavor_name": "m1", **traits}
+    return {"event_type": "compute.instance.exists", "message_id": message_id,
+            "generated": "2026-03-01T10:00:00", "traits": traits}
+
+
+def test_events_without_required_fields_are_skipped():
+    sample = {"counter_name": "cpu", "counter_volume": 1}
+    events = messages_to_events([
+        message(),
+        message(project_id=None),
+        message(resource_id=None),
+        message(message_id=None),
+        {"event_type": "compute.instance.exists", "generated": "not a time"},
+        sample,
+    ])
+    assert isinstance(events[0], Event) and events[0].resource_id == "r1"
+    assert events[1:5] == [None] * 4
+    assert events[5] is sample
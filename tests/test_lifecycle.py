@@ -0,0 +1,40 @@
+"""tests of the resource lifecycle"""
+from datetime import datetime, timedelta
+
+from metersink.lifecycle import DELETED, IntervalStore
+
+START = datetime(2026, 3, 1, 10, 0)
+
+
+def at(minutes):
+    return START + timedelta(minutes=minutes)
+
+
+def test_runtime_per_size_until_deletion():
+    store = IntervalStore()
+    store.apply("r1", "compute.instance.create.end", at(0), "small", message_id="m1")
+    store.apply("r1", "compute.instance.exists", at(30), "large", message_id="m2")
+    store.apply("r1", "compute.instance.shelve.end", at(50), None, message_id="m3")
+    store.apply("r1", "compute.instance.unshelve.end", at(80), None, message_id="m4")
+    usage = store.apply("r1", "compute.instance.delete.end", at(90), None, message_id="m5")
+    assert usage.state == DELETED
+    assert usage.minutes == 60
+    assert usage.sizes == {"small": 1800.0, "large": 1800.0}
+    # a late duplicate gets the final usage
+    assert store.apply("r1", "compute.instance.exists", at(95), None) == usage
+
+
+def test_duplicates_and_stale_events_do_not_count():
+    store = IntervalStore()
+    store.apply("r1", "compute.instance.create.end", at(0), "small", message_id="m1")
+    usage = store.apply("r1", "compute.instance.exists", at(60), None, message_id="m2")
+    assert store.apply("r1", "compute.instance.exists", at(60), None, message_id="m2") == usage
+    assert store.apply("r1", "compute.instance.exists", at(30), None, message_id="m3") == usage
+    assert store.stats()["duplicates"] == 1 and store.stats()["stale"] == 1
+
+
+def test_resource_first_seen_continues_after_what_was_billed():
+    store = IntervalStore()
+    usage = store.apply("r1", "compute.instance.exists", at(120), "small",
+                        created_at=at(0), billed=(at(0), at(90)))
+    assert usage.minutes == 120
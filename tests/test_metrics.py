@@ -0,0 +1,35 @@
+"""tests of the in-process metrics"""
+import threading
+
+import pytest
+
+from metersink import metrics
+
+
+def test_metric_without_its_hooks_fails_when_it_is_created():
+    class Gauge(metrics._Sharded):  # pylint: disable=protected-access
+        kind = "gauge"
+
+        def _merge(self, total, value):
+            return value
+
+    registered = len(metrics._METRICS)  # pylint: disable=protected-access
+    with pytest.raises(TypeError):
+        Gauge("test_gauge", "a gauge without samples")
+    # it would break every scrape from the registry
+    assert len(metrics._METRICS) == registered  # pylint: disable=protected-access
+
+
+def test_counter_adds_up_its_threads():
+    counter = metrics.Counter("test_events_total", "events", labels=("kind",))
+    threads = [threading.Thread(target=counter.inc, args=("a",), kwargs={"amount": 2})
+               for _thread in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc("b")
+    assert counter.values() == {("a",): 8, ("b",): 1}
+    text = metrics.render([(counter.name, counter.kind, counter.documentation,
+                            counter.samples())])
+    assert 'test_events_total{kind="a"} 8' in text
@@ -0,0 +1,39 @@
+"""tests of the odoo sink"""
+from datetime import datetime
+
+import pytest
+
+from benchmarks.fake_odoo import FakeOdoo
+from metersink import output_odoo
+from metersink.lib import Event
+
+START = datetime(2026, 3, 1, 10, 0)
+
+
+@pytest.fixture(name="odoo_server")
+def fixture_odoo_server():
+    odoo_server = FakeOdoo(projects={"p1"}).start()
+    output_odoo.invalidate_caches()
+    yield odoo_server
+    odoo_server.stop()
+    output_odoo.invalidate_caches()
+
+
+def session(odoo_server):
+    return {"url": odoo_server.url, "db": "test", "user_name": "u", "password": "p",
+            "user_id": 2}
+
+
+def event(project_id, resource_id):
+    return Event(event_type="compute.instance.exists", message_id=f"m-{resource_id}",
+                 generated=START, project_id=project_id, resource_id=resource_id,
+                 flavor_name="m1", size=None, created_at=START, display_name="vm")
+
+
+def test_event_without_sale_order_writes_no_line(odoo_server):
+    odoo = session(odoo_server)
+    output_odoo.odoo_handle_os_resource(odoo, event("p2", "r-orphan"))
+    assert not odoo_server.tables["sale.order.line"]
+    output_odoo.odoo_handle_os_resource(odoo, event("p1", "r-known"))
+    lines = list(odoo_server.tables["sale.order.line"].values())
+    assert len(lines) == 1 and lines[0]["order_id"]
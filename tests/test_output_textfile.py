@@ -0,0 +1,38 @@
+"""tests of the file sink writer"""
+import json
+import os
+import types
+
+import pytest
+
+from metersink.output_textfile import JsonLinesWriter
+
+
+def test_durable_write_counts_progress_once_on_disk(tmp_path, monkeypatch):
+    path = str(tmp_path / "out.jsonl")
+    writer = JsonLinesWriter(path, fsync=True)
+    progress = types.SimpleNamespace(delivered=0)
+
+    def fail(_fd):
+        raise OSError("disk gone")
+    monkeypatch.setattr(os, "fsync", fail)
+    with pytest.raises(OSError):
+        writer.write_batch([{"a": 1}, {"a": 2}], durable=True, progress=progress)
+    assert progress.delivered == 0
+
+    monkeypatch.undo()
+    writer.write_batch([{"a": 1}, {"a": 2}], durable=True, progress=progress)
+    assert progress.delivered == 2
+    writer.close()
+    with open(path, encoding="utf-8") as file:
+        lines = [json.loads(line) for line in file]
+    # the failed write left its messages in the page cache, the retry adds them
+    assert lines[-2:] == [{"a": 1}, {"a": 2}]
+
+
+def test_buffered_write_counts_progress(tmp_path):
+    writer = JsonLinesWriter(str(tmp_path / "out.jsonl"))
+    progress = types.SimpleNamespace(delivered=0)
+    writer.write_batch([{"a": 1}], progress=progress)
+    assert progress.delivered == 1
+    writer.close()
@@ -0,0 +1,103 @@
+"""tests of the incremental body decoding"""
+import gzip
+import io
+import json
+import zlib
+
+import pytest
+
+from metersink.parse import (
+    ParseError,
+    TooLarge,
+    UnsupportedFormat,
+    iter_batches,
+    iter_chunks,
+    iter_messages,
+)
+
+MESSAGES = [{"message_id": "a", "x": [1, 2]}, {"message_id": "b", "x": "]}"}]
+
+
+def parse(body, content_type="application/json", encoding="identity", chunk_size=4, **limits):
+    messages = iter_messages(io.BytesIO(body), content_type, encoding, chunk_size, **limits)
+    return [message for batch in iter_batches(messages, 1) for message in batch]
+
+
+def test_json_array_in_small_chunks():
+    body = b' [{"message_id": "a", "x": [1, 2]},\n {"message_id": "b", "x": "]}"}] '
+    assert parse(body) == MESSAGES
+
+
+def test_ndjson():
+    body = b'{"message_id": "a", "x": [1, 2]}\n\n{"message_id": "b", "x": "]}"}'
+    assert parse(body, "application/x-ndjson") == MESSAGES
+
+
+@pytest.mark.parametrize("encoding, compress", [
+    ("gzip", gzip.compress),
+    ("deflate", zlib.compress),
+    ("deflate", lambda body: zlib.compress(body)[2:-4]),
+])
+def test_compressed_bodies(encoding, compress):
+    body = b'[{"message_id": "a", "x": [1, 2]}, {"message_id": "b", "x": "]}"}]'
+    assert parse(compress(body), encoding=encoding) == MESSAGES
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b'[{"message_id": "a"}, {"message_id": ', "application/json"),
+    (b'[{"message_id": "a"}] []', "application/json"),
+    (b'{"message_id": "a"}\n{broken', "application/x-ndjson"),
+    (b'[{"message_id": "a"}, 3]', "application/json"),
+])
+def test_invalid_bodies(body, content_type):
+    with pytest.raises(ParseError):
+        parse(body, content_type)
+
+
+def test_truncated_gzip():
+    with pytest.raises(ParseError):
+        parse(gzip.compress(b'[{"message_id": "a"}]')[:-8], encoding="gzip")
+
+
+def test_unsupported_format():
+    with pytest.raises(UnsupportedFormat):
+        parse(b"[]", "text/plain")
+    with pytest.raises(UnsupportedFormat):
+        parse(b"[]", encoding="br")
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 64])
+def test_elements_across_chunks(chunk_size):
+    messages = [{"message_id": "a\\\"]", "x": -1.5e3}, {"y": [True, None, {"z": "{"}]}]
+    body = json.dumps(messages).encode("utf-8")
+    assert parse(body, chunk_size=chunk_size) == messages
+    assert parse(b'{"message_id": "a"}', chunk_size=chunk_size) == [{"message_id": "a"}]
+
+
+def test_batches_are_yielded_while_the_body_is_read():
+    body = b'[{"message_id": "a"}, {"message_id": "b"}, {"message_id": "c"}, broken'
+    batches = iter_batches(iter_messages(io.BytesIO(body), "application/json", chunk_size=8), 2)
+    assert next(batches) == [{"message_id": "a"}, {"message_id": "b"}]
+    with pytest.raises(ParseError):
+        next(batches)
+
+
+@pytest.mark.parametrize("content_type", ["application/json", "application/x-ndjson"])
+def test_message_limit(content_type):
+    small, large = {"message_id": "a"}, {"message_id": "b" * 100}
+    if content_type == "application/json":
+        body = json.dumps([small, large]).encode("utf-8")
+    else:
+        body = b"\n".join(json.dumps(message).encode("utf-8") for message in (small, large))
+    assert parse(body, content_type, max_message=200) == [small, large]
+    with pytest.raises(TooLarge):
+        parse(body, content_type, max_message=50)
+
+
+def test_body_limit_counts_decompressed_bytes():
+    body = gzip.compress(b"[" + b" " * 100000 + b"]")
+    chunks = iter_chunks(io.BytesIO(body), "gzip", chunk_size=1024, max_body=10000)
+    with pytest.raises(TooLarge):
+        for chunk in chunks:
+            # a chunk is inflated in pieces of chunk_size
+            assert len(chunk) <= 1024
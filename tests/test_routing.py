@@ -0,0 +1,57 @@
+"""tests of the sink routing table"""
+import os
+
+import pytest
+
+from metersink.routing import Router, SinkPolicy
+
+CONFIG = """
+[output]
+file = {files}
+odoo = https://odoo.example
+
+[file]
+delivery_retries = 3
+
+[odoo]
+odoo_db = db1
+odoo_user_name = bot
+odoo_api_key = key
+"""
+
+
+def write_config(path, files, mtime):
+    with open(path, "w", encoding="utf-8") as config:
+        config.write(CONFIG.format(files=files))
+    os.utime(path, (mtime, mtime))
+
+
+def test_routes_are_a_read_only_snapshot(tmp_path):
+    path = str(tmp_path / "settings.conf")
+    write_config(path, "out.jsonl", 1000)
+    router = Router(path, check_interval=0)
+    routes = router.current()
+    assert list(routes.sinks) == ["file:out.jsonl", "odoo:https://odoo.example/db1"]
+    assert routes.sinks["file:out.jsonl"][2] == SinkPolicy(60.0, 3)
+    with pytest.raises(TypeError):
+        routes.sinks["file:other.jsonl"] = ("file", "other.jsonl", SinkPolicy(1.0, 0))
+    assert not hasattr(routes, "conf")
+
+    write_config(path, "other.jsonl", 2000)
+    reloaded = []
+    router.add_listener(reloaded.append)
+    assert router.current().files == ("other.jsonl",)
+    assert router.conf.get("output", "file") == "other.jsonl"
+    # the table handed out before stays as it was
+    assert routes.files == ("out.jsonl",) and "file:out.jsonl" in routes.sinks
+    assert len(reloaded) == 1
+
+
+def test_broken_config_keeps_the_old_routes(tmp_path):
+    path = str(tmp_path / "settings.conf")
+    write_config(path, "out.jsonl", 1000)
+    router = Router(path, check_interval=0)
+    with open(path, "a", encoding="utf-8") as config:
+        config.write("odoo_db =\n    db1\n    db2\n")
+    os.utime(path, (2000, 2000))
+    assert router.current().files == ("out.jsonl",)
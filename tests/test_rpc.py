@@ -0,0 +1,54 @@
+"""tests of the pooled xml-rpc transport"""
+import threading
+
+import pytest
+
+from benchmarks.fake_odoo import FakeOdoo
+from metersink.rpc import ConnectionPool, PooledServerProxy
+
+
+@pytest.fixture(name="odoo_server")
+def fixture_odoo_server():
+    odoo_server = FakeOdoo().start()
+    yield odoo_server
+    odoo_server.stop()
+
+
+def test_connections_are_kept_open(odoo_server):
+    pool = ConnectionPool(odoo_server.url, pool_size=2)
+    proxy = PooledServerProxy(pool, f"{odoo_server.url}/xmlrpc/2/common")
+    for _call in range(3):
+        assert proxy.version()["server_version"] == "16.0"
+    stats = pool.stats()
+    assert (stats["opened"], stats["reused"], stats["size"], stats["idle"]) == (1, 2, 1, 1)
+    pool.close()
+
+
+def test_checkout_waits_for_a_free_transport(odoo_server):
+    pool = ConnectionPool(odoo_server.url, pool_size=1, checkout_timeout=0.1)
+    with pool.checkout():
+        with pytest.raises(TimeoutError):
+            with pool.checkout():
+                pass
+        released = threading.Event()
+
+        def wait():
+            with pool.checkout():
+                released.set()
+
+        pool.checkout_timeout = 5.0
+        thread = threading.Thread(target=wait)
+        thread.start()
+    thread.join(5)
+    assert released.is_set() and pool.stats()["waits"] == 2
+
+
+def test_broken_transport_is_replaced(odoo_server):
+    pool = ConnectionPool(odoo_server.url, pool_size=1)
+    with pytest.raises(ConnectionResetError):
+        with pool.checkout():
+            raise ConnectionResetError("reset")
+    stats = pool.stats()
+    assert (stats["discarded"], stats["size"], stats["idle"]) == (1, 1, 1)
+    proxy = PooledServerProxy(pool, f"{odoo_server.url}/xmlrpc/2/common")
+    assert proxy.version()
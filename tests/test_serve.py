@@ -0,0 +1,66 @@
+"""tests of the front of the worker processes"""
+import itertools
+from concurrent.futures import Future
+
+import pytest
+
+from metersink.ingest import QueueFull, partition_of
+from metersink.serve import Front
+
+
+class FakeWorker:
+    """answers the calls of the front like a worker process, full if told so"""
+
+    def __init__(self, number, full=False):
+        self.number = number
+        self.full = full
+        self.prepared = {}
+        self.taken = []
+
+    def call(self, kind, payload=None) -> Future:
+        future = Future()
+        if kind == "prepare":
+            token, part = payload
+            if self.full:
+                future.set_result(("full", 3))
+                return future
+            self.prepared[token] = part
+            future.set_result(("ok", len(part)))
+        elif kind == "commit":
+            self.taken.extend(self.prepared.pop(payload, []))
+            future.set_result(("ok", None))
+        elif kind == "cancel":
+            self.prepared.pop(payload, None)
+            future.set_result(("ok", None))
+        return future
+
+
+def front_of(workers) -> Front:
+    front = Front.__new__(Front)
+    front.call_timeout = 1
+    front.workers = workers
+    front._tokens = itertools.count()  # pylint: disable=protected-access
+    return front
+
+
+def batch_for_both_workers() -> list:
+    projects = {}
+    for number in itertools.count():
+        projects.setdefault(partition_of({"project_id": f"p{number}"}, 2), f"p{number}")
+        if len(projects) == 2:
+            break
+    return [{"project_id": projects[0]}, {"project_id": projects[1]}]
+
+
+def test_batch_is_taken_by_all_workers():
+    workers = [FakeWorker(0), FakeWorker(1)]
+    assert front_of(workers).accept(batch_for_both_workers()) == 2
+    assert [len(worker.taken) for worker in workers] == [1, 1]
+
+
+def test_full_worker_rejects_the_whole_batch():
+    workers = [FakeWorker(0), FakeWorker(1, full=True)]
+    with pytest.raises(QueueFull):
+        front_of(workers).accept(batch_for_both_workers())
+    assert [worker.taken for worker in workers] == [[], []]
+    assert [worker.prepared for worker in workers] == [{}, {}]
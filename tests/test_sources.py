@@ -0,0 +1,72 @@
+"""tests of the queue consumers with the in-memory broker"""
+import time
+
+from metersink.dedup import Deduplicator
+from metersink.sources import MemoryBroker, MemorySource
+
+QUEUE = "metering"
+
+
+def wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def consume(broker, accept):
+    source = MemorySource(broker, queue_name=QUEUE, prefetch=50, consumers=1,
+                          batch_size=10, batch_timeout=0.05)
+    source.start(accept)
+    return source
+
+
+def publish(broker, message_ids):
+    for message_id in message_ids:
+        broker.publish(QUEUE, {"message_id": message_id})
+
+
+def test_delivered_batches_are_acked():
+    broker = MemoryBroker()
+    publish(broker, [str(number) for number in range(25)])
+    taken = []
+    source = consume(broker, lambda messages, on_done: (taken.extend(messages), on_done(True)))
+    try:
+        wait_for(lambda: broker.acked == 25)
+    finally:
+        source.stop(timeout=5)
+    assert [message["message_id"] for message in taken] == [str(number) for number in range(25)]
+    assert broker.depth(QUEUE) == 0
+
+
+def test_failed_batches_are_redelivered():
+    broker = MemoryBroker()
+    publish(broker, [str(number) for number in range(10)])
+    attempts = []
+
+    def accept(messages, on_done):
+        attempts.append(messages)
+        on_done(len(attempts) > 1)
+
+    source = consume(broker, accept)
+    try:
+        wait_for(lambda: broker.acked == 10)
+    finally:
+        source.stop(timeout=5)
+    assert len(attempts) == 2
+    assert sorted(attempts[0], key=str) == sorted(attempts[1], key=str)
+    assert source.stats()["nacked"] == 10
+
+
+def test_redelivered_duplicates_are_dropped():
+    broker = MemoryBroker()
+    dedup = Deduplicator(capacity=1000)
+    publish(broker, ["a", "b", "a", "c", "b"])
+    taken = []
+    source = consume(broker, lambda messages, on_done: (
+        taken.extend(dedup.filter(messages)), on_done(True)))
+    try:
+        wait_for(lambda: broker.acked == 5)
+    finally:
+        source.stop(timeout=5)
+    assert [message["message_id"] for message in taken] == ["a", "b", "c"]
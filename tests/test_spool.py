@@ -0,0 +1,103 @@
+"""tests of the write-ahead spool"""
+import os
+import threading
+
+from metersink.spool import Position, Spool
+
+
+def test_append_and_replay(tmp_path):
+    spool = Spool(str(tmp_path), sinks=["file"])
+    first = spool.append([{"message_id": "a"}])
+    second = spool.append([{"message_id": "b"}])
+    assert first.end == second.start
+    spool.close()
+
+    spool = Spool(str(tmp_path), sinks=["file"])
+    replayed = list(spool.replay())
+    assert [record.batch for record, _sinks in replayed] == [
+        [{"message_id": "a"}], [{"message_id": "b"}]]
+    assert all(sinks == ["file"] for _record, sinks in replayed)
+
+
+def test_commit_moves_checkpoint_without_gaps(tmp_path):
+    spool = Spool(str(tmp_path), sinks=["file", "odoo"])
+    first = spool.append([{"message_id": "a"}])
+    second = spool.append([{"message_id": "b"}])
+    spool.commit(second, "file")
+    assert spool.checkpoints["file"].position == Position(1, 0)
+    spool.commit(first, "file")
+    assert spool.checkpoints["file"].position == second.end
+    spool.close()
+
+    # only the sink which did not commit gets the batches again
+    spool = Spool(str(tmp_path), sinks=["file", "odoo"])
+    assert [sinks for _record, sinks in spool.replay()] == [["odoo"], ["odoo"]]
+
+
+def test_discard_commits_every_sink(tmp_path):
+    spool = Spool(str(tmp_path), sinks=["file", "odoo"])
+    record = spool.append([{"message_id": "a"}])
+    spool.discard(record)
+    assert spool.stats()["checkpoints"] == {"file": list(record.end), "odoo": list(record.end)}
+
+
+def test_compact_deletes_delivered_segments(tmp_path):
+    spool = Spool(str(tmp_path), sinks=["file"], segment_size=10)
+    records = [spool.append([{"message_id": str(number)}]) for number in range(3)]
+    assert len(spool.segments()) == 4
+    for record in records:
+        spool.commit(record, "file")
+    assert spool.segments() == [4]
+
+
+def test_torn_write_is_cut_off(tmp_path):
+    spool = Spool(str(tmp_path), sinks=["file"])
+    record = spool.append([{"message_id": "a"}])
+    spool.close()
+    with open(os.path.join(str(tmp_path), "0000000001.log"), "ab") as segment:
+        segment.write(b'[{"message_id": "tor')
+
+    spool = Spool(str(tmp_path), sinks=["file"])
+    assert spool.end() == record.end
+    assert [record.batch for record, _sinks in spool.replay()] == [[{"message_id": "a"}]]
+    after = spool.append([{"message_id": "b"}])
+    assert after.start == record.end
+
+
+def test_concurrent_compaction(tmp_path):
+    sinks = [f"sink{number}" for number in range(4)]
+    spool = Spool(str(tmp_path), sinks=sinks, segment_size=10, fsync=False)
+    records = [spool.append([{"message_id": str(number)}]) for number in range(20)]
+    errors = []
+
+    def commit(sink):
+        try:
+            for record in records:
+                spool.commit(record, sink)
+        except OSError as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=commit, args=(sink,)) for sink in sinks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert spool.segments() == [21]
+
+
+def test_checkpoint_is_fsynced_before_it_replaces_the_old_one(tmp_path, monkeypatch):
+    spool = Spool(str(tmp_path), sinks=["file"])
+    record = spool.append([{"message_id": "a"}])
+    synced = []
+    fsync = os.fsync
+    checkpoint = os.path.join(str(tmp_path), "file.checkpoint")
+
+    def tracking_fsync(fd):
+        synced.append(os.path.exists(checkpoint))
+        fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", tracking_fsync)
+    spool.commit(record, "file")
+    # the new checkpoint file, then the directory with the rename
+    assert synced == [False, True]